@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+
+# Static analysis of Metaphor grammars, looking for things which are
+# slow or dangerous at run time:
+#
+#   - REPEAT of something which can match without consuming anything,
+#     which loops for ever;
+#   - left recursion, which recurses for ever;
+#   - calls of rules which don't exist, and variables used in a rule's
+#     output which the rule never sets;
+#   - alternatives which can start with the same character, so that a
+#     failed earlier one makes us re-parse the same input;
+#   - alternatives which can never be reached, because an earlier one
+#     always succeeds, or succeeds on a prefix of anything they match;
+#   - rules which are re-entered at the same input position (where the
+#     packrat memo pays for itself) and tiny rules which never are (where
+#     it's pure overhead).
+#
+# For each rule we print whether it's nullable, how it recurses and what
+# we think of memoising it. We exit with status 1 if we found anything
+# which will loop or crash at run time.
+#
+# Note that <*whitespace*> is skipped before every quoted token, so it
+# would put the whitespace characters in nearly every FIRST set; we treat
+# it as transparent there, since that re-parse is always a memo hit.
+
+import argparse
+import sys
+
+import metaphor_grammar
+
+WHITESPACE = "*whitespace*"
+
+#--------------------------------------------------------
+# Character sets which may be complemented (for ANY_BUT):
+# ("in", chars) or ("not", chars)
+
+NOTHING = ("in", frozenset())
+
+def union(a, b):
+    (kind_a, chars_a), (kind_b, chars_b) = a, b
+    if kind_a == "in" and kind_b == "in":
+        return ("in", chars_a | chars_b)
+    if kind_a == "not" and kind_b == "not":
+        return ("not", chars_a & chars_b)
+    if kind_a == "in":
+        return ("not", chars_b - chars_a)
+    return ("not", chars_a - chars_b)
+
+def overlap(a, b):
+    # Some characters both can start with (None if there aren't any)
+    (kind_a, chars_a), (kind_b, chars_b) = a, b
+    if kind_a == "in" and kind_b == "in":
+        common = chars_a & chars_b
+    elif kind_a == "in":
+        common = chars_a - chars_b
+    elif kind_b == "in":
+        common = chars_b - chars_a
+    else:
+        return "(almost anything)"
+    if not common:
+        return None
+    return " ".join(repr(c) for c in sorted(common)[:8]) + \
+           (" ..." if len(common) > 8 else "")
+
+#--------------------------------------------------------
+# Properties of nodes, given properties of the rules they call. Each is
+# computed for all the rules at once by iterating until nothing changes.
+
+def fixpoint(grammar, initial, compute):
+    values = {name: initial for name in grammar.rules}
+    changed = True
+    while changed:
+        changed = False
+        for name, body in grammar.rules.items():
+            value = compute(body, values)
+            if value != values[name]:
+                values[name] = value
+                changed = True
+    return values
+
+def nullable(node, rules):
+    # Can it succeed without consuming anything?
+    kind = node[0]
+    if kind == "alt":
+        return any(nullable(child, rules) for child in node[1])
+    if kind == "seq":
+        return all(nullable(child, rules) for child in node[1])
+    if kind in ("token", "literal"):
+        return node[1] == ""
+    if kind in ("any_of", "any_but"):
+        return False
+    if kind == "call":
+        return rules.get(node[1], node[1] == WHITESPACE)
+    if kind in ("group", "store"):
+        return nullable(node[1], rules)
+    return True     # repeat, output, gen, empty
+
+def infallible(node, rules):
+    # Does it always succeed?
+    kind = node[0]
+    if kind == "alt":
+        return any(infallible(child, rules) for child in node[1])
+    if kind == "seq":
+        return all(infallible(child, rules) for child in node[1])
+    if kind in ("token", "literal"):
+        return node[1] == ""
+    if kind in ("any_of", "any_but"):
+        return False
+    if kind == "call":
+        return rules.get(node[1], node[1] == WHITESPACE)
+    if kind in ("group", "store"):
+        return infallible(node[1], rules)
+    return True
+
+def first(node, rules, nullables):
+    # The characters it can start with
+    kind = node[0]
+    if kind == "alt":
+        result = NOTHING
+        for child in node[1]:
+            result = union(result, first(child, rules, nullables))
+        return result
+    if kind == "seq":
+        result = NOTHING
+        for child in node[1]:
+            result = union(result, first(child, rules, nullables))
+            if not nullable(child, nullables):
+                break
+        return result
+    if kind in ("token", "literal"):
+        return ("in", frozenset(node[1][:1]))
+    if kind == "any_of":
+        return ("in", frozenset(node[1]))
+    if kind == "any_but":
+        return ("not", frozenset(node[1]))
+    if kind == "call":
+        if node[1] == WHITESPACE:
+            return NOTHING
+        return rules.get(node[1], NOTHING)
+    if kind in ("group", "store", "repeat"):
+        return first(node[1], rules, nullables)
+    return NOTHING
+
+def left_calls(node, nullables):
+    # Rules it can call before consuming anything
+    kind = node[0]
+    if kind == "alt":
+        return set().union(*[left_calls(child, nullables)
+                             for child in node[1]])
+    if kind == "seq":
+        result = set()
+        for child in node[1]:
+            result |= left_calls(child, nullables)
+            if not nullable(child, nullables):
+                break
+        return result
+    if kind == "call":
+        return {node[1]}
+    if kind == "token":
+        return {WHITESPACE}
+    if kind in ("group", "store", "repeat"):
+        return left_calls(node[1], nullables)
+    return set()
+
+def skeleton(branch):
+    # The items of a branch that match input, without any names they're
+    # stored under: two branches which agree on these match the same way
+    items = branch[1] if branch[0] == "seq" else [branch]
+    result = []
+    for item in items:
+        if item[0] == "output":
+            continue
+        while item[0] == "store":
+            item = item[1]
+        result.append(item)
+    return result
+
+def shadows(a, b):
+    # Does branch a match whenever branch b does (so that b, tried after
+    # it, never gets a chance)? It does if a's items are the start of b's,
+    # or the same but for a last token or literal which starts b's one
+    a, b = skeleton(a), skeleton(b)
+    if len(a) > len(b):
+        return False
+    for k, (x, y) in enumerate(zip(a, b)):
+        if x == y:
+            continue
+        return k == len(a) - 1 and x[0] == y[0] and \
+               x[0] in ("token", "literal") and y[1].startswith(x[1])
+    return True
+
+def size(node):
+    return sum(1 for _ in metaphor_grammar.walk(node))
+
+#--------------------------------------------------------
+# Recursion: strongly connected components of the call graph (Tarjan)
+
+def components(graph):
+    index, lowlink, stack, on_stack, result = {}, {}, [], set(), []
+    def visit(v):
+        index[v] = lowlink[v] = len(index)
+        stack.append(v)
+        on_stack.add(v)
+        for w in graph.get(v, ()):
+            if w not in index:
+                visit(w)
+                lowlink[v] = min(lowlink[v], lowlink[w])
+            elif w in on_stack:
+                lowlink[v] = min(lowlink[v], index[w])
+        if lowlink[v] == index[v]:
+            component = []
+            while True:
+                w = stack.pop()
+                on_stack.discard(w)
+                component.append(w)
+                if w == v:
+                    break
+            result.append(component)
+    for v in graph:
+        if v not in index:
+            visit(v)
+    return result
+
+#--------------------------------------------------------
+
+class Analysis:
+    def __init__(self, grammar, filename):
+        self.grammar = grammar
+        self.filename = filename
+        self.problems = 0
+        self.nullables = fixpoint(grammar, False, nullable)
+        self.infallibles = fixpoint(grammar, False, infallible)
+        self.firsts = fixpoint(grammar, NOTHING, lambda node, rules:
+                               first(node, rules, self.nullables))
+        self.calls = {name: set(metaphor_grammar.calls(body))
+                      for name, body in grammar.rules.items()}
+        self.lefts = {name: left_calls(body, self.nullables)
+                      for name, body in grammar.rules.items()}
+        self.reentries = {name: 0 for name in grammar.rules}
+
+    def report(self, rule, level, message):
+        print("%s: <%s>: %s: %s" % (self.filename, rule, level, message))
+        if level == "error":
+            self.problems += 1
+
+    def left_closure(self, node):
+        # Rules called at the position where node starts, however indirectly
+        todo = list(left_calls(node, self.nullables))
+        found = set()
+        while todo:
+            name = todo.pop()
+            if name not in found:
+                found.add(name)
+                todo.extend(self.lefts.get(name, ()))
+        return found
+
+    def check_undefined(self):
+        for name, called in self.calls.items():
+            for callee in sorted(called):
+                if callee not in self.grammar.rules and callee != WHITESPACE:
+                    self.report(name, "error", "calls undefined rule <%s>" %
+                                callee)
+        if self.grammar.start not in self.grammar.rules:
+            self.report(self.grammar.start, "error",
+                        "start rule is not defined")
+        for name in self.grammar.tokens:
+            if name not in self.grammar.rules:
+                self.report(name, "error", "is a token, but not defined")
+            elif self.nullables[name]:
+                self.report(name, "warning", "is a token, but can match "
+                            "nothing, so the lexer won't be used")
+
+    def check_variables(self, name):
+        # (The runtime won't load a compiler with one of these either)
+        stored, loaded = set(), []
+        for node in metaphor_grammar.walk(self.grammar.rules[name]):
+            if node[0] in ("store", "output") and node[2] is not None:
+                stored.add(node[2])
+            if node[0] == "output":
+                loaded += [out[1] for out in node[1] if out[0] == "load"]
+        for variable in sorted(set(loaded) - stored):
+            self.report(name, "error", "uses the variable %s, which it "
+                        "never sets" % variable)
+
+    def check_unused(self):
+        used = {self.grammar.start}
+        todo = [self.grammar.start]
+        for name in self.grammar.tokens:
+            if name not in used:
+                used.add(name)
+                todo.append(name)
+        while todo:
+            for callee in self.calls.get(todo.pop(), ()):
+                if callee not in used:
+                    used.add(callee)
+                    todo.append(callee)
+        for name in self.grammar.rules:
+            if name not in used:
+                self.report(name, "note", "is never used")
+
+    def check_nodes(self, name):
+        for node in metaphor_grammar.walk(self.grammar.rules[name]):
+            if node[0] == "repeat" and nullable(node[1], self.nullables):
+                self.report(name, "error",
+                            "REPEAT of something which can match empty "
+                            "input will loop for ever")
+            if node[0] == "alt":
+                self.check_alternatives(name, node[1])
+
+    def check_alternatives(self, name, branches):
+        last = len(branches)
+        for i, branch in enumerate(branches[:-1]):
+            if infallible(branch, self.infallibles):
+                self.report(name, "warning",
+                            "alternative %d always succeeds, so %s never "
+                            "tried" % (i + 1, "the rest are" if i + 2 <
+                                       len(branches) else "the last is"))
+                last = i + 1
+                break
+        # An alternative which can't match unless an earlier one does is
+        # unreachable, which is a bug rather than a re-parse cost
+        shadowed = set()
+        for j in range(1, last):
+            for i in range(j):
+                if shadows(branches[i], branches[j]):
+                    self.report(name, "warning",
+                                "alternative %d can never match, since %d "
+                                "matches first wherever it would" %
+                                (j + 1, i + 1))
+                    shadowed.add(j)
+                    break
+        starts = [first(branch, self.firsts, self.nullables)
+                  for branch in branches]
+        for i in range(last):
+            for j in range(i + 1, last):
+                if j in shadowed:
+                    continue
+                common = overlap(starts[i], starts[j])
+                if common:
+                    self.report(name, "warning",
+                                "alternatives %d and %d can both start with "
+                                "%s; if %d fails we re-parse that input for "
+                                "%d (consider factoring out the common "
+                                "prefix)" % (i + 1, j + 1, common,
+                                             i + 1, j + 1))
+        # A rule called at the same place in more than one alternative
+        # (at the start, or after a prefix they share) is called again at
+        # the same position whenever an earlier alternative fails
+        again = set()
+        for i in range(len(branches)):
+            for j in range(i + 1, len(branches)):
+                again |= self.shared_calls(branches[i], branches[j])
+        for callee in again:
+            if callee in self.reentries:
+                self.reentries[callee] += 1
+
+    def shared_calls(self, a, b):
+        a, b = skeleton(a), skeleton(b)
+        shared = set()
+        k = 0
+        while k < min(len(a), len(b)) and a[k] == b[k]:
+            shared |= set(metaphor_grammar.calls(a[k]))
+            k += 1
+        if k < len(a) and k < len(b):
+            shared |= self.left_closure(a[k]) & self.left_closure(b[k])
+        return shared
+
+    def check_recursion(self):
+        graph = {name: self.calls[name] & set(self.grammar.rules)
+                 for name in self.grammar.rules}
+        self.recursion = {name: "none" for name in self.grammar.rules}
+        for component in components(graph):
+            if len(component) > 1:
+                for name in component:
+                    self.recursion[name] = "mutual (%s)" % \
+                        ", ".join("<%s>" % n for n in sorted(component)
+                                  if n != name)
+            elif component[0] in graph[component[0]]:
+                self.recursion[component[0]] = "self"
+        for name in self.grammar.rules:
+            body = self.grammar.rules[name]
+            if name in self.left_closure(body):
+                self.recursion[name] += ", LEFT"
+                self.report(name, "error", "is left recursive, and will "
+                            "recurse for ever")
+
+    def memo_verdict(self, name):
+        body = self.grammar.rules[name]
+        leaf = not (self.calls[name] - {WHITESPACE})
+        if self.reentries[name]:
+            return "helps (re-entered after failure in %d place(s))" % \
+                   self.reentries[name]
+        if leaf and size(body) <= 4:
+            return "overhead only (tiny, and never re-entered)"
+        return "little benefit (never re-entered)"
+
+    def run(self, quiet):
+        self.check_undefined()
+        self.check_unused()
+        self.check_recursion()
+        for name in self.grammar.rules:
+            self.check_nodes(name)
+            self.check_variables(name)
+        if quiet:
+            return
+        print()
+        print("%-16s %-9s %-58s %s" % ("rule", "nullable", "memo", "recursion"))
+        for name in self.grammar.rules:
+            print("%-16s %-9s %-58s %s" %
+                  ("<%s>" % name, "yes" if self.nullables[name] else "no",
+                   self.memo_verdict(name), self.recursion[name]))
+
+#--------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    description="Look for performance hazards in Metaphor grammars")
+parser.add_argument("grammars", nargs="+", help="grammar files")
+parser.add_argument("--quiet", action="store_true",
+                    help="only print warnings, not the table of rules")
+ARGS = parser.parse_args()
+
+problems = 0
+for filename in ARGS.grammars:
+    try:
+        grammar = metaphor_grammar.read_grammar_file(filename)
+    except (OSError, metaphor_grammar.GrammarError) as problem:
+        print("%s: %s" % (filename, problem), file=sys.stderr)
+        problems += 1
+        continue
+    analysis = Analysis(grammar, filename)
+    analysis.run(ARGS.quiet)
+    problems += analysis.problems
+    if not ARGS.quiet and filename != ARGS.grammars[-1]:
+        print()
+
+sys.exit(1 if problems else 0)
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+
+# Benchmarks for the Metaphor runtime and the compilers it generates.
+#
+# We time metaphor-compiler.py compiling its own grammar, the AEXP and
+# test compilers on synthetic inputs made by repeating the examples up to
+# various sizes, and some tiny grammars which each exercise one primitive.
+# Every run is a separate process, so we can see its peak RSS, and it is
+# given --profile, so we can see how many instructions it executed, how
+# many blocks of memory the parse left allocated (Python doesn't count
+# the ones it allocated and freed again), and how long the garbage
+# collector took, which "--options=--gc" shows with the collector left
+# on during the parse.
+#
+# The "startup" benchmarks run metaphor-compiler.py (our biggest program)
+# on a tiny grammar, from source, from a .pyc and as bytecode on the
+# program-less runtime, so they're nearly all startup time. For those we
+# also check what they import beyond what Python loads anyway, against
+# --import-budget, and how long they take beyond Python's own startup
+# (an empty script, run the same way), against the baseline's time plus
+# --startup-budget.
+#
+# The results are compared with a stored baseline (see --save), and we
+# exit with status 1 if anything got slower, fatter or did more work by
+# more than the tolerance.
+
+import argparse
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from metaphor_tools import HERE, COMPILER, error, build_compiler, \
+     build_bytecode, build_runtime, build_pyc, run_measured
+
+#--------------------------------------------------------
+# Command line
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the Metaphor runtime and generated compilers")
+parser.add_argument("--sizes", default="1K,10K,100K",
+                    help="comma-separated input sizes, e.g. 1K,1M,100M")
+parser.add_argument("--primitive-size", default="50K",
+                    help="input size for the primitive benchmarks")
+parser.add_argument("--repeat", type=int, default=3,
+                    help="runs per benchmark (we keep the fastest)")
+parser.add_argument("--only", default="",
+                    help="comma-separated prefixes of benchmarks to run")
+parser.add_argument("--baseline",
+                    default=os.path.join(HERE, "benchmark-baseline.json"),
+                    help="where the baseline results are kept")
+parser.add_argument("--save", action="store_true",
+                    help="save these results as the new baseline")
+parser.add_argument("--tolerance", type=float, default=10.0,
+                    help="percentage change we put up with")
+parser.add_argument("--options", default="",
+                    help="extra runtime options for every run")
+parser.add_argument("--import-budget", type=float, default=2.0,
+                    help="milliseconds a compiler may spend importing at "
+                         "startup")
+parser.add_argument("--startup-budget", type=float, default=3.0,
+                    help="milliseconds a startup benchmark may take "
+                         "beyond its baseline")
+ARGS = parser.parse_args()
+
+def parse_size(text):
+    multiplier = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in multiplier:
+        return int(float(text[:-1]) * multiplier[text[-1]])
+    return int(text)
+
+#--------------------------------------------------------
+# Building compilers
+
+WORK = tempfile.mkdtemp(prefix="metaphor-benchmark-")
+atexit.register(shutil.rmtree, WORK, True)
+
+def build(name, grammar):
+    return build_compiler(grammar, WORK, name)
+
+def write_file(name, text):
+    path = os.path.join(WORK, name)
+    with open(path, "w") as fout:
+        fout.write(text)
+    return path
+
+#--------------------------------------------------------
+# Synthetic inputs: repeat a chunk of an example until we reach the size
+
+def read(name):
+    with open(os.path.join(HERE, name)) as fin:
+        return fin.read()
+
+def scaled(before, chunk, separator, after, size):
+    parts = [chunk]
+    total = len(before) + len(chunk) + len(after)
+    while total < size:
+        parts.append(chunk)
+        total += len(separator) + len(chunk)
+    return before + separator.join(parts) + after
+
+def aexp_input(size):
+    return scaled("", read("aexp-example.txt").strip() + "\n", "", "", size)
+
+def test_input(size):
+    text = read("test-example.txt")
+    body = text[text.index("BEGIN") + 5:text.rindex("END")].strip()
+    return scaled("BEGIN\n", body, ";\n", "\nEND\n", size)
+
+def metaphor_input(size):
+    text = read("metaphor-grammar.txt")
+    first = text.index("\n", text.index("BEGIN")) + 1
+    last = text.rindex("END")
+    return scaled(text[:first], text[first:last], "", "END\n", size)
+
+# Tiny grammars for timing one primitive at a time, and the runtime
+# options to run them with. "call-memo" calls <x> twice at each
+# position, so every other CALL is a memo hit. <x> only matches text, so
+# without --no-spans a call of it would be a match of a regular
+# expression rather than a CALL (see spanned()): "span" times that.
+NO_PATTERNS = ["--no-tokens", "--no-spans"]
+PRIMITIVES = [
+    ("literal", "<p> ::= REPEAT LITERAL 'abc';", "abc", NO_PATTERNS),
+    ("any-of", "<p> ::= REPEAT ANY_OF 'abc';", "abcbca", NO_PATTERNS),
+    ("call", "<p> ::= REPEAT <x>;\n<x> ::= ANY_OF 'abc';", "abcbca",
+     NO_PATTERNS),
+    ("call-memo", "<p> ::= REPEAT (<x> LITERAL ';' | <x> LITERAL ',');\n"
+                  "<x> ::= ANY_OF 'abc';", "a,b;c,", NO_PATTERNS),
+    ("span", "<p> ::= REPEAT <x>;\n<x> ::= ANY_OF 'abc';", "abcbca",
+     ["--patterns-from=0"]),
+]
+
+TINY_GRAMMAR = "BEGIN <p>\n<p> ::= 'x';\nEND\n"
+
+#--------------------------------------------------------
+# Running one benchmark
+
+def run_once(compiler, input_path, options):
+    options = ["--profile"] + options + ARGS.options.split()
+    run = run_measured(compiler, options, input_path, keep_stdout=False)
+    stderr = run.stderr.decode(errors="replace")
+    if run.status != 0:
+        error("+++ %s failed on %s:\n%s" % (compiler, input_path, stderr))
+    profile = {}
+    for line in stderr.splitlines():
+        if line.startswith("+++ profile: "):
+            _, _, what, value = line.split(None, 3)
+            profile[what] = value
+    return run.seconds, run.peak_rss_kb, profile
+
+def benchmark(name, compiler, input_path, options):
+    best = None
+    for _ in range(max(1, ARGS.repeat)):
+        seconds, rss, profile = run_once(compiler, input_path, options)
+        if best is None or seconds < best[0]:
+            best = (seconds, rss, profile)
+    seconds, rss, profile = best
+    chars = os.path.getsize(input_path)
+    return {"chars": chars,
+            "seconds": round(seconds, 6),
+            "chars_per_second": round(chars / seconds, 1),
+            "peak_rss_kb": rss,
+            "instructions": int(profile.get("instructions", 0)),
+            "allocated_blocks": int(profile.get("allocated-blocks", 0)),
+            "gc_seconds": float(profile.get("gc-seconds", 0))}
+
+def imports(command):
+    # What a command imports: {module: microseconds}, from -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    found = {}
+    for line in result.stderr.splitlines():
+        fields = line.partition("import time:")[2].split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            found[fields[2].strip()] = int(fields[0])
+    return found
+
+def extra_imports(compiler, input_path, options):
+    # The modules it imports which Python doesn't anyway
+    anyway = imports(["-c", "pass"])
+    return {module: us for module, us in
+            imports([compiler] + options + [input_path]).items()
+            if module not in anyway}
+
+#--------------------------------------------------------
+# The benchmarks themselves
+
+def wanted(name):
+    prefixes = [p for p in ARGS.only.split(",") if p]
+    return not prefixes or any(name.startswith(p) for p in prefixes)
+
+def startup_cases():
+    tiny = write_file("tiny-grammar.txt", TINY_GRAMMAR)
+    yield "startup-source", COMPILER, tiny, []
+    # (a copy, so that its .pyc goes in WORK)
+    copy = os.path.join(WORK, os.path.basename(COMPILER))
+    shutil.copy(COMPILER, copy)
+    yield "startup-pyc", build_pyc(copy), tiny, []
+    bytecode = build_bytecode(os.path.join(HERE, "metaphor-grammar.txt"),
+                              os.path.join(WORK, "metaphor.mbc"))
+    yield "startup-bytecode", build_pyc(build_runtime(WORK)), tiny, \
+          ["--bytecode=" + bytecode, "--compact"]
+
+def cases():
+    # (name, compiler, input file, runtime options)
+    labels = [s.strip() for s in ARGS.sizes.split(",") if s.strip()]
+    if any(wanted(name) for name in
+           ["startup-source", "startup-pyc", "startup-bytecode"]):
+        for case in startup_cases():
+            yield case
+    yield "self-compile", COMPILER, \
+          os.path.join(HERE, "metaphor-grammar.txt"), []
+    for kind, grammar, make_input, compiler in [
+            ("metaphor", None, metaphor_input, COMPILER),
+            ("aexp", "aexp-grammar.txt", aexp_input, None),
+            ("test", "test-grammar.txt", test_input, None)]:
+        names = [kind + "-" + label for label in labels]
+        if not any(wanted(name) for name in names):
+            continue
+        if compiler is None:
+            compiler = build(kind, os.path.join(HERE, grammar))
+        for name, label in zip(names, labels):
+            if wanted(name):
+                text = make_input(parse_size(label))
+                yield name, compiler, write_file(name + ".txt", text), []
+    size = parse_size(ARGS.primitive_size)
+    for kind, rules, chunk, options in PRIMITIVES:
+        name = "primitive-" + kind
+        if not wanted(name):
+            continue
+        grammar = write_file(name + "-grammar.txt",
+                             "BEGIN <p>\n" + rules + "\nEND\n")
+        compiler = build(name, grammar)
+        yield name, compiler, write_file(name + ".txt",
+                                         scaled("", chunk, "", "", size)), \
+              options
+
+def python_startup():
+    # Seconds to run an empty script, as run_once() runs a compiler
+    empty = write_file("empty.py", "")
+    return min(run_measured(empty, [], os.devnull, keep_stdout=False).seconds
+               for _ in range(max(1, ARGS.repeat)))
+
+RESULTS = {}
+over_budget = []
+PYTHON_startup = None
+for name, compiler, input_path, options in cases():
+    if wanted(name):
+        result = RESULTS[name] = benchmark(name, compiler, input_path,
+                                           options)
+        print("%-22s %10d chars %12d instrs %8.3fs %12.0f chars/s %8d KB "
+              "%9d blocks %7.3fs gc" %
+              (name, result["chars"], result["instructions"],
+               result["seconds"], result["chars_per_second"],
+               result["peak_rss_kb"], result["allocated_blocks"],
+               result["gc_seconds"]))
+        if name.startswith("startup-"):
+            extra = extra_imports(compiler, input_path, options)
+            result["import_ms"] = round(sum(extra.values()) / 1000.0, 3)
+            print("%-22s imports %s (%.3f ms)" %
+                  ("", ", ".join(sorted(extra)) or "nothing",
+                   result["import_ms"]))
+            if result["import_ms"] > ARGS.import_budget:
+                over_budget.append(
+                    "%s: imports take %.3f ms, over the %.3f ms budget" %
+                    (name, result["import_ms"], ARGS.import_budget))
+            if PYTHON_startup is None:
+                PYTHON_startup = python_startup()
+            result["startup_ms"] = round(
+                1000 * (result["seconds"] - PYTHON_startup), 3)
+            print("%-22s %.3f ms beyond Python's own startup" %
+                  ("", result["startup_ms"]))
+
+#--------------------------------------------------------
+# Compare with (or save) the baseline
+
+def change(new, old):
+    return 100.0 * (new - old) / old if old else 0.0
+
+if ARGS.save:
+    with open(ARGS.baseline, "w") as fout:
+        json.dump(RESULTS, fout, indent=2, sort_keys=True)
+        fout.write("\n")
+    print("Saved baseline to", ARGS.baseline)
+    sys.exit(0)
+
+if not os.path.exists(ARGS.baseline):
+    print("No baseline in %s (use --save to make one)" % ARGS.baseline)
+    for problem in over_budget:
+        print("***REGRESSION:", problem)
+    sys.exit(1 if over_budget else 0)
+
+with open(ARGS.baseline) as fin:
+    BASELINE = json.load(fin)
+
+regressions = over_budget[:]
+print()
+for name, result in RESULTS.items():
+    if name not in BASELINE:
+        continue
+    old = BASELINE[name]
+    speed = change(result["chars_per_second"], old["chars_per_second"])
+    rss = change(result["peak_rss_kb"], old["peak_rss_kb"])
+    steps = change(result["instructions"], old["instructions"])
+    blocks = change(result["allocated_blocks"],
+                    old.get("allocated_blocks", 0))
+    print("%-22s speed %+6.1f%%  rss %+6.1f%%  instructions %+6.1f%%  "
+          "blocks %+6.1f%%" % (name, speed, rss, steps, blocks))
+    if speed < -ARGS.tolerance:
+        regressions.append("%s: throughput down %.1f%%" % (name, -speed))
+    if rss > ARGS.tolerance:
+        regressions.append("%s: peak RSS up %.1f%%" % (name, rss))
+    if steps > ARGS.tolerance:
+        regressions.append("%s: instructions up %.1f%%" % (name, steps))
+    if blocks > ARGS.tolerance:
+        regressions.append("%s: allocated blocks up %.1f%%" % (name, blocks))
+    if "startup_ms" in result and "startup_ms" in old and \
+       result["startup_ms"] > old["startup_ms"] + ARGS.startup_budget:
+        regressions.append("%s: startup took %.3f ms, over the %.3f ms of "
+                           "the baseline and the %.3f ms budget" %
+                           (name, result["startup_ms"], old["startup_ms"],
+                            ARGS.startup_budget))
+
+if regressions:
+    print()
+    for regression in regressions:
+        print("***REGRESSION:", regression)
+    sys.exit(1)
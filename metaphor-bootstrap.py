@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# Bootstrap a new version of the compiler in one Python process.
+#
+# This does what "make fixedpoint" does, without starting four Pythons and
+# writing four compilers out: (with OLD meaning metaphor-compiler.py and
+# its runtime, and NEW the runtime in new-metaphor-runtime-*.py)
+#
+#   core1 = OLD compiler compiling new-in-old-metaphor-grammar.txt
+#   core2 = OLD runtime + core1 compiling new-in-new-metaphor-grammar.txt
+#   core3 = NEW runtime + core2 compiling new-in-new-metaphor-grammar.txt
+#   core4 = NEW runtime + core3 compiling new-in-new-metaphor-grammar.txt
+#
+# and then checks that core3 and core4 are the same program, instruction
+# by instruction. If the new-* files aren't there (no "make prepare") we
+# use the current grammar and runtime, which just checks that we're still
+# at a fixed point, like "make verify".
+#
+# The output of each stage is cached in .metaphor-cache, keyed by a hash
+# of everything that went into it, so re-running after changing only the
+# new runtime (say) only re-runs the stages which use it.
+
+import argparse
+import hashlib
+import os
+import time
+
+from metaphor_tools import HERE, COMPILER, error, combine, read_compiler, \
+     run_in_process, load_program
+
+CACHE = os.path.join(HERE, ".metaphor-cache")
+
+def here(name):
+    return os.path.join(HERE, name)
+
+def new_or_current(new, current):
+    return here(new) if os.path.exists(here(new)) else here(current)
+
+parser = argparse.ArgumentParser(
+    description="Bootstrap the Metaphor compiler to a fixed point in-process")
+parser.add_argument("--old-compiler", default=COMPILER)
+parser.add_argument("--old-grammar", default=new_or_current(
+    "new-in-old-metaphor-grammar.txt", "metaphor-grammar.txt"),
+    help="the new grammar, written in the old syntax")
+parser.add_argument("--new-grammar", default=new_or_current(
+    "new-in-new-metaphor-grammar.txt", "metaphor-grammar.txt"),
+    help="the new grammar, written in the new syntax")
+parser.add_argument("--new-header", default=new_or_current(
+    "new-metaphor-runtime-header.py", "metaphor-runtime-header.py"))
+parser.add_argument("--new-trailer", default=new_or_current(
+    "new-metaphor-runtime-trailer.py", "metaphor-runtime-trailer.py"))
+parser.add_argument("--output",
+                    help="write the fixed-point compiler here")
+parser.add_argument("--no-cache", action="store_true",
+                    help="run every stage, even if we've run it before")
+ARGS = parser.parse_args()
+
+def read(name):
+    with open(name) as fin:
+        return fin.read()
+
+#--------------------------------------------------------
+
+def stage(number, header, core, trailer, grammar):
+    with open(grammar) as fin:
+        source = fin.read()
+    key = hashlib.sha256("\0".join([header, core, trailer, source])
+                         .encode()).hexdigest()
+    cached = os.path.join(CACHE, key + ".py")
+    if not ARGS.no_cache and os.path.exists(cached):
+        print("stage %d: cached" % number)
+        return read(cached)
+    started = time.perf_counter()
+    status, output, errors = run_in_process(header, core, trailer, grammar)
+    if status != 0:
+        error("stage %d failed compiling %s:\n%s" % (number, grammar, errors))
+    print("stage %d: %.2fs" % (number, time.perf_counter() - started))
+    os.makedirs(CACHE, exist_ok=True)
+    with open(cached + ".tmp", "w") as fout:
+        fout.write(output)
+    os.replace(cached + ".tmp", cached)
+    return output
+
+def shape(program):
+    # Instructions by name rather than by function object, so that
+    # programs loaded separately can be compared
+    return [item if isinstance(item, str) else
+            (item[0].__name__,) + tuple(item[1:]) for item in program]
+
+def rule_names(program):
+    # The labels which are rules: what ADR starts at and CALL (or a
+    # superinstruction made from it) calls
+    return {item[1] for item in program
+            if not isinstance(item, str) and
+               (item[0] == "ADR" or item[0].startswith("CALL"))}
+
+def first_difference(a, b):
+    rules = rule_names(a) | rule_names(b)
+    rule = None
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i, rule, x, y
+        if isinstance(x, str) and x in rules:
+            rule = x
+    return min(len(a), len(b)), rule, None, None
+
+old_header, old_core, old_trailer = read_compiler(ARGS.old_compiler)
+new_header, new_trailer = read(ARGS.new_header), read(ARGS.new_trailer)
+
+core1 = stage(1, old_header, old_core, old_trailer, ARGS.old_grammar)
+core2 = stage(2, old_header, core1, old_trailer, ARGS.new_grammar)
+core3 = stage(3, new_header, core2, new_trailer, ARGS.new_grammar)
+core4 = stage(4, new_header, core3, new_trailer, ARGS.new_grammar)
+
+program3 = shape(load_program(new_header, core3))
+program4 = shape(load_program(new_header, core4))
+if program3 != program4:
+    index, rule, x, y = first_difference(program3, program4)
+    error("No fixed point: stages 3 and 4 first differ at instruction %d "
+          "(in <%s>):\n  %r\n  %r" % (index, rule, x, y))
+if core3 != core4:
+    error("Stages 3 and 4 are the same program, but not the same text")
+print("Fixed point: %d instructions" % len(program4))
+
+if ARGS.output:
+    with open(ARGS.output, "w") as fout:
+        fout.write(combine(new_header, core4, new_trailer))
+    os.chmod(ARGS.output, 0o755)
+    print("Wrote", ARGS.output)
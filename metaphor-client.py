@@ -0,0 +1,74 @@
+#!/usr/bin/python3 -S
+
+# The client for metaphor-daemon.py (which describes the protocol):
+#
+#   ./metaphor-client.py [--socket=PATH] compiler [options] file
+#
+# does what "compiler [options] file" would, but in the daemon, which
+# already has Python started and the compiler loaded. If there's no
+# daemon, we just run the compiler ourselves.
+#
+# This is run once per file, so it imports as little as it can (and the
+# -S above stops Python importing site, which we don't need either).
+
+import os
+import socket
+import struct
+import sys
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                              "metaphor-%d.sock" % os.getuid())
+
+FIELD = struct.Struct(">I")
+
+def error(*args):
+    print(*args, file=sys.stderr)
+    sys.exit(1)
+
+def send_message(connection, fields):
+    parts = [FIELD.pack(len(fields))]
+    for field in fields:
+        data = field.encode("utf-8")
+        parts += [FIELD.pack(len(data)), data]
+    connection.sendall(b"".join(parts))
+
+def receive_exactly(stream, n):
+    data = stream.read(n)
+    if len(data) != n:
+        error("+++ The Metaphor daemon went away")
+    return data
+
+def receive_message(stream):
+    count, = FIELD.unpack(receive_exactly(stream, FIELD.size))
+    fields = []
+    for _ in range(count):
+        length, = FIELD.unpack(receive_exactly(stream, FIELD.size))
+        fields.append(receive_exactly(stream, length))
+    return fields
+
+argv = sys.argv[1:]
+where = DEFAULT_SOCKET
+if argv and argv[0].startswith("--socket="):
+    where = argv.pop(0).partition("=")[2]
+if len(argv) < 2 or argv[0].startswith("--"):
+    error("Usage: %s [--socket=PATH] compiler [option ...] input-file" %
+          os.path.basename(sys.argv[0]))
+compiler, options, input_path = argv[0], argv[1:-1], argv[-1]
+
+connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+    connection.connect(where)
+except OSError:
+    # no daemon, so do it the slow way
+    os.execv(sys.executable, [sys.executable, compiler] + argv[1:])
+
+with connection:
+    send_message(connection, ["parse", os.getcwd(), compiler, input_path]
+                             + options)
+    with connection.makefile("rb") as stream:
+        status, stdout, stderr = receive_message(stream)
+
+# (stdout as it is, since with --bytes it needn't be UTF-8)
+sys.stdout.buffer.write(stdout)
+sys.stderr.write(stderr.decode("utf-8"))
+sys.exit(int(status))
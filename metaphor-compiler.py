@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
+# Startup time matters (a compiler may be run thousands of times on tiny
+# inputs), so only import here what every run needs, and nothing Python
+# hasn't already loaded for itself if we can help it. The rest is
+# imported where it's used.
+import codecs
+import io
 import sys
-import string
-import re
 import os
+import time
 
 # Meta-compiler runtime. This was originally based on a tutorial/website by
 # James M. Neighbors: "Tutorial: Metacompilers Part 1" (2008). That was
@@ -18,36 +23,190 @@ def error(*args):
 
 #--------------------------------------------------------
 # Parse command-line arguments, get filenames straight
+#
+# Options come before the input file. The limits bound how much work one
+# parse may do, so that a bad grammar or a pathological input can't tie
+# us up forever. Running out of any of them stops the parse with
+# LIMIT_EXIT_STATUS (exit status 1 means a usage or syntax error).
+# Options without a type are flags, given without a value.
+
+OPTIONS = {
+    "--max-steps":     int,    # instructions executed
+    "--max-seconds":   float,  # wall-clock time
+    "--max-memo":      int,    # entries in RULE_USE_CACHE
+    "--profile":       None,   # report counts and timings on stderr
+    "--fuse":          None,   # use superinstructions (see fuse())
+    "--inline":        None,   # inline tiny rules (see inline())
+    "--compact":       None,   # run the compact form (see assemble())
+    "--bytecode":      str,    # run the program in this bytecode file
+    "--emit-bytecode": str,    # write our output as a bytecode file
+    "--parallel":      int,    # worker processes (see parallel_pass())
+    "--split-rule":    str,    # ... which parse runs of this rule
+    "--split-at":      str,    # ... from just after this text
+    "--stream":        str,    # parse a stream of this rule (see
+                               # parse_stream()); the input may be "-"
+    "--memo-spill":    int,    # memo entries to keep in memory before
+                               # spilling to disk (see TieredMemo)
+    "--memo-dir":      str,    # ... in a file in this directory
+    "--adapt-memo":    None,   # stop memoising rules which never gain
+                               # by it (see adapt_memo())
+    "--gc":            None,   # leave the garbage collector on while
+                               # parsing (see execute())
+    "--no-tokens":     None,   # ignore the grammar's TOKENS (see
+                               # tokenise())
+    "--no-spans":      None,   # run every rule an instruction at a time
+                               # (see spanned())
+    "--bytes":         None,   # read the input as bytes (see "Bytes
+                               # mode" below)
+    "--patterns-from": int,    # use the TOKENS and spans only for
+                               # inputs this long (see make_patterns())
+    "--verify":        None,   # check the program even if it's just as
+                               # metaphor-compiler.py made it (see
+                               # verify())
+}
+LIMIT_EXIT_STATUS = 3
 
 myname = os.path.basename(sys.argv[0])
-if len(sys.argv) == 1:
-    error("Usage: %s <input-file>" % myname)
-INPUT_name = sys.argv[1]
+usage = "Usage: %s [option=value ...] <input-file>\n" % myname + \
+        "Options: " + ", ".join(sorted(OPTIONS))
+
+OPTION_values = {}
+argv = sys.argv[1:]
+while argv and argv[0].startswith("--"):
+    name, _, value = argv.pop(0).partition("=")
+    if name not in OPTIONS:
+        error(usage)
+    if OPTIONS[name] is None:
+        if value:
+            error("Option %s takes no value" % name)
+        OPTION_values[name] = True
+        continue
+    try:
+        OPTION_values[name] = OPTIONS[name](value)
+    except ValueError:
+        error("Bad value for %s: %r" % (name, value))
+if len(argv) != 1:
+    error(usage)
+INPUT_name = argv[0]
+
+MAX_STEPS = OPTION_values.get("--max-steps")
+MAX_SECONDS = OPTION_values.get("--max-seconds")
+MAX_MEMO = OPTION_values.get("--max-memo")
+PROFILE = OPTION_values.get("--profile", False)
+FUSE = OPTION_values.get("--fuse", False)
+INLINE = OPTION_values.get("--inline", False)
+VERIFY = OPTION_values.get("--verify", False)
+COMPACT = OPTION_values.get("--compact", False)
+BYTECODE_name = OPTION_values.get("--bytecode")
+EMIT_BYTECODE_name = OPTION_values.get("--emit-bytecode")
+PARALLEL = OPTION_values.get("--parallel", 0)
+SPLIT_rule = OPTION_values.get("--split-rule")
+SPLIT_at = OPTION_values.get("--split-at")
+if PARALLEL and not (SPLIT_rule and SPLIT_at):
+    error("Option --parallel needs --split-rule and --split-at")
+STREAM_rule = OPTION_values.get("--stream")
+if STREAM_rule and (PARALLEL or EMIT_BYTECODE_name):
+    error("Option --stream can't be used with --parallel or --emit-bytecode")
+MEMO_spill = OPTION_values.get("--memo-spill")
+MEMO_dir = OPTION_values.get("--memo-dir")
+if MEMO_spill is not None and (MEMO_spill < 1 or PARALLEL):
+    error("Option --memo-spill needs a positive value, and no --parallel")
+ADAPT_memo = OPTION_values.get("--adapt-memo", False)
+KEEP_GC = OPTION_values.get("--gc", False)
+# The collector is ours to pause (see pause_collector() in the trailer)
+# if we're the program being run, or if load_library() says so
+GC_owned = __name__ == "__main__"
+NO_TOKENS = OPTION_values.get("--no-tokens", False)
+NO_SPANS = OPTION_values.get("--no-spans", False)
+BYTES = OPTION_values.get("--bytes", False)
+PATTERN_input = OPTION_values.get("--patterns-from", 20000)
+if BYTES and STREAM_rule:
+    error("Options --bytes and --stream can't be used together")
+if ADAPT_memo and STREAM_rule:
+    error("Options --adapt-memo and --stream can't be used together")
+if ADAPT_memo and MEMO_spill:
+    error("Options --adapt-memo and --memo-spill can't be used together")
 
 #--------------------------------------------------------
-# Global variables holding input file contents
+# Global variables holding input file contents, and the state of the
+# parse. start() sets them all up for one input: usually just the one
+# we were given, but see metaphor-prefork.py. If text is given, that's
+# the input, and name just names it (see metaphor_push.py).
+
+NO_VARS = ()
+
+def start(name, text=None):
+    global INPUT, INPUT_file, INPUT_decoder, INPUT_position
+    global GENINT_counter, GEN_numbers
+    global GEN_counted, HWM_position, HWM_rules
+    global CALL_STACK, EXPR_STACK, SWITCH, RETVAL
+    global PC, RULE, VARS_list, OUTPUT_list, RULE_USE_CACHE, MEMO_hits
+    global MEMO_hits_of, UNMEMOISED, MEMO_adapted
+    global TOKEN_kind, LEX_hits, TEXT_spans, SPAN_hits, GC_work
+
+    if text is not None:
+        INPUT = text
+    elif STREAM_rule:
+        # INPUT is just a window on the file, which parse_stream() moves
+        # (read_more() reads its bytes, and decodes them as it would)
+        INPUT_file = sys.stdin if name == "-" else open(name)
+        INPUT_decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(INPUT_file.encoding)(
+                INPUT_file.errors), True)
+        INPUT = ""
+    else:
+        with open(name, "rb" if BYTES else "r") as fin:
+            INPUT = fin.read()
+
+    # Other global variables
 
-with open(INPUT_name) as fin:
-    INPUT = fin.read()
- 
-# Other global variables
+    INPUT_position = 0
+    GENINT_counter = 1
+    GEN_numbers = {}    # label -> its number in the output, as a string
+    GEN_counted = 0     # labels numbered before GEN_numbers was cleared
 
-INPUT_position = 0
-GENINT_counter = 1
+    HWM_position = 0
+    HWM_rules = []
 
-HWM_position = 0
-HWM_rules = []
+    # The stacks' frames are tuples, which CPython keeps free lists of,
+    # so pushing and popping one hardly allocates anything. (We've tried
+    # the other ways: the positions in an array('i') beside a list of
+    # output lists, frames as __slots__ objects reused from call to call,
+    # and a free list of output lists. Each was as slow or slower, by up
+    # to 8% on AEXP and our own grammar, since each takes more Python to
+    # push and pop than a tuple does.)
+    CALL_STACK = [] # return addr, rule-name, vars list
+    EXPR_STACK = [] # input position, output list 
+    SWITCH = False
+    RETVAL = ""
+
+    # These get saved on a function (rule) call
+    PC = None
+    RULE = None
+    VARS_list = NO_VARS
+    OUTPUT_list = []
 
-CALL_STACK = [] # return addr, rule-name, vars dict
-EXPR_STACK = [] # input position, output list 
-SWITCH = False
-RETVAL = ""
+    # The packrat memo (see CALL), and which rules we've given up
+    # memoising (see adapt_memo())
+    RULE_USE_CACHE = {}
+    MEMO_hits = 0
+    MEMO_hits_of = {}
+    UNMEMOISED = set()
+    MEMO_adapted = not ADAPT_memo
 
-# These get saved on a function (rule) call
-PC = None
-RULE = None
-VARS_dict = {}
-OUTPUT_list = []
+    # The rules the lexer has found tokens for (see tokenise()): none yet
+    TOKEN_kind = {}
+    LEX_hits = 0
+
+    # The rules we match all at once (see spanned()): none yet either
+    TEXT_spans = {}
+    SPAN_hits = 0
+
+    # For --profile: the garbage collector's collections, the seconds
+    # they took, and when this one started (see count_collection())
+    GC_work = [0, 0.0, 0.0]
+
+start(INPUT_name)
         
 #--------------------------------------------------------
 # Parsing machine instructions
@@ -65,6 +224,11 @@ def get_char():
     INPUT_position += 1
     return result
 
+def input_text(start, end):
+    # INPUT[start:end] as a string, even with --bytes (for messages)
+    text = INPUT[max(0, start):end]
+    return text if isinstance(text, str) else text.decode("latin-1")
+
 def success():
     global SWITCH, HWM_position, HWM_rules
     SWITCH = True
@@ -133,17 +297,14 @@ def match_char_not_in(candidates):
 # token recognisers in the grammar, rather than built-in to the
 # runtime
 
+# (verify() in the trailer has made sure that x is a string; with
+# --bytes, it's then made into a table: see "Bytes mode" below)
+
 def ANY_OF(x):
-    if isinstance(x, str):
-        match_char_in(x)
-    else:
-        error("Wrong argument " + x + " to ANY_OF")
+    match_char_in(x)
 
 def ANY_BUT(x):
-    if isinstance(x, str):
-        match_char_not_in(x)
-    else:
-        error("Wrong argument " + x + " to ANY_BUT")
+    match_char_not_in(x)
 
 def LITERAL(x):
     CHECKPOINT()
@@ -159,29 +320,79 @@ def LITERAL(x):
 # Be a packrat: 
 # When we use a rule at a particular place in the input, first check 
 # if we've done this before, and if so, return the cached result.
-RULE_USE_CACHE = {}
+# (RULE_USE_CACHE is set up by start().) With --parallel, some of the
+# results were worked out by other processes, and are only SPLICED in
+# when we get to them: see splice() in the trailer. A token rule where
+# the lexer found one of its tokens is as quick: see lexed(). So is a
+# rule which only matches text, which we can match in one go: see
+# spanned().
+
+SPLICED = object()
 
 def CALL(rule):
-    global PC, RULE, OUTPUT_list, VARS_dict
-    global INPUT_position, RETVAL, SWITCH
-    if (INPUT_position, rule) in RULE_USE_CACHE:
-        INPUT_position, RETVAL, SWITCH =  RULE_USE_CACHE[INPUT_position, rule]
+    global PC, RULE, OUTPUT_list, VARS_list
+    global INPUT_position, RETVAL, SWITCH, MEMO_hits
+    key = (INPUT_position, rule)
+    if key in RULE_USE_CACHE:
+        MEMO_hits += 1
+        INPUT_position, RETVAL, SWITCH = RULE_USE_CACHE[key]
+        if RETVAL is SPLICED:
+            splice(key)
+    elif rule in TOKEN_kind and lexed(rule):
+        pass
+    elif rule in TEXT_spans:
+        spanned(rule)
     else:
-        CALL_STACK.append([PC, RULE, VARS_dict])
+        CALL_STACK.append((PC, RULE, VARS_list))
         EXPR_STACK.append((INPUT_position, OUTPUT_list))
-        PC = lookup(rule)
+        PC = LABELS[rule]
         RULE = rule
         OUTPUT_list = []
-        VARS_dict = {}
+        VARS_list = NO_VARS
 
 def R():
-    global PC, RULE, VARS_dict, OUTPUT_list
+    global PC, RULE, VARS_list, OUTPUT_list
     consolidate_OUTPUT_list_to_RETVAL()
     # DON'T restore old INPUT_position ...
     old_posn, OUTPUT_list = EXPR_STACK.pop()  
     # ... but use it to cache our result
     RULE_USE_CACHE[old_posn, RULE] = (INPUT_position, RETVAL, SWITCH)
-    PC, RULE, VARS_dict = CALL_STACK.pop()
+    PC, RULE, VARS_list = CALL_STACK.pop()
+
+# With --adapt-memo, CALL counts each rule's memo hits as well, and CALL
+# and R leave the memo alone for the rules adapt_memo() (in the trailer)
+# has given up on. Without it, they needn't do either.
+
+if ADAPT_memo:
+    def CALL(rule):
+        global PC, RULE, OUTPUT_list, VARS_list
+        global INPUT_position, RETVAL, SWITCH, MEMO_hits
+        key = (INPUT_position, rule)
+        if rule not in UNMEMOISED and key in RULE_USE_CACHE:
+            MEMO_hits += 1
+            MEMO_hits_of[rule] = MEMO_hits_of.get(rule, 0) + 1
+            INPUT_position, RETVAL, SWITCH = RULE_USE_CACHE[key]
+            if RETVAL is SPLICED:
+                splice(key)
+        elif rule in TOKEN_kind and lexed(rule):
+            pass
+        elif rule in TEXT_spans:
+            spanned(rule)
+        else:
+            CALL_STACK.append((PC, RULE, VARS_list))
+            EXPR_STACK.append((INPUT_position, OUTPUT_list))
+            PC = LABELS[rule]
+            RULE = rule
+            OUTPUT_list = []
+            VARS_list = NO_VARS
+
+    def R():
+        global PC, RULE, VARS_list, OUTPUT_list
+        consolidate_OUTPUT_list_to_RETVAL()
+        old_posn, OUTPUT_list = EXPR_STACK.pop()
+        if RULE not in UNMEMOISED:
+            RULE_USE_CACHE[old_posn, RULE] = (INPUT_position, RETVAL, SWITCH)
+        PC, RULE, VARS_list = CALL_STACK.pop()
     
 def SET():
     global RETVAL
@@ -193,17 +404,17 @@ def ADR(label):
 
 def B(label):
     global PC
-    PC = lookup(label)
+    PC = LABELS[label]
 
 def BT(label):
     global PC
     if SWITCH:
-        PC = lookup(label)
+        PC = LABELS[label]
    
 def BF(label):
     global PC
     if not SWITCH:
-        PC = lookup(label)
+        PC = LABELS[label]
         
 def CL(literal):
     OUTPUT_list.append(literal)
@@ -214,10 +425,18 @@ def CI():
 def END():
     PC = None # halt interpreter
 
+# GEN makes a new label, which is just a tuple that nothing else could
+# be equal to: (GEN_source, GENINT_counter), where GEN_source is 0, or
+# which --parallel worker made it. It gets its number when it's first
+# written out (see write_output()), so the numbers don't depend on what
+# was parsed (or thrown away, or found in the memo) before: just on the
+# output, and whichever copies of the label are in it.
+GEN_source = 0
+
 def GEN():
     global GENINT_counter
     global RETVAL
-    RETVAL = str(GENINT_counter)
+    RETVAL = (GEN_source, GENINT_counter)
     GENINT_counter += 1
     success()
 
@@ -254,32 +473,241 @@ def KET():
 def YIELD():
     OUTPUT_list.append(RETVAL)
 
-def STORE(name):
-    VARS_dict[name] = RETVAL
+# A rule's variables are numbered when the program is loaded (see
+# allocate_slots() in the trailer), so STORE and LOAD take a slot number
+# in VARS_list. Most rules never STORE anything, so they all share
+# NO_VARS (which is never changed) until they do.
+
+def STORE(slot):
+    global VARS_list
+    if VARS_list is NO_VARS:
+        VARS_list = [None] * len(SLOT_names[RULE])
+    VARS_list[slot] = RETVAL
 
 def show_place_of_error(message):   
     # This shows where we are NOW
     text = "... " + \
-           INPUT[max(0, INPUT_position - 60):INPUT_position] + "\n" + \
+           input_text(INPUT_position - 60, INPUT_position) + "\n" + \
            "***ERROR: "+ message + "\n***HERE:\n" + \
-               INPUT[INPUT_position:INPUT_position + 60] + " ...\n"
+               input_text(INPUT_position, INPUT_position + 60) + " ...\n"
     # ignore last stackframe
     while len(CALL_STACK) > 1:
         _, rule, _ = CALL_STACK.pop()
         text += "in <" + rule + "> "
     error(text)
 
-def LOAD(name):
+def LOAD(slot):
+    # verify() in the trailer has made sure that it's been stored
     global RETVAL
-    if name in VARS_dict:
-        RETVAL = VARS_dict[name]
-    else:
-        show_place_of_error("INTERNAL ERROR: No such variable: " + name)
+    RETVAL = VARS_list[slot]
 
 # DEBUGGING
 def NOP(what):
     pass
 
+def LEX(*rules):
+    # Not really an instruction: it just records the grammar's TOKENS,
+    # after the last rule, where it's never executed
+    pass
+
+#-------------------------------------------------
+# Superinstructions: each does the work of a common sequence of the
+# instructions above, so the interpreter loop goes round fewer times.
+# They're never in the grammar's output; with --fuse, fuse() in the
+# trailer swaps them in when the program is loaded.
+#
+# A CALL can't be followed by anything in the same instruction, because
+# the rule it calls has to run first. So the ones with CALL come in pairs:
+# if the rule's result was already in RULE_USE_CACHE the first does the
+# whole job and skips the second, and otherwise the rule returns to the
+# second, which finishes off.
+
+def called_from_memo(rule):
+    # CALL, and say whether the rule's result came from the memo
+    resume = PC
+    CALL(rule)
+    return PC == resume
+
+def TOKEN(literal):
+    # CHECKPOINT, CALL '*whitespace*', then as TOKEN_END
+    global PC
+    CHECKPOINT()
+    if called_from_memo("*whitespace*"):
+        PC += 1
+        TOKEN_END(literal)
+
+def TOKEN_END(literal):
+    # BF rollback, LITERAL, BF rollback, COMMIT, B end, rollback: ROLLBACK
+    if SWITCH:
+        LITERAL(literal)
+    if SWITCH:
+        COMMIT()
+    else:
+        ROLLBACK()
+
+def CALL_YIELD_BF(rule, label):
+    global PC
+    if called_from_memo(rule):
+        PC += 1
+        YIELD_BF(label)
+
+def YIELD_BF(label):
+    YIELD()
+    BF(label)
+
+def CALL_STORE_BF(rule, slot, label):
+    global PC
+    if called_from_memo(rule):
+        PC += 1
+        STORE_BF(slot, label)
+
+def STORE_BF(slot, label):
+    STORE(slot)
+    BF(label)
+
+def COMMIT_YIELD_B(label):
+    COMMIT()
+    YIELD()
+    B(label)
+
+def ANY_OF_YIELD_BF(x, label):
+    ANY_OF(x)
+    YIELD_BF(label)
+
+def ANY_BUT_YIELD_BF(x, label):
+    ANY_BUT(x)
+    YIELD_BF(label)
+
+def LITERAL_YIELD_BF(x, label):
+    LITERAL(x)
+    YIELD_BF(label)
+
+def KET_YIELD_BT(label):
+    KET()
+    YIELD()
+    BT(label)
+
+#-------------------------------------------------
+# Inlined rules: with --inline, inline() in the trailer replaces calls
+# of rules which just match one thing, like <digit> ::= ANY_OF '0..9';
+# and runs of alternatives which each match one character, like
+# (<lower> | <upper> | LITERAL '_'). The results are the same as before,
+# except that nothing goes in RULE_USE_CACHE. We still push a frame
+# while "in" the rule, so that the high water mark knows where we were.
+
+def CALL_INLINE(rule, match, x):
+    # CALL a rule which is just "match x" (ANY_OF, ANY_BUT or LITERAL)
+    global RETVAL
+    CALL_STACK.append((PC, RULE, VARS_list))
+    match(x)
+    CALL_STACK.pop()
+    if not SWITCH:
+        RETVAL = ""     # as R would leave it
+
+def CHAR_CLASS(chars, called):
+    # Alternatives which each match one of chars, the first of them
+    # through a CALL_INLINE for each of the called ones. Like those
+    # alternatives, we YIELD the character we match.
+    global RETVAL
+    if have_char() and INPUT[INPUT_position] in chars:
+        got = INPUT[INPUT_position]
+        if got in called:
+            CALL_STACK.append((PC, RULE, VARS_list))
+            match_char_in(got)
+            CALL_STACK.pop()
+        else:
+            match_char_in(got)
+        OUTPUT_list.append(RETVAL)
+    else:
+        failure()
+        if called:
+            RETVAL = ""
+
+#-------------------------------------------------------
+# Bytes mode, for --bytes. For grammars which only deal in ASCII (or
+# Latin-1), INPUT can be the bytes of the file, as they are, rather than
+# decoded into a string: then each byte is a character, and we needn't
+# make a string for each one we look at.
+#
+# These replace the matching instructions above (before the program is
+# made, so it's these which it uses). Once the program is loaded, each
+# string of characters which ANY_OF, ANY_BUT and CHAR_CLASS look for
+# is made into a table of 256 entries, which is true for the bytes in
+# it (see byte_tables() in the trailer), and we look up the byte in
+# that. LITERAL compares the bytes of its string with INPUT in one go.
+# A character we match is still returned as a string (one of CHARS,
+# which are made once), and the output is the same as it would be
+# without --bytes, but written as Latin-1 in one go (see write_bytes()
+# in the trailer). Spans are written just as they are in the input.
+
+if BYTES:
+    CHARS = [chr(byte) for byte in range(256)]
+    ENCODED = {}    # LITERAL's string -> its bytes, if it's Latin-1
+
+    def match_char_in(table):
+        # (which is all that CHECKPOINT, get_char and COMMIT come to)
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and table[INPUT[INPUT_position]]:
+            RETVAL = CHARS[INPUT[INPUT_position]]
+            INPUT_position += 1
+            success()
+        else:
+            failure()
+        return SWITCH
+
+    def match_char_not_in(table):
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and \
+           not table[INPUT[INPUT_position]]:
+            RETVAL = CHARS[INPUT[INPUT_position]]
+            INPUT_position += 1
+            success()
+        else:
+            failure()
+        return SWITCH
+
+    def LITERAL(x):
+        global INPUT_position, RETVAL
+        data = ENCODED.get(x)
+        if data is not None and INPUT.startswith(data, INPUT_position):
+            INPUT_position += len(data)
+            RETVAL = x
+            success()
+            return
+        # It doesn't match, but what it matches of it counts for the
+        # high water mark, and the last character of that is left in
+        # RETVAL, just as though we'd matched a character at a time
+        start = INPUT_position
+        for ch in x:
+            if INPUT_position < len(INPUT) and \
+               CHARS[INPUT[INPUT_position]] == ch:
+                RETVAL = ch
+                INPUT_position += 1
+                success()
+            else:
+                INPUT_position = start
+                failure()
+                return
+
+    def CHAR_CLASS(chars, called):
+        # (called is None if there are none)
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and chars[INPUT[INPUT_position]]:
+            got = INPUT[INPUT_position]
+            inside = called is not None and called[got]
+            if inside:
+                CALL_STACK.append((PC, RULE, VARS_list))
+            RETVAL = CHARS[got]
+            INPUT_position += 1
+            success()
+            if inside:
+                CALL_STACK.pop()
+            OUTPUT_list.append(RETVAL)
+        else:
+            failure()
+            if called is not None:
+                RETVAL = ""
+
 #-------------------------------------------------------
 # The "assembler" instructions go here
 PROGRAM = \
@@ -289,40 +717,43 @@ PROGRAM = \
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L3'),
+    (BF, 'L1'),
     (LITERAL, 'BEGIN'),
-    (BF, 'L3'),
+    (BF, 'L1'),
     (COMMIT,),
-    (B, 'L4'),
-    'L3',
+    (B, 'L2'),
+    'L1',
     (ROLLBACK,),
-    'L4',
-    (BF, 'L1'),
+    'L2',
+    (BF, 'L3'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L5'),
+    (BF, 'L4'),
     (LITERAL, '<'),
-    (BF, 'L5'),
+    (BF, 'L4'),
     (COMMIT,),
-    (B, 'L6'),
-    'L5',
+    (B, 'L5'),
+    'L4',
     (ROLLBACK,),
-    'L6',
-    (BF, 'L1'),
+    'L5',
+    (BF, 'L3'),
     (CALL, 'id'),
     (STORE, 'name'),
-    (BF, 'L1'),
+    (BF, 'L3'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L7'),
+    (BF, 'L6'),
     (LITERAL, '>'),
-    (BF, 'L7'),
+    (BF, 'L6'),
     (COMMIT,),
-    (B, 'L8'),
-    'L7',
+    (B, 'L7'),
+    'L6',
     (ROLLBACK,),
-    'L8',
-    (BF, 'L1'),
+    'L7',
+    (BF, 'L3'),
+    (CALL, 'tokens'),
+    (STORE, 'tokens'),
+    (BF, 'L3'),
     (BRA,),
     (LMI,),
     (CL, '(ADR, \''),
@@ -332,88 +763,193 @@ PROGRAM = \
     (NL,),
     (KET,),
     (YIELD,),
-    'L9',
+    'L8',
     (CALL, 'st'),
     (YIELD,),
-    (BT, 'L9'),
+    (BT, 'L8'),
     (SET,),
-    (BF, 'L1'),
+    (BF, 'L3'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L10'),
+    (BF, 'L9'),
     (LITERAL, 'END'),
-    (BF, 'L10'),
+    (BF, 'L9'),
     (COMMIT,),
-    (B, 'L11'),
-    'L10',
+    (B, 'L10'),
+    'L9',
     (ROLLBACK,),
-    'L11',
-    (BF, 'L1'),
+    'L10',
+    (BF, 'L3'),
     (BRA,),
+    (LOAD, 'tokens'),
+    (YIELD,),
     (CL, '(END,),'),
     (NL,),
     (KET,),
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L2'),
-    'L1',
+    (B, 'L11'),
+    'L3',
     (ROLLBACK,),
-    'L2',
+    'L11',
     'L12',
     (R,),
-    'st',
+    'tokens',
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L15'),
-    (LITERAL, '<'),
-    (BF, 'L15'),
+    (BF, 'L13'),
+    (LITERAL, 'TOKENS'),
+    (BF, 'L13'),
     (COMMIT,),
-    (B, 'L16'),
-    'L15',
+    (B, 'L14'),
+    'L13',
     (ROLLBACK,),
+    'L14',
+    (BF, 'L15'),
+    (BRA,),
+    (CL, '(LEX'),
+    (KET,),
+    (YIELD,),
+    (CALL, 'token'),
+    (YIELD,),
+    (BF, 'L15'),
     'L16',
-    (BF, 'L13'),
-    (CALL, 'ruleid'),
-    (STORE, 'rule'),
-    (BF, 'L13'),
+    (CALL, 'token'),
+    (YIELD,),
+    (BT, 'L16'),
+    (SET,),
+    (BF, 'L15'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (BF, 'L17'),
-    (LITERAL, '>'),
+    (LITERAL, ';'),
     (BF, 'L17'),
     (COMMIT,),
     (B, 'L18'),
     'L17',
     (ROLLBACK,),
     'L18',
-    (BF, 'L13'),
+    (BF, 'L15'),
+    (BRA,),
+    (CL, '),'),
+    (NL,),
+    (KET,),
+    (YIELD,),
+    (COMMIT,),
+    (YIELD,),
+    (B, 'L19'),
+    'L15',
+    (ROLLBACK,),
+    'L19',
+    (BT, 'L20'),
+    (CHECKPOINT,),
+    (SET,),
+    (YIELD,),
+    (BF, 'L21'),
+    (COMMIT,),
+    (YIELD,),
+    (B, 'L22'),
+    'L21',
+    (ROLLBACK,),
+    'L22',
+    'L20',
+    (R,),
+    'token',
+    (CHECKPOINT,),
+    (CHECKPOINT,),
+    (CALL, '*whitespace*'),
+    (BF, 'L23'),
+    (LITERAL, '<'),
+    (BF, 'L23'),
+    (COMMIT,),
+    (B, 'L24'),
+    'L23',
+    (ROLLBACK,),
+    'L24',
+    (BF, 'L25'),
+    (CALL, 'ruleid'),
+    (STORE, 'rule'),
+    (BF, 'L25'),
+    (CHECKPOINT,),
+    (CALL, '*whitespace*'),
+    (BF, 'L26'),
+    (LITERAL, '>'),
+    (BF, 'L26'),
+    (COMMIT,),
+    (B, 'L27'),
+    'L26',
+    (ROLLBACK,),
+    'L27',
+    (BF, 'L25'),
+    (BRA,),
+    (CL, ', \''),
+    (LOAD, 'rule'),
+    (YIELD,),
+    (CL, '\''),
+    (KET,),
+    (YIELD,),
+    (COMMIT,),
+    (YIELD,),
+    (B, 'L28'),
+    'L25',
+    (ROLLBACK,),
+    'L28',
+    'L29',
+    (R,),
+    'st',
+    (CHECKPOINT,),
+    (CHECKPOINT,),
+    (CALL, '*whitespace*'),
+    (BF, 'L30'),
+    (LITERAL, '<'),
+    (BF, 'L30'),
+    (COMMIT,),
+    (B, 'L31'),
+    'L30',
+    (ROLLBACK,),
+    'L31',
+    (BF, 'L32'),
+    (CALL, 'ruleid'),
+    (STORE, 'rule'),
+    (BF, 'L32'),
+    (CHECKPOINT,),
+    (CALL, '*whitespace*'),
+    (BF, 'L33'),
+    (LITERAL, '>'),
+    (BF, 'L33'),
+    (COMMIT,),
+    (B, 'L34'),
+    'L33',
+    (ROLLBACK,),
+    'L34',
+    (BF, 'L32'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L19'),
+    (BF, 'L35'),
     (LITERAL, '::='),
-    (BF, 'L19'),
+    (BF, 'L35'),
     (COMMIT,),
-    (B, 'L20'),
-    'L19',
+    (B, 'L36'),
+    'L35',
     (ROLLBACK,),
-    'L20',
-    (BF, 'L13'),
+    'L36',
+    (BF, 'L32'),
     (CALL, 'ex1'),
     (STORE, 'body'),
-    (BF, 'L13'),
+    (BF, 'L32'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L21'),
+    (BF, 'L37'),
     (LITERAL, ';'),
-    (BF, 'L21'),
+    (BF, 'L37'),
     (COMMIT,),
-    (B, 'L22'),
-    'L21',
+    (B, 'L38'),
+    'L37',
     (ROLLBACK,),
-    'L22',
-    (BF, 'L13'),
+    'L38',
+    (BF, 'L32'),
     (BRA,),
     (CL, '\''),
     (LOAD, 'rule'),
@@ -428,17 +964,17 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L14'),
-    'L13',
+    (B, 'L39'),
+    'L32',
     (ROLLBACK,),
-    'L14',
-    'L23',
+    'L39',
+    'L40',
     (R,),
     'ex1',
     (CHECKPOINT,),
     (CALL, 'ex2'),
     (YIELD,),
-    (BF, 'L24'),
+    (BF, 'L41'),
     (BRA,),
     (CL, '\'L'),
     (GEN,),
@@ -446,20 +982,20 @@ PROGRAM = \
     (CL, '\''),
     (KET,),
     (STORE, 'label'),
-    'L26',
+    'L42',
     (BRA,),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L29'),
+    (BF, 'L43'),
     (LITERAL, '|'),
-    (BF, 'L29'),
+    (BF, 'L43'),
     (COMMIT,),
-    (B, 'L30'),
-    'L29',
+    (B, 'L44'),
+    'L43',
     (ROLLBACK,),
-    'L30',
-    (BF, 'L27'),
+    'L44',
+    (BF, 'L45'),
     (BRA,),
     (CL, '(BT, '),
     (LOAD, 'label'),
@@ -470,19 +1006,19 @@ PROGRAM = \
     (YIELD,),
     (CALL, 'ex2'),
     (YIELD,),
-    (BF, 'L27'),
+    (BF, 'L45'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L28'),
-    'L27',
+    (B, 'L46'),
+    'L45',
     (ROLLBACK,),
-    'L28',
-    'L31',
+    'L46',
+    'L47',
     (KET,),
     (YIELD,),
-    (BT, 'L26'),
+    (BT, 'L42'),
     (SET,),
-    (BF, 'L24'),
+    (BF, 'L41'),
     (BRA,),
     (LOAD, 'label'),
     (YIELD,),
@@ -492,11 +1028,11 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L25'),
-    'L24',
+    (B, 'L48'),
+    'L41',
     (ROLLBACK,),
-    'L25',
-    'L32',
+    'L48',
+    'L49',
     (R,),
     'ex2',
     (CHECKPOINT,),
@@ -523,7 +1059,7 @@ PROGRAM = \
     (CHECKPOINT,),
     (CALL, 'ex3'),
     (YIELD,),
-    (BF, 'L35'),
+    (BF, 'L50'),
     (BRA,),
     (CL, '(BF, '),
     (LOAD, 'rollback'),
@@ -534,31 +1070,31 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L36'),
-    'L35',
+    (B, 'L51'),
+    'L50',
     (ROLLBACK,),
-    'L36',
-    (BT, 'L37'),
+    'L51',
+    (BT, 'L52'),
     (CHECKPOINT,),
     (CALL, 'output'),
     (YIELD,),
-    (BF, 'L38'),
+    (BF, 'L53'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L39'),
-    'L38',
+    (B, 'L54'),
+    'L53',
     (ROLLBACK,),
-    'L39',
-    'L37',
+    'L54',
+    'L52',
     (KET,),
     (YIELD,),
-    (BF, 'L33'),
-    'L40',
+    (BF, 'L55'),
+    'L56',
     (BRA,),
     (CHECKPOINT,),
     (CALL, 'ex3'),
     (YIELD,),
-    (BF, 'L41'),
+    (BF, 'L57'),
     (BRA,),
     (CL, '(BF, '),
     (LOAD, 'rollback'),
@@ -569,27 +1105,27 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L42'),
-    'L41',
+    (B, 'L58'),
+    'L57',
     (ROLLBACK,),
-    'L42',
-    (BT, 'L43'),
+    'L58',
+    (BT, 'L59'),
     (CHECKPOINT,),
     (CALL, 'output'),
     (YIELD,),
-    (BF, 'L44'),
+    (BF, 'L60'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L45'),
-    'L44',
+    (B, 'L61'),
+    'L60',
     (ROLLBACK,),
-    'L45',
-    'L43',
+    'L61',
+    'L59',
     (KET,),
     (YIELD,),
-    (BT, 'L40'),
+    (BT, 'L56'),
     (SET,),
-    (BF, 'L33'),
+    (BF, 'L55'),
     (BRA,),
     (CL, '(COMMIT,),'),
     (NL,),
@@ -614,44 +1150,44 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L34'),
-    'L33',
+    (B, 'L62'),
+    'L55',
     (ROLLBACK,),
-    'L34',
-    'L46',
+    'L62',
+    'L63',
     (R,),
     'ex3',
     (CHECKPOINT,),
     (CALL, 'quoted_symbol'),
     (YIELD,),
-    (BF, 'L47'),
+    (BF, 'L64'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L48'),
-    'L47',
+    (B, 'L65'),
+    'L64',
     (ROLLBACK,),
-    'L48',
-    (BT, 'L49'),
+    'L65',
+    (BT, 'L66'),
     (CHECKPOINT,),
     (CALL, 'ex3yield'),
     (YIELD,),
-    (BF, 'L50'),
+    (BF, 'L67'),
     (BRA,),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L54'),
+    (BF, 'L68'),
     (LITERAL, ':'),
-    (BF, 'L54'),
+    (BF, 'L68'),
     (COMMIT,),
-    (B, 'L55'),
-    'L54',
+    (B, 'L69'),
+    'L68',
     (ROLLBACK,),
-    'L55',
-    (BF, 'L52'),
+    'L69',
+    (BF, 'L70'),
     (CALL, 'id'),
     (STORE, 'id'),
-    (BF, 'L52'),
+    (BF, 'L70'),
     (BRA,),
     (CL, '(STORE, \''),
     (LOAD, 'id'),
@@ -662,15 +1198,15 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L53'),
-    'L52',
+    (B, 'L71'),
+    'L70',
     (ROLLBACK,),
-    'L53',
-    (BT, 'L56'),
+    'L71',
+    (BT, 'L72'),
     (CHECKPOINT,),
     (SET,),
     (YIELD,),
-    (BF, 'L57'),
+    (BF, 'L73'),
     (BRA,),
     (CL, '(YIELD,),'),
     (NL,),
@@ -678,33 +1214,33 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L58'),
-    'L57',
+    (B, 'L74'),
+    'L73',
     (ROLLBACK,),
-    'L58',
-    'L56',
+    'L74',
+    'L72',
     (KET,),
     (YIELD,),
-    (BF, 'L50'),
+    (BF, 'L67'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L51'),
-    'L50',
+    (B, 'L75'),
+    'L67',
     (ROLLBACK,),
-    'L51',
-    (BT, 'L49'),
+    'L75',
+    (BT, 'L66'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L61'),
+    (BF, 'L76'),
     (LITERAL, 'REPEAT'),
-    (BF, 'L61'),
+    (BF, 'L76'),
     (COMMIT,),
-    (B, 'L62'),
-    'L61',
+    (B, 'L77'),
+    'L76',
     (ROLLBACK,),
-    'L62',
-    (BF, 'L59'),
+    'L77',
+    (BF, 'L78'),
     (BRA,),
     (CL, '\'L'),
     (GEN,),
@@ -721,7 +1257,7 @@ PROGRAM = \
     (YIELD,),
     (CALL, 'ex3'),
     (YIELD,),
-    (BF, 'L59'),
+    (BF, 'L78'),
     (BRA,),
     (CL, '(BT, '),
     (LOAD, 'label'),
@@ -734,17 +1270,17 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L60'),
-    'L59',
+    (B, 'L79'),
+    'L78',
     (ROLLBACK,),
-    'L60',
-    'L49',
+    'L79',
+    'L66',
     (R,),
     'quoted_symbol',
     (CHECKPOINT,),
     (CALL, 'string'),
     (STORE, 's'),
-    (BF, 'L63'),
+    (BF, 'L80'),
     (BRA,),
     (CL, '\'L'),
     (GEN,),
@@ -800,28 +1336,28 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L64'),
-    'L63',
+    (B, 'L81'),
+    'L80',
     (ROLLBACK,),
-    'L64',
-    'L65',
+    'L81',
+    'L82',
     (R,),
     'ex3yield',
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L68'),
+    (BF, 'L83'),
     (LITERAL, 'ANY_OF'),
-    (BF, 'L68'),
+    (BF, 'L83'),
     (COMMIT,),
-    (B, 'L69'),
-    'L68',
+    (B, 'L84'),
+    'L83',
     (ROLLBACK,),
-    'L69',
-    (BF, 'L66'),
+    'L84',
+    (BF, 'L85'),
     (CALL, 'string'),
     (STORE, 's'),
-    (BF, 'L66'),
+    (BF, 'L85'),
     (BRA,),
     (CL, '(ANY_OF, '),
     (LOAD, 's'),
@@ -832,26 +1368,26 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L67'),
-    'L66',
+    (B, 'L86'),
+    'L85',
     (ROLLBACK,),
-    'L67',
-    (BT, 'L70'),
+    'L86',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L73'),
+    (BF, 'L88'),
     (LITERAL, 'ANY_BUT'),
-    (BF, 'L73'),
+    (BF, 'L88'),
     (COMMIT,),
-    (B, 'L74'),
-    'L73',
+    (B, 'L89'),
+    'L88',
     (ROLLBACK,),
-    'L74',
-    (BF, 'L71'),
+    'L89',
+    (BF, 'L90'),
     (CALL, 'string'),
     (STORE, 's'),
-    (BF, 'L71'),
+    (BF, 'L90'),
     (BRA,),
     (CL, '(ANY_BUT, '),
     (LOAD, 's'),
@@ -862,26 +1398,26 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L72'),
-    'L71',
+    (B, 'L91'),
+    'L90',
     (ROLLBACK,),
-    'L72',
-    (BT, 'L70'),
+    'L91',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L77'),
+    (BF, 'L92'),
     (LITERAL, 'LITERAL'),
-    (BF, 'L77'),
+    (BF, 'L92'),
     (COMMIT,),
-    (B, 'L78'),
-    'L77',
+    (B, 'L93'),
+    'L92',
     (ROLLBACK,),
-    'L78',
-    (BF, 'L75'),
+    'L93',
+    (BF, 'L94'),
     (CALL, 'string'),
     (STORE, 's'),
-    (BF, 'L75'),
+    (BF, 'L94'),
     (BRA,),
     (CL, '(LITERAL, '),
     (LOAD, 's'),
@@ -892,23 +1428,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L76'),
-    'L75',
+    (B, 'L95'),
+    'L94',
     (ROLLBACK,),
-    'L76',
-    (BT, 'L70'),
+    'L95',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L81'),
+    (BF, 'L96'),
     (LITERAL, 'GEN'),
-    (BF, 'L81'),
+    (BF, 'L96'),
     (COMMIT,),
-    (B, 'L82'),
-    'L81',
+    (B, 'L97'),
+    'L96',
     (ROLLBACK,),
-    'L82',
-    (BF, 'L79'),
+    'L97',
+    (BF, 'L98'),
     (BRA,),
     (CL, '(GEN,),'),
     (NL,),
@@ -916,23 +1452,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L80'),
-    'L79',
+    (B, 'L99'),
+    'L98',
     (ROLLBACK,),
-    'L80',
-    (BT, 'L70'),
+    'L99',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L85'),
+    (BF, 'L100'),
     (LITERAL, 'EMPTY'),
-    (BF, 'L85'),
+    (BF, 'L100'),
     (COMMIT,),
-    (B, 'L86'),
-    'L85',
+    (B, 'L101'),
+    'L100',
     (ROLLBACK,),
-    'L86',
-    (BF, 'L83'),
+    'L101',
+    (BF, 'L102'),
     (BRA,),
     (CL, '(SET,),'),
     (NL,),
@@ -940,37 +1476,37 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L84'),
-    'L83',
+    (B, 'L103'),
+    'L102',
     (ROLLBACK,),
-    'L84',
-    (BT, 'L70'),
+    'L103',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L89'),
+    (BF, 'L104'),
     (LITERAL, '<'),
-    (BF, 'L89'),
+    (BF, 'L104'),
     (COMMIT,),
-    (B, 'L90'),
-    'L89',
+    (B, 'L105'),
+    'L104',
     (ROLLBACK,),
-    'L90',
-    (BF, 'L87'),
+    'L105',
+    (BF, 'L106'),
     (CALL, 'ruleid'),
     (STORE, 'rule'),
-    (BF, 'L87'),
+    (BF, 'L106'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L91'),
+    (BF, 'L107'),
     (LITERAL, '>'),
-    (BF, 'L91'),
+    (BF, 'L107'),
     (COMMIT,),
-    (B, 'L92'),
-    'L91',
+    (B, 'L108'),
+    'L107',
     (ROLLBACK,),
-    'L92',
-    (BF, 'L87'),
+    'L108',
+    (BF, 'L106'),
     (BRA,),
     (CL, '(CALL, \''),
     (LOAD, 'rule'),
@@ -981,37 +1517,37 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L88'),
-    'L87',
+    (B, 'L109'),
+    'L106',
     (ROLLBACK,),
-    'L88',
-    (BT, 'L70'),
+    'L109',
+    (BT, 'L87'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L95'),
+    (BF, 'L110'),
     (LITERAL, '('),
-    (BF, 'L95'),
+    (BF, 'L110'),
     (COMMIT,),
-    (B, 'L96'),
-    'L95',
+    (B, 'L111'),
+    'L110',
     (ROLLBACK,),
-    'L96',
-    (BF, 'L93'),
+    'L111',
+    (BF, 'L112'),
     (CALL, 'ex1'),
     (STORE, 'e'),
-    (BF, 'L93'),
+    (BF, 'L112'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L97'),
+    (BF, 'L113'),
     (LITERAL, ')'),
-    (BF, 'L97'),
+    (BF, 'L113'),
     (COMMIT,),
-    (B, 'L98'),
-    'L97',
+    (B, 'L114'),
+    'L113',
     (ROLLBACK,),
-    'L98',
-    (BF, 'L93'),
+    'L114',
+    (BF, 'L112'),
     (BRA,),
     (CL, '(BRA,),'),
     (NL,),
@@ -1023,39 +1559,39 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L94'),
-    'L93',
+    (B, 'L115'),
+    'L112',
     (ROLLBACK,),
-    'L94',
-    'L70',
+    'L115',
+    'L87',
     (R,),
     'output',
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L101'),
+    (BF, 'L116'),
     (LITERAL, '{'),
-    (BF, 'L101'),
+    (BF, 'L116'),
     (COMMIT,),
-    (B, 'L102'),
-    'L101',
+    (B, 'L117'),
+    'L116',
     (ROLLBACK,),
-    'L102',
-    (BF, 'L99'),
+    'L117',
+    (BF, 'L118'),
     (CALL, 'outlist'),
     (STORE, 'e'),
-    (BF, 'L99'),
+    (BF, 'L118'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L103'),
+    (BF, 'L119'),
     (LITERAL, '}'),
-    (BF, 'L103'),
+    (BF, 'L119'),
     (COMMIT,),
-    (B, 'L104'),
-    'L103',
+    (B, 'L120'),
+    'L119',
     (ROLLBACK,),
-    'L104',
-    (BF, 'L99'),
+    'L120',
+    (BF, 'L118'),
     (BRA,),
     (CL, '(BRA,),'),
     (NL,),
@@ -1069,18 +1605,18 @@ PROGRAM = \
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L107'),
+    (BF, 'L121'),
     (LITERAL, ':'),
-    (BF, 'L107'),
+    (BF, 'L121'),
     (COMMIT,),
-    (B, 'L108'),
-    'L107',
+    (B, 'L122'),
+    'L121',
     (ROLLBACK,),
-    'L108',
-    (BF, 'L105'),
+    'L122',
+    (BF, 'L123'),
     (CALL, 'id'),
     (STORE, 'id'),
-    (BF, 'L105'),
+    (BF, 'L123'),
     (BRA,),
     (CL, '(STORE, \''),
     (LOAD, 'id'),
@@ -1091,15 +1627,15 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L106'),
-    'L105',
+    (B, 'L124'),
+    'L123',
     (ROLLBACK,),
-    'L106',
-    (BT, 'L109'),
+    'L124',
+    (BT, 'L125'),
     (CHECKPOINT,),
     (SET,),
     (YIELD,),
-    (BF, 'L110'),
+    (BF, 'L126'),
     (BRA,),
     (CL, '(YIELD,),'),
     (NL,),
@@ -1107,43 +1643,43 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L111'),
-    'L110',
+    (B, 'L127'),
+    'L126',
     (ROLLBACK,),
-    'L111',
-    'L109',
+    'L127',
+    'L125',
     (KET,),
     (YIELD,),
-    (BF, 'L99'),
+    (BF, 'L118'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L100'),
-    'L99',
+    (B, 'L128'),
+    'L118',
     (ROLLBACK,),
-    'L100',
-    'L112',
+    'L128',
+    'L129',
     (R,),
     'outlist',
     (CHECKPOINT,),
-    'L115',
+    'L130',
     (CALL, 'out1'),
     (YIELD,),
-    (BT, 'L115'),
+    (BT, 'L130'),
     (SET,),
-    (BF, 'L113'),
+    (BF, 'L131'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L114'),
-    'L113',
+    (B, 'L132'),
+    'L131',
     (ROLLBACK,),
-    'L114',
-    'L116',
+    'L132',
+    'L133',
     (R,),
     'out1',
     (CHECKPOINT,),
     (CALL, 'string'),
     (STORE, 's'),
-    (BF, 'L117'),
+    (BF, 'L134'),
     (BRA,),
     (CL, '(CL, '),
     (LOAD, 's'),
@@ -1154,23 +1690,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L118'),
-    'L117',
+    (B, 'L135'),
+    'L134',
     (ROLLBACK,),
-    'L118',
-    (BT, 'L119'),
+    'L135',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L122'),
+    (BF, 'L137'),
     (LITERAL, 'NL'),
-    (BF, 'L122'),
+    (BF, 'L137'),
     (COMMIT,),
-    (B, 'L123'),
-    'L122',
+    (B, 'L138'),
+    'L137',
     (ROLLBACK,),
-    'L123',
-    (BF, 'L120'),
+    'L138',
+    (BF, 'L139'),
     (BRA,),
     (CL, '(NL,),'),
     (NL,),
@@ -1178,23 +1714,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L121'),
-    'L120',
+    (B, 'L140'),
+    'L139',
     (ROLLBACK,),
-    'L121',
-    (BT, 'L119'),
+    'L140',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L126'),
+    (BF, 'L141'),
     (LITERAL, 'TAB'),
-    (BF, 'L126'),
+    (BF, 'L141'),
     (COMMIT,),
-    (B, 'L127'),
-    'L126',
+    (B, 'L142'),
+    'L141',
     (ROLLBACK,),
-    'L127',
-    (BF, 'L124'),
+    'L142',
+    (BF, 'L143'),
     (BRA,),
     (CL, '(TB,),'),
     (NL,),
@@ -1202,23 +1738,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L125'),
-    'L124',
+    (B, 'L144'),
+    'L143',
     (ROLLBACK,),
-    'L125',
-    (BT, 'L119'),
+    'L144',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L130'),
+    (BF, 'L145'),
     (LITERAL, 'INDENT'),
-    (BF, 'L130'),
+    (BF, 'L145'),
     (COMMIT,),
-    (B, 'L131'),
-    'L130',
+    (B, 'L146'),
+    'L145',
     (ROLLBACK,),
-    'L131',
-    (BF, 'L128'),
+    'L146',
+    (BF, 'L147'),
     (BRA,),
     (CL, '(LMI,),'),
     (NL,),
@@ -1226,23 +1762,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L129'),
-    'L128',
+    (B, 'L148'),
+    'L147',
     (ROLLBACK,),
-    'L129',
-    (BT, 'L119'),
+    'L148',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L134'),
+    (BF, 'L149'),
     (LITERAL, 'OUTDENT'),
-    (BF, 'L134'),
+    (BF, 'L149'),
     (COMMIT,),
-    (B, 'L135'),
-    'L134',
+    (B, 'L150'),
+    'L149',
     (ROLLBACK,),
-    'L135',
-    (BF, 'L132'),
+    'L150',
+    (BF, 'L151'),
     (BRA,),
     (CL, '(LMD,),'),
     (NL,),
@@ -1250,23 +1786,23 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L133'),
-    'L132',
+    (B, 'L152'),
+    'L151',
     (ROLLBACK,),
-    'L133',
-    (BT, 'L119'),
+    'L152',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
-    (BF, 'L138'),
+    (BF, 'L153'),
     (LITERAL, 'GEN'),
-    (BF, 'L138'),
+    (BF, 'L153'),
     (COMMIT,),
-    (B, 'L139'),
-    'L138',
+    (B, 'L154'),
+    'L153',
     (ROLLBACK,),
-    'L139',
-    (BF, 'L136'),
+    'L154',
+    (BF, 'L155'),
     (BRA,),
     (CL, '(GEN,),'),
     (NL,),
@@ -1276,15 +1812,15 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L137'),
-    'L136',
+    (B, 'L156'),
+    'L155',
     (ROLLBACK,),
-    'L137',
-    (BT, 'L119'),
+    'L156',
+    (BT, 'L136'),
     (CHECKPOINT,),
     (CALL, 'id'),
     (STORE, 'id'),
-    (BF, 'L140'),
+    (BF, 'L157'),
     (BRA,),
     (CL, '(LOAD, \''),
     (LOAD, 'id'),
@@ -1297,427 +1833,427 @@ PROGRAM = \
     (YIELD,),
     (COMMIT,),
     (YIELD,),
-    (B, 'L141'),
-    'L140',
+    (B, 'L158'),
+    'L157',
     (ROLLBACK,),
-    'L141',
-    'L119',
+    'L158',
+    'L136',
     (R,),
     'ruleid',
     (CHECKPOINT,),
     (CALL, 'id'),
     (YIELD,),
-    (BF, 'L142'),
+    (BF, 'L159'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L143'),
-    'L142',
+    (B, 'L160'),
+    'L159',
     (ROLLBACK,),
-    'L143',
-    (BT, 'L144'),
+    'L160',
+    (BT, 'L161'),
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L145'),
+    (BF, 'L162'),
     (LITERAL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L145'),
+    (BF, 'L162'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L146'),
-    'L145',
+    (B, 'L163'),
+    'L162',
     (ROLLBACK,),
-    'L146',
-    'L144',
+    'L163',
+    'L161',
     (R,),
     'lower',
     (CHECKPOINT,),
     (ANY_OF, 'abcdefghijklmnopqrstuvwxyz'),
     (YIELD,),
-    (BF, 'L147'),
+    (BF, 'L164'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L148'),
-    'L147',
+    (B, 'L165'),
+    'L164',
     (ROLLBACK,),
-    'L148',
-    'L149',
+    'L165',
+    'L166',
     (R,),
     'upper',
     (CHECKPOINT,),
     (ANY_OF, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
     (YIELD,),
-    (BF, 'L150'),
+    (BF, 'L167'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L151'),
-    'L150',
+    (B, 'L168'),
+    'L167',
     (ROLLBACK,),
-    'L151',
-    'L152',
+    'L168',
+    'L169',
     (R,),
     'digit',
     (CHECKPOINT,),
     (ANY_OF, '0123456789'),
     (YIELD,),
-    (BF, 'L153'),
+    (BF, 'L170'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L154'),
-    'L153',
+    (B, 'L171'),
+    'L170',
     (ROLLBACK,),
-    'L154',
-    'L155',
+    'L171',
+    'L172',
     (R,),
     'id',
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L156'),
+    (BF, 'L173'),
     (BRA,),
     (CHECKPOINT,),
     (CALL, 'lower'),
     (YIELD,),
-    (BF, 'L158'),
+    (BF, 'L174'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L159'),
-    'L158',
+    (B, 'L175'),
+    'L174',
     (ROLLBACK,),
-    'L159',
-    (BT, 'L160'),
+    'L175',
+    (BT, 'L176'),
     (CHECKPOINT,),
     (CALL, 'upper'),
     (YIELD,),
-    (BF, 'L161'),
+    (BF, 'L177'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L162'),
-    'L161',
+    (B, 'L178'),
+    'L177',
     (ROLLBACK,),
-    'L162',
-    (BT, 'L160'),
+    'L178',
+    (BT, 'L176'),
     (CHECKPOINT,),
     (LITERAL, '_'),
     (YIELD,),
-    (BF, 'L163'),
+    (BF, 'L179'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L164'),
-    'L163',
+    (B, 'L180'),
+    'L179',
     (ROLLBACK,),
-    'L164',
-    'L160',
+    'L180',
+    'L176',
     (KET,),
     (YIELD,),
-    (BF, 'L156'),
-    'L165',
+    (BF, 'L173'),
+    'L181',
     (BRA,),
     (CHECKPOINT,),
     (CALL, 'lower'),
     (YIELD,),
-    (BF, 'L166'),
+    (BF, 'L182'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L167'),
-    'L166',
+    (B, 'L183'),
+    'L182',
     (ROLLBACK,),
-    'L167',
-    (BT, 'L168'),
+    'L183',
+    (BT, 'L184'),
     (CHECKPOINT,),
     (CALL, 'upper'),
     (YIELD,),
-    (BF, 'L169'),
+    (BF, 'L185'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L170'),
-    'L169',
+    (B, 'L186'),
+    'L185',
     (ROLLBACK,),
-    'L170',
-    (BT, 'L168'),
+    'L186',
+    (BT, 'L184'),
     (CHECKPOINT,),
     (LITERAL, '_'),
     (YIELD,),
-    (BF, 'L171'),
+    (BF, 'L187'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L172'),
-    'L171',
+    (B, 'L188'),
+    'L187',
     (ROLLBACK,),
-    'L172',
-    (BT, 'L168'),
+    'L188',
+    (BT, 'L184'),
     (CHECKPOINT,),
     (CALL, 'digit'),
     (YIELD,),
-    (BF, 'L173'),
+    (BF, 'L189'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L174'),
-    'L173',
+    (B, 'L190'),
+    'L189',
     (ROLLBACK,),
-    'L174',
-    'L168',
+    'L190',
+    'L184',
     (KET,),
     (YIELD,),
-    (BT, 'L165'),
+    (BT, 'L181'),
     (SET,),
-    (BF, 'L156'),
+    (BF, 'L173'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L157'),
-    'L156',
+    (B, 'L191'),
+    'L173',
     (ROLLBACK,),
-    'L157',
-    'L175',
+    'L191',
+    'L192',
     (R,),
     'number',
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L176'),
+    (BF, 'L193'),
     (CALL, 'digit'),
     (YIELD,),
-    (BF, 'L176'),
-    'L178',
+    (BF, 'L193'),
+    'L194',
     (CALL, 'digit'),
     (YIELD,),
-    (BT, 'L178'),
+    (BT, 'L194'),
     (SET,),
-    (BF, 'L176'),
+    (BF, 'L193'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L177'),
-    'L176',
+    (B, 'L195'),
+    'L193',
     (ROLLBACK,),
-    'L177',
-    'L179',
+    'L195',
+    'L196',
     (R,),
     'hex_digit',
     (CHECKPOINT,),
     (CALL, 'digit'),
     (YIELD,),
-    (BF, 'L180'),
+    (BF, 'L197'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L181'),
-    'L180',
+    (B, 'L198'),
+    'L197',
     (ROLLBACK,),
-    'L181',
-    (BT, 'L182'),
+    'L198',
+    (BT, 'L199'),
     (CHECKPOINT,),
     (ANY_OF, 'abcdefABCDEF'),
     (YIELD,),
-    (BF, 'L183'),
+    (BF, 'L200'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L184'),
-    'L183',
+    (B, 'L201'),
+    'L200',
     (ROLLBACK,),
-    'L184',
-    'L182',
+    'L201',
+    'L199',
     (R,),
     'hex',
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L185'),
+    (BF, 'L202'),
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BF, 'L185'),
-    'L187',
+    (BF, 'L202'),
+    'L203',
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BT, 'L187'),
+    (BT, 'L203'),
     (SET,),
-    (BF, 'L185'),
+    (BF, 'L202'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L186'),
-    'L185',
+    (B, 'L204'),
+    'L202',
     (ROLLBACK,),
-    'L186',
-    'L188',
+    'L204',
+    'L205',
     (R,),
     'string_escape',
     (CHECKPOINT,),
     (LITERAL, '\\'),
     (YIELD,),
-    (BF, 'L189'),
+    (BF, 'L206'),
     (BRA,),
     (CHECKPOINT,),
     (ANY_OF, '\\\'\"abfnrtv0'),
     (YIELD,),
-    (BF, 'L191'),
+    (BF, 'L207'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L192'),
-    'L191',
+    (B, 'L208'),
+    'L207',
     (ROLLBACK,),
-    'L192',
-    (BT, 'L193'),
+    'L208',
+    (BT, 'L209'),
     (CHECKPOINT,),
     (LITERAL, 'u'),
     (YIELD,),
-    (BF, 'L194'),
+    (BF, 'L210'),
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BF, 'L194'),
+    (BF, 'L210'),
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BF, 'L194'),
+    (BF, 'L210'),
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BF, 'L194'),
+    (BF, 'L210'),
     (CALL, 'hex_digit'),
     (YIELD,),
-    (BF, 'L194'),
+    (BF, 'L210'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L195'),
-    'L194',
+    (B, 'L211'),
+    'L210',
     (ROLLBACK,),
-    'L195',
-    'L193',
+    'L211',
+    'L209',
     (KET,),
     (YIELD,),
-    (BF, 'L189'),
+    (BF, 'L206'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L190'),
-    'L189',
+    (B, 'L212'),
+    'L206',
     (ROLLBACK,),
-    'L190',
-    'L196',
+    'L212',
+    'L213',
     (R,),
     'string',
     (CHECKPOINT,),
     (CALL, '*whitespace*'),
     (YIELD,),
-    (BF, 'L197'),
+    (BF, 'L214'),
     (LITERAL, '\''),
     (YIELD,),
-    (BF, 'L197'),
-    'L199',
+    (BF, 'L214'),
+    'L215',
     (BRA,),
     (CHECKPOINT,),
     (CALL, 'string_escape'),
     (YIELD,),
-    (BF, 'L200'),
+    (BF, 'L216'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L201'),
-    'L200',
+    (B, 'L217'),
+    'L216',
     (ROLLBACK,),
-    'L201',
-    (BT, 'L202'),
+    'L217',
+    (BT, 'L218'),
     (CHECKPOINT,),
     (ANY_BUT, '\''),
     (YIELD,),
-    (BF, 'L203'),
+    (BF, 'L219'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L204'),
-    'L203',
+    (B, 'L220'),
+    'L219',
     (ROLLBACK,),
-    'L204',
-    'L202',
+    'L220',
+    'L218',
     (KET,),
     (YIELD,),
-    (BT, 'L199'),
+    (BT, 'L215'),
     (SET,),
-    (BF, 'L197'),
+    (BF, 'L214'),
     (LITERAL, '\''),
     (YIELD,),
-    (BF, 'L197'),
+    (BF, 'L214'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L198'),
-    'L197',
+    (B, 'L221'),
+    'L214',
     (ROLLBACK,),
-    'L198',
-    'L205',
+    'L221',
+    'L222',
     (R,),
     '*whitespace*',
     (CHECKPOINT,),
     (BRA,),
     (CHECKPOINT,),
-    'L210',
+    'L223',
     (BRA,),
     (CHECKPOINT,),
     (ANY_OF, ' \t\n\r\u000b\u000c'),
     (YIELD,),
-    (BF, 'L211'),
+    (BF, 'L224'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L212'),
-    'L211',
+    (B, 'L225'),
+    'L224',
     (ROLLBACK,),
-    'L212',
-    (BT, 'L213'),
+    'L225',
+    (BT, 'L226'),
     (CHECKPOINT,),
     (CALL, 'comment'),
     (YIELD,),
-    (BF, 'L214'),
+    (BF, 'L227'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L215'),
-    'L214',
+    (B, 'L228'),
+    'L227',
     (ROLLBACK,),
-    'L215',
-    'L213',
+    'L228',
+    'L226',
     (KET,),
     (YIELD,),
-    (BT, 'L210'),
+    (BT, 'L223'),
     (SET,),
-    (BF, 'L208'),
+    (BF, 'L229'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L209'),
-    'L208',
+    (B, 'L230'),
+    'L229',
     (ROLLBACK,),
-    'L209',
-    'L216',
+    'L230',
+    'L231',
     (KET,),
     (STORE, 'ignore'),
-    (BF, 'L206'),
+    (BF, 'L232'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L207'),
-    'L206',
+    (B, 'L233'),
+    'L232',
     (ROLLBACK,),
-    'L207',
-    'L217',
+    'L233',
+    'L234',
     (R,),
     'comment',
     (CHECKPOINT,),
     (LITERAL, '#'),
     (YIELD,),
-    (BF, 'L218'),
-    'L220',
+    (BF, 'L235'),
+    'L236',
     (BRA,),
     (CHECKPOINT,),
     (ANY_BUT, '\n\r'),
     (YIELD,),
-    (BF, 'L221'),
+    (BF, 'L237'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L222'),
-    'L221',
+    (B, 'L238'),
+    'L237',
     (ROLLBACK,),
-    'L222',
-    'L223',
+    'L238',
+    'L239',
     (KET,),
     (YIELD,),
-    (BT, 'L220'),
+    (BT, 'L236'),
     (SET,),
-    (BF, 'L218'),
+    (BF, 'L235'),
     (COMMIT,),
     (YIELD,),
-    (B, 'L219'),
-    'L218',
+    (B, 'L240'),
+    'L235',
     (ROLLBACK,),
-    'L219',
-    'L224',
+    'L240',
+    'L241',
     (R,),
     (END,),
 ]
@@ -1756,50 +2292,1525 @@ whitespace_code = [\
     'X130',
     (R,),]
 
+#-------------------------------------------------------
+# Most runs use only some of what follows. Compiling the rest (the
+# verifier, the lexer, bytecode files, and what --inline, --fuse,
+# --bytes, --memo-spill, --parallel and --stream need) would take longer
+# than a run on a small input does. So those parts are kept as source
+# in DEFERRED, and each is compiled the first time need() is asked for
+# it. They're still here, in the one file, and tracebacks still point at
+# their lines.
+
+DEFERRED = {}   # part -> (file name, line, source)
+
+def deferred(source):
+    caller = sys._getframe(1)
+    return caller.f_code.co_filename, caller.f_lineno, source
+
+def need(part):
+    if part in DEFERRED:
+        name, line, source = DEFERRED.pop(part)
+        exec(compile("\n" * (line - 1) + source, name, "exec"), globals())
+
+#-------------------------------------------------------
+# The compact form, for --compact. Rather than a list of labels and
+# tuples, the program is an array of opcodes (indexes into INSTRUCTIONS)
+# and a parallel array of indexes into CONSTANTS, the table of argument
+# tuples, so each different tuple (and the strings in it) is stored just
+# once. The labels go straight into LABELS, as addresses in the arrays,
+# so the instructions themselves don't need to know.
+#
+# New instructions go on the end of INSTRUCTIONS, so opcodes don't change.
+
+INSTRUCTIONS = [
+    ADR, CALL, R, B, BT, BF, END, NOP,
+    CHECKPOINT, ROLLBACK, COMMIT, ANY_OF, ANY_BUT, LITERAL, SET, GEN,
+    CL, CI, TB, LMI, LMD, NL, BRA, KET, YIELD, STORE, LOAD,
+    TOKEN, TOKEN_END, CALL_YIELD_BF, YIELD_BF, CALL_STORE_BF, STORE_BF,
+    COMMIT_YIELD_B, ANY_OF_YIELD_BF, ANY_BUT_YIELD_BF, LITERAL_YIELD_BF,
+    KET_YIELD_BT, CALL_INLINE, CHAR_CLASS, LEX,
+]
+OPCODE_of = {instruction: opcode
+             for opcode, instruction in enumerate(INSTRUCTIONS)}
+
+def assemble(program):
+    # Returns (opcodes, operands, constants, labels)
+    import array
+    opcodes = array.array("H")
+    operands = array.array("i")
+    constants = []
+    numbers = {}
+    labels = {}
+    for item in program:
+        if isinstance(item, str):
+            labels.setdefault(item, len(opcodes))
+            continue
+        args = tuple(sys.intern(x) if isinstance(x, str) else x
+                     for x in item[1:])
+        if args not in numbers:
+            numbers[args] = len(constants)
+            constants.append(args)
+        opcodes.append(OPCODE_of[item[0]])
+        operands.append(numbers[args])
+    return opcodes, operands, constants, labels
+
+#-------------------------------------------------------
+# Bytecode files: the compact form written out, so that a runtime with
+# no PROGRAM of its own (see metaphor-runtime.py in the Makefile) can run
+# any grammar without Python having to parse it. --emit-bytecode writes
+# one (from our output, which had better be a program) and --bytecode
+# runs one. Everything is little-endian, and the parts with 4-byte items
+# come first, so that they're aligned and we can use them where they are:
+#
+#   magic, version, len(INSTRUCTIONS), number of instructions,
+#   strings, constants, constants' arguments, labels
+#   and bytes of string text                        ("<4sHHIIIIII")
+#   operands                                        (i each)
+#   string lengths in bytes                         (I each)
+#   the arguments of all the constants, as string
+#   numbers or, for the instructions CALL_INLINE
+#   takes, -1 - opcode                              (i each)
+#   labels: string number and address of each      (i each)
+#   opcodes                                         (H each)
+#   number of arguments of each constant            (B each)
+#   the UTF-8 text of the strings
+
+DEFERRED["bytecode"] = deferred(r'''
+BYTECODE_MAGIC = b"MPHB"
+BYTECODE_VERSION = 2
+BYTECODE_HEADER = "<4sHHIIIIII"
+
+def write_bytecode(program, name):
+    import array, struct
+    opcodes, operands, constants, labels = assemble(program)
+    strings, numbers = [], {}
+    def number(s):
+        if s not in numbers:
+            numbers[s] = len(strings)
+            strings.append(s.encode("utf-8"))
+        return numbers[s]
+    sizes = array.array("B", [len(args) for args in constants])
+    arguments = array.array("i", [number(x) if isinstance(x, str)
+                                  else -1 - OPCODE_of[x]
+                                  for args in constants for x in args])
+    places = array.array("i")
+    for label, address in labels.items():
+        places.extend([number(label), address])
+    lengths = array.array("I", [len(s) for s in strings])
+    text = b"".join(strings)
+    with open(name, "wb") as fout:
+        fout.write(struct.pack(BYTECODE_HEADER,
+            BYTECODE_MAGIC, BYTECODE_VERSION, len(INSTRUCTIONS),
+            len(opcodes), len(strings), len(constants), len(arguments),
+            len(labels), len(text)))
+        for part in [operands, lengths, arguments, places, opcodes, sizes]:
+            if sys.byteorder == "big":
+                part.byteswap()
+            fout.write(part.tobytes())
+        fout.write(text)
+
+def read_bytecode(name):
+    # Returns (opcodes, operands, constants, labels), as assemble() does,
+    # except that the arrays are memoryviews of what we read (or, on a
+    # big-endian machine, arrays we've turned round)
+    import struct
+    try:
+        with open(name, "rb") as fin:
+            data = memoryview(fin.read())
+        magic, version, count, n_code, n_strings, n_constants, \
+            n_arguments, n_labels, n_text = \
+            struct.unpack_from(BYTECODE_HEADER, data)
+    except (OSError, struct.error) as problem:
+        error("+++ Can't read bytecode from %s: %s" % (name, problem))
+    if magic != BYTECODE_MAGIC or version != BYTECODE_VERSION or \
+       count > len(INSTRUCTIONS):
+        error("+++ %s is not Metaphor bytecode version %d" %
+              (name, BYTECODE_VERSION))
+    at = struct.calcsize(BYTECODE_HEADER)
+    def take(kind, n):
+        nonlocal at
+        end = at + n * struct.calcsize(kind)
+        if end > len(data):
+            error("+++ %s is truncated" % name)
+        part = data[at:end]
+        at = end
+        if sys.byteorder == "big":
+            import array
+            part = array.array(kind, part.tobytes())
+            part.byteswap()
+            return part
+        return part.cast(kind)
+    operands = take("i", n_code)
+    lengths = take("I", n_strings)
+    arguments = take("i", n_arguments)
+    places = take("i", 2 * n_labels)
+    opcodes = take("H", n_code)
+    sizes = take("B", n_constants)
+    text = take("B", n_text)
+    # Anything else wrong with it would only show when we ran it, if at
+    # all, so we look now
+    if at != len(data) or sum(lengths) != n_text or \
+       sum(sizes) != n_arguments or \
+       n_code and (max(opcodes) >= len(INSTRUCTIONS) or
+                   min(operands) < 0 or max(operands) >= n_constants) or \
+       n_labels and (min(places) < 0 or max(places[1::2]) > n_code):
+        error("+++ %s is bad bytecode" % name)
+    try:
+        strings = []
+        start = 0
+        for length in lengths:
+            strings.append(sys.intern(str(text[start:start + length],
+                                          "utf-8")))
+            start += length
+        constants = []
+        start = 0
+        for size in sizes:
+            constants.append(tuple(strings[x] if x >= 0
+                                   else INSTRUCTIONS[-1 - x]
+                                   for x in arguments[start:start + size]))
+            start += size
+        labels = {strings[places[i]]: places[i + 1]
+                  for i in range(0, len(places), 2)}
+    except (UnicodeDecodeError, IndexError):
+        error("+++ %s is bad bytecode" % name)
+    return opcodes, operands, constants, labels
+
+def disassemble(opcodes, operands, constants, labels):
+    # Back to a list of labels and tuples, for the passes above
+    at = {}
+    for label, address in labels.items():
+        at.setdefault(address, []).append(label)
+    program = []
+    for i, (opcode, operand) in enumerate(zip(opcodes, operands)):
+        program.extend(at.get(i, []))
+        program.append((INSTRUCTIONS[opcode],) + constants[operand])
+    program.extend(at.get(len(opcodes), []))
+    return program
+''')
+
+# The passes and the tuple loop need the list form; only the compact
+# loop can run what we read as it is.
+LOADED = None
+if BYTECODE_name is not None:
+    need("bytecode")
+    LOADED = read_bytecode(BYTECODE_name)
+    if not COMPACT or INLINE or FUSE:
+        PROGRAM = disassemble(*LOADED)
+        LOADED = None
+elif not PROGRAM:
+    # (metaphor-runtime.py, which only runs what it's given)
+    error("Option --bytecode is needed, as there's no program here\n" +
+          usage)
+
 # If the grammar doesn't itself define <*whitespace*>, we need
 # to bolt this code onto the end of the program
 
-if "*whitespace*" not in PROGRAM:
+if LOADED is None and "*whitespace*" not in PROGRAM:
     PROGRAM.extend(whitespace_code)
 
+#-------------------------------------------------------
+# The lexer. A grammar can say, just after BEGIN <start>, that some of
+# its rules are tokens:
+#
+#   TOKENS <id> <number>;
+#
+# which comes out as a LEX after its last rule. Then before the parse,
+# tokenise() goes through the input once, looking for the token rules
+# in that order. Where one matches, we note the token (its kind, where
+# it starts, where its text starts and where it ends) in four arrays,
+# and carry on from its end; where none does, we carry on from the next
+# character. A CALL of a token rule where there's a token of its kind is
+# then just a look in the arrays (see lexed()), without running the rule
+# or keeping memo entries for it and the rules it calls.
+#
+# The lexer doesn't run the token rules, since that would cost as much
+# as the parse would have. Instead, token_pattern() turns them into one
+# regular expression (using atomic groups and possessive repeats, which
+# don't backtrack, just as a rule doesn't), from the code the grammar
+# compiled them to, before any of the passes below change it. A token's
+# text is what the rule would return: all it matched, after anything
+# it only STOREd (like the <*whitespace*> before it). A rule which
+# makes output, or can match nothing, or calls itself, can't be a token,
+# and then we do without the lexer (--profile says why).
+#
+# A rule's result depends only on where it starts (which is why the
+# memo works), so the tokens change nothing but the speed. Except for
+# one thing: the lexer has been further ahead than the parse, so a
+# syntax error is found again without the tokens, to report the high
+# water mark the parse would have reached on its own.
+
+def program_code(program):
+    # (instruction, args) for each instruction, and each label's index
+    code, labels = [], {}
+    for item in program:
+        if isinstance(item, str):
+            labels.setdefault(item, len(code))
+        else:
+            code.append((item[0], item[1:]))
+    return code, labels
+
+def compact_code(opcodes, operands, constants):
+    return [(INSTRUCTIONS[opcode], constants[operand])
+            for opcode, operand in zip(opcodes, operands)]
+
+# Making the patterns means importing re and compiling a pattern for
+# every rule we call, which takes longer than a small input takes to
+# parse. So make_patterns() waits for an input of PATTERN_input
+# characters or more (--patterns-from; see parse()), and then they're
+# kept for the rest. It decompiles the program as it was before the
+# passes below.
+
+TOKEN_rules = ()
+TOKEN_pattern = None
+TOKEN_problem = None
+TEXT_patterns = None    # until make_patterns()
+PATTERN_program = PROGRAM if LOADED is None else LOADED
+if LOADED is None:
+    for item in reversed(PROGRAM):
+        if isinstance(item, tuple) and item[0] == LEX:
+            TOKEN_rules = item[1:]
+            break
+else:
+    for opcode, operand in zip(LOADED[0], LOADED[1]):
+        if INSTRUCTIONS[opcode] == LEX:
+            TOKEN_rules = LOADED[2][operand]
+
+def wants_patterns(size):
+    # Whether an input of this many characters is worth making the
+    # patterns for (see metaphor-prefork.py, which makes them once for
+    # all its workers)
+    return size >= PATTERN_input and \
+           not (NO_TOKENS and NO_SPANS or STREAM_rule)
+
+def make_patterns():
+    global TOKEN_pattern, TOKEN_problem, TEXT_patterns
+    need("patterns")
+    if isinstance(PATTERN_program, list):
+        code, labels = program_code(PATTERN_program)
+    else:
+        code, labels = compact_code(*PATTERN_program[:3]), \
+                       PATTERN_program[3]
+    called = {args[0] for instruction, args in code if instruction == CALL}
+    piece = rule_pieces(code, labels)
+    if TOKEN_rules:
+        try:
+            TOKEN_pattern = token_pattern(piece, TOKEN_rules)
+        except (NotAToken, IndexError, KeyError) as problem:
+            TOKEN_problem = str(problem) or "an unusual shape"
+    TEXT_patterns = text_patterns(piece, sorted(called))
+
+DEFERRED["patterns"] = deferred(r'''
+class NotAToken(Exception):
+    pass
+
+def rule_pieces(code, labels):
+    # Returns rule_piece(rule), which turns a rule into (prefix, text,
+    # nullable, exact): regular expressions for what it matches without
+    # returning it, and then what it returns (None if nothing), or
+    # raises NotAToken. A piece of a rule is the same. It isn't exact
+    # if it returns more than the text: see ex3().
+    import re
+    done, busy = {}, set()
+
+    def fail(why):
+        raise NotAToken(why)
+
+    def whole(piece):
+        return piece[0] + (piece[1] or "")
+
+    def rule_piece(rule):
+        if rule not in done:
+            if rule in busy or rule not in labels:
+                fail("<%s> can't be a token" % rule)
+            busy.add(rule)
+            try:
+                piece, i = ex1(labels[rule])
+                if code[i][0] != R:
+                    fail("<%s> isn't the usual shape" % rule)
+                done[rule] = piece
+            except (NotAToken, IndexError, KeyError) as problem:
+                # (so we needn't look again)
+                done[rule] = problem
+            finally:
+                busy.discard(rule)
+        if isinstance(done[rule], Exception):
+            raise done[rule]
+        return done[rule]
+
+    def ex1(i):
+        # alternatives: ex2, then (BT, end) before each of the rest
+        pieces = []
+        while True:
+            piece, i = ex2(i)
+            pieces.append(piece)
+            if code[i][0] != BT or labels[code[i][1][0]] <= i:
+                break
+            i += 1
+        if len(pieces) == 1:
+            return pieces[0], i
+        nullable = any(piece[2] for piece in pieces)
+        if all(piece[1] is None for piece in pieces):
+            return ("(?>%s)" % "|".join(p[0] for p in pieces), None,
+                    nullable, True), i
+        texts = []
+        for prefix, text, _, _ in pieces:
+            if prefix:
+                fail("the alternatives don't return the same kind of thing")
+            texts.append(text or "")
+        return ("", "(?>%s)" % "|".join(texts), nullable,
+                all(piece[3] for piece in pieces)), i
+
+    def ex2(i):
+        # CHECKPOINT, items each followed by (BF, rollback), COMMIT,
+        # YIELD, (B, end), ROLLBACK
+        if code[i][0] != CHECKPOINT:
+            fail("output or an unusual shape")
+        i += 1
+        prefix, text, nullable, exact = "", None, True, True
+        while code[i][0] != COMMIT:
+            piece, i = ex3(i)
+            if code[i][0] != BF:
+                fail("output or an unusual shape")
+            i += 1
+            if text is None:
+                prefix += piece[0]
+                text = piece[1]
+            elif piece[0]:
+                fail("something it doesn't return between what it does")
+            else:
+                text += piece[1] or ""
+            nullable = nullable and piece[2]
+            exact = exact and piece[3]
+        if [x[0] for x in code[i:i + 4]] != [COMMIT, YIELD, B, ROLLBACK]:
+            fail("an unusual shape")
+        return (prefix, text, nullable, exact), i + 4
+
+    def ex3(i):
+        start = i
+        instruction, args = code[i]
+        if instruction == CHECKPOINT:
+            # a quoted token: <*whitespace*> then a LITERAL
+            shape = [x[0] for x in code[i:i + 8]]
+            if shape != [CHECKPOINT, CALL, BF, LITERAL, BF, COMMIT, B,
+                         ROLLBACK]:
+                fail("an unusual shape")
+            literal = code[i + 3][1][0]
+            piece = (whole(rule_piece(code[i + 1][1][0])) +
+                     re.escape(literal), None, False, True)
+            i += 8
+        else:
+            if instruction in (ANY_OF, ANY_BUT):
+                chars = "".join(re.escape(c) for c in args[0])
+                if instruction == ANY_OF:
+                    found = "[%s]" % chars if chars else "(?!)"
+                else:
+                    found = "[^%s]" % chars if chars else "(?s:.)"
+                piece = ("", found, False, True)
+            elif instruction == LITERAL:
+                piece = ("", re.escape(args[0]), not args[0], True)
+            elif instruction == SET:
+                piece = ("", "", True, True)
+            elif instruction == CALL:
+                piece = rule_piece(args[0])
+            elif instruction == BRA:
+                piece, i = ex1(i + 1)
+                if code[i][0] != KET:
+                    fail("output")
+            else:
+                fail("it uses %s" % getattr(instruction, "__name__",
+                                            instruction))
+            i += 1
+            if code[i][0] == STORE:
+                piece = (whole(piece), None, piece[2], True)
+            elif code[i][0] != YIELD:
+                fail("an unusual shape")
+            i += 1
+        # and then any REPEATs of it: (BT, back to its start), SET. When
+        # ANY_OF, ANY_BUT or LITERAL fails it leaves RETVAL as it was,
+        # so the last (failed) time round the YIELD returns the last
+        # character again: the text and then some, which isn't exact.
+        # (Only a problem if the rule returns it, and not if it's STOREd.)
+        bare = instruction in (ANY_OF, ANY_BUT, LITERAL)
+        while code[i][0] == BT and labels[code[i][1][0]] == start and \
+              code[i + 1][0] == SET:
+            prefix, text, _, exact = piece
+            if text is None:
+                piece = ("(?:%s)*+" % prefix, None, True, True)
+            elif not prefix:
+                piece = ("", "(?:%s)*+" % text, True, exact and not bare)
+            else:
+                fail("it REPEATs something it doesn't all return")
+            bare = False
+            i += 2
+        return piece, i
+
+    return rule_piece
+
+def token_pattern(rule_piece, rules):
+    # Returns the pattern, in which the text of a token of kind k is the
+    # group "k<k>"
+    import re
+    kinds = []
+    for k, rule in enumerate(rules):
+        prefix, text, nullable, exact = rule_piece(rule)
+        if nullable:
+            raise NotAToken("<%s> can match nothing" % rule)
+        if not exact:
+            raise NotAToken("<%s> REPEATs a match which returns its last "
+                            "character twice" % rule)
+        kinds.append("%s(?P<k%d>%s)" % (prefix, k, text or ""))
+    try:
+        return compile_pattern("|".join(kinds))
+    except re.error as problem:
+        raise NotAToken(str(problem))
+
+def compile_pattern(pattern):
+    # With --bytes, the input is bytes, and so must the pattern be
+    import re
+    if BYTES:
+        try:
+            pattern = pattern.encode("latin-1")
+        except UnicodeEncodeError:
+            raise NotAToken("it isn't all Latin-1")
+    return re.compile(pattern)
+
+def text_patterns(rule_piece, rules):
+    # For spanned() (below): for each of these rules which can be turned
+    # into a regular expression, (match, whether it returns its text),
+    # where the text is group 1
+    import re
+    patterns = {}
+    for rule in rules:
+        try:
+            prefix, text, _, exact = rule_piece(rule)
+            if not exact:
+                continue
+            patterns[rule] = (compile_pattern("%s(%s)" % (prefix, text or
+                                                          "")).match,
+                              text is not None)
+        except (NotAToken, IndexError, KeyError, re.error):
+            pass
+    return patterns
+
+def tokenise():
+    # Returns how long it took
+    global TOKEN_kind, TOKEN_find
+    global TOKEN_starts, TOKEN_kinds, TOKEN_texts, TOKEN_ends
+    import array, bisect
+    started = time.monotonic()
+    starts, kinds, texts, ends = [array.array("i") for _ in range(4)]
+    search = TOKEN_pattern.search
+    found = search(INPUT)
+    while found:
+        kind = found.lastgroup
+        starts.append(found.start())
+        kinds.append(int(kind[1:]))
+        texts.append(found.start(kind))
+        ends.append(found.end())
+        found = search(INPUT, found.end())
+    TOKEN_starts, TOKEN_kinds, TOKEN_texts, TOKEN_ends = \
+        starts, kinds, texts, ends
+    TOKEN_kind = {rule: kind for kind, rule in enumerate(TOKEN_rules)}
+    TOKEN_find = bisect.bisect_left
+    return time.monotonic() - started
+
+def lexed(rule):
+    # For CALL: if there's a token of this rule's kind here, do what a
+    # memo hit would, and say so
+    global INPUT_position, RETVAL, SWITCH, LEX_hits
+    i = TOKEN_find(TOKEN_starts, INPUT_position)
+    if i == len(TOKEN_starts) or TOKEN_starts[i] != INPUT_position or \
+       TOKEN_kinds[i] != TOKEN_kind[rule]:
+        return False
+    LEX_hits += 1
+    RETVAL = slice(TOKEN_texts[i], TOKEN_ends[i])
+    INPUT_position = TOKEN_ends[i]
+    SWITCH = True
+    return True
+''')
+
+#-------------------------------------------------------
+# Spans. A rule like <id> or <string> returns just the text it matched,
+# which used to mean a string for every character, and joining them
+# together again at every level of the rules it was made by. Now the
+# text is a span instead: slice(start, end) of INPUT, which becomes a
+# string only when the output is written (see write_items()), as one
+# slice of the input.
+#
+# What's more, a rule which only matches text (what the lexer can make
+# a token of, though it may match nothing) doesn't have to be run
+# an instruction at a time: text_patterns() turns it into a regular
+# expression in the same way, and a CALL of it is one match (see
+# spanned()), whose result goes in the memo as the rule's own would.
+#
+# Like the lexer, that changes nothing but the speed, except that the
+# high water mark doesn't see inside such rules; so a syntax error is
+# found again without them. And like the lexer, it's off with --stream
+# (which has to see the parse get to the end of its window), and when
+# the input is given a piece at a time (see metaphor_push.py), and
+# --no-spans turns it off.
+
+def spanned(rule):
+    # For CALL: match the rule in one go, and leave things as its R would
+    global INPUT_position, RETVAL, SWITCH, SPAN_hits
+    SPAN_hits += 1
+    match, returns = TEXT_spans[rule]
+    key = (INPUT_position, rule)
+    found = match(INPUT, INPUT_position)
+    if found is None:
+        RETVAL, SWITCH = "", False
+    else:
+        RETVAL = slice(found.start(1), found.end()) if returns else ""
+        INPUT_position, SWITCH = found.end(), True
+    if rule not in UNMEMOISED:
+        RULE_USE_CACHE[key] = (INPUT_position, RETVAL, SWITCH)
+
+def text_of(x):
+    # x with any spans in it made into strings
+    if isinstance(x, slice):
+        return INPUT[x]
+    if isinstance(x, list):
+        return [text_of(y) for y in x]
+    return x
+
+#-------------------------------------------------------
+# Inlining for --inline (see CALL_INLINE and CHAR_CLASS in the header).
+# An alternative which matches a single thing always comes out as
+#
+#     (CHECKPOINT,), thing, (YIELD,), (BF, fail), (COMMIT,), (YIELD,),
+#     (B, done), fail, (ROLLBACK,), done
+#
+# with a (BT, end) between it and the next alternative. A rule which is
+# just one of those (and then R) is small enough to inline, and a run of
+# them which each match one character can be done in one go.
+
+DEFERRED["inline"] = deferred(r'''
+def branch_at(program, i, references):
+    # The thing matched by the alternative at program[i], or None
+    if program[i:i + 1] != [(CHECKPOINT,)] or i + 10 > len(program):
+        return None
+    thing = program[i + 1]
+    fail, done = program[i + 7], program[i + 9]
+    if not isinstance(thing, tuple) or \
+       program[i + 2:i + 7] != [(YIELD,), (BF, fail), (COMMIT,), (YIELD,),
+                                (B, done)] or \
+       program[i + 8] != (ROLLBACK,) or \
+       references.get(fail) != 1 or references.get(done) != 1:
+        return None
+    return thing
+
+def one_char(thing):
+    # The characters it matches, if it matches one of them and no more
+    if thing[0] not in (ANY_OF, LITERAL, CALL_INLINE):
+        return None
+    match, x = thing[-2], thing[-1]
+    if match in (ANY_OF, LITERAL) and isinstance(x, str) and \
+       (match == ANY_OF or len(x) == 1):
+        return x
+    return None
+
+def inline(program):
+    references = {}
+    called = set()
+    for item in program:
+        if isinstance(item, tuple) and item[0] in (B, BT, BF):
+            references[item[1]] = references.get(item[1], 0) + 1
+        elif isinstance(item, tuple) and item[0] == CALL:
+            called.add(item[1])
+    # first the rules, replacing their CALLs (the first definition of a
+    # rule is the one lookup finds)
+    rules = {}
+    for i, item in enumerate(program):
+        if item in called and item not in references and item not in rules:
+            thing = branch_at(program, i + 1, references)
+            if thing is None or thing[0] not in (ANY_OF, ANY_BUT, LITERAL):
+                rules[item] = None
+                continue
+            j = i + 11
+            while j < len(program) and isinstance(program[j], str):
+                j += 1
+            rules[item] = thing if program[j:j + 1] == [(R,)] else None
+    program = [(CALL_INLINE, item[1]) + rules[item[1]]
+               if isinstance(item, tuple) and item[0] == CALL and
+                  rules.get(item[1]) else item
+               for item in program]
+    # then runs of one-character alternatives, all with the same (BT, end)
+    # after them, apart from the last
+    result = []
+    i = 0
+    while i < len(program):
+        chars, via_call, end, j, after = "", "", None, i, i
+        while True:
+            thing = branch_at(program, j, references)
+            if thing is None or one_char(thing) is None:
+                break
+            new = "".join(c for c in one_char(thing) if c not in chars)
+            chars += new
+            if thing[0] == CALL_INLINE:
+                via_call += new
+            after = j + 10
+            following = program[after] if after < len(program) else None
+            if end is None and isinstance(following, tuple) and \
+               following[0] == BT:
+                end = following[1]
+            if end is None or following != (BT, end):
+                break
+            j = after + 1
+        if chars:
+            result.append((CHAR_CLASS, chars, via_call))
+            i = after
+        else:
+            result.append(program[i])
+            i += 1
+    return result
+''')
+
+#-------------------------------------------------------
+# Peephole pass for --fuse: replace common sequences of instructions with
+# the superinstructions which do the same job. None of these sequences has
+# a label inside it, so nothing can jump into the middle of one. The
+# whitespace-then-literal sequence which the grammar generates for a
+# quoted token also has two labels of its own at the end, which we can
+# drop if nothing else uses them.
+
+DEFERRED["fuse"] = deferred(r'''
+def fuse(program):
+    references = {}
+    for item in program:
+        if isinstance(item, tuple) and item[0] in (B, BT, BF):
+            references[item[1]] = references.get(item[1], 0) + 1
+    def at(i, *pattern):
+        # Does program[i:] start with these instructions? (A None in
+        # the pattern matches any operand.)
+        if i + len(pattern) > len(program):
+            return False
+        for item, want in zip(program[i:], pattern):
+            if not isinstance(item, tuple) or len(item) != len(want) or \
+               any(w is not None and w != x for x, w in zip(item, want)):
+                return False
+        return True
+    fused = []
+    i = 0
+    while i < len(program):
+        item = program[i]
+        if at(i, (CHECKPOINT,), (CALL, "*whitespace*"), (BF, None),
+              (LITERAL, None), (BF, None), (COMMIT,), (B, None)) and \
+           program[i + 7:i + 10] == [program[i + 2][1], (ROLLBACK,),
+                                     program[i + 6][1]] and \
+           program[i + 4][1] == program[i + 2][1] and \
+           references[program[i + 2][1]] == 2 and \
+           references[program[i + 6][1]] == 1:
+            literal = program[i + 3][1]
+            fused += [(TOKEN, literal), (TOKEN_END, literal)]
+            i += 10
+        elif at(i, (CALL, None), (STORE, None), (BF, None)):
+            rule, name, label = item[1], program[i + 1][1], program[i + 2][1]
+            fused += [(CALL_STORE_BF, rule, name, label),
+                      (STORE_BF, name, label)]
+            i += 3
+        elif at(i, (CALL, None), (YIELD,), (BF, None)):
+            rule, label = item[1], program[i + 2][1]
+            fused += [(CALL_YIELD_BF, rule, label), (YIELD_BF, label)]
+            i += 3
+        elif at(i, (COMMIT,), (YIELD,), (B, None)):
+            fused.append((COMMIT_YIELD_B, program[i + 2][1]))
+            i += 3
+        elif at(i, (KET,), (YIELD,), (BT, None)):
+            fused.append((KET_YIELD_BT, program[i + 2][1]))
+            i += 3
+        elif isinstance(item, tuple) and \
+             item[0] in (ANY_OF, ANY_BUT, LITERAL) and \
+             at(i + 1, (YIELD,), (BF, None)):
+            combined = {ANY_OF: ANY_OF_YIELD_BF, ANY_BUT: ANY_BUT_YIELD_BF,
+                        LITERAL: LITERAL_YIELD_BF}[item[0]]
+            fused.append((combined, item[1], program[i + 2][1]))
+            i += 3
+        else:
+            fused.append(item)
+            i += 1
+    return fused
+''')
+
+if INLINE:
+    need("inline")
+    PROGRAM = inline(PROGRAM)
+if FUSE:
+    need("fuse")
+    PROGRAM = fuse(PROGRAM)
+
+#-------------------------------------------------------
+# Rule variables. Each rule's variables (the names it STOREs) are given
+# slots, numbered from 0 in the order they're first stored, and STORE
+# and LOAD get the slot number instead of the name, so that a rule's
+# variables can be a list rather than a dict (see STORE in the header).
+# A LOAD of a name which its rule never stores is a mistake in the
+# grammar, so we say so now rather than when the parse gets there. A
+# rule's code runs from its label (the first one after the last R) to
+# its own R.
+
+SLOT_names = {}     # rule -> names of its variables, in slot order
+
+# Which argument of each of these instructions is a variable
+VARIABLE_at = {STORE: 0, STORE_BF: 0, CALL_STORE_BF: 1, LOAD: 0}
+
+def number_variables(code):
+    # code is (rule, instruction, args) for each instruction, in order.
+    # Returns (slot names of each rule, {index in code: new args}).
+    names_of = {}
+    for rule, instruction, args in code:
+        if instruction in VARIABLE_at and instruction != LOAD:
+            names = names_of.setdefault(rule, [])
+            if args[VARIABLE_at[instruction]] not in names:
+                names.append(args[VARIABLE_at[instruction]])
+    changed = {}
+    for i, (rule, instruction, args) in enumerate(code):
+        if instruction in VARIABLE_at:
+            at = VARIABLE_at[instruction]
+            names = names_of.get(rule, [])
+            if args[at] not in names:
+                error("+++ <%s> uses the variable %s, which it never sets" %
+                      (rule, args[at]))
+            changed[i] = args[:at] + (names.index(args[at]),) + args[at + 1:]
+    return names_of, changed
+
+def rule_code(program):
+    # The list form as number_variables() wants it
+    code = []
+    rule = None
+    for item in program:
+        if isinstance(item, str):
+            if rule is None:
+                rule = item
+        else:
+            code.append((rule, item[0], item[1:]))
+            if item[0] == R:
+                rule = None
+    return code
+
+def allocate_slots(program, slot_names=SLOT_names):
+    # The list form, with names changed to slots (whose names go in
+    # slot_names)
+    names_of, changed = number_variables(rule_code(program))
+    slot_names.update(names_of)
+    result = []
+    i = 0
+    for item in program:
+        if isinstance(item, tuple):
+            if i in changed:
+                item = (item[0],) + changed[i]
+            i += 1
+        result.append(item)
+    return result
+
+def allocate_compact_slots(opcodes, operands, constants, labels):
+    # The same for the compact form (of bytecode we've read), where the
+    # new arguments are new constants. (The operands are a memoryview of
+    # what we read, so we change a copy; and not an array, since
+    # importing array imports collections, which would slow our start.)
+    starts = {}
+    for label, address in labels.items():
+        starts.setdefault(address, label)
+    code = []
+    rule = None
+    for i, opcode in enumerate(opcodes):
+        if rule is None:
+            rule = starts.get(i)
+        code.append((rule, INSTRUCTIONS[opcode], constants[operands[i]]))
+        if INSTRUCTIONS[opcode] == R:
+            rule = None
+    names_of, changed = number_variables(code)
+    SLOT_names.update(names_of)
+    if changed:
+        operands = memoryview(bytearray(operands)).cast("i")
+        constants = list(constants)
+        numbers = {}
+        for i, args in changed.items():
+            if args not in numbers:
+                numbers[args] = len(constants)
+                constants.append(args)
+            operands[i] = numbers[args]
+    return opcodes, operands, constants, labels
+
+if LOADED is None:
+    PROGRAM = allocate_slots(PROGRAM)
+else:
+    LOADED = allocate_compact_slots(*LOADED)
+
+#-------------------------------------------------------
+# The verifier. Before we run a program (as it will be run, after all
+# the passes above), we make sure that it can't go wrong in ways which
+# the instructions would otherwise have to look out for every time:
+#
+#   - every instruction has the right number and kinds of operands;
+#   - every label we branch to, and every rule we call, exists;
+#   - on every path through a rule, each CHECKPOINT is matched by one
+#     COMMIT or ROLLBACK and each BRA by one KET, in the right order,
+#     with nothing left over at R;
+#   - on every path through a rule, a variable is stored before it's
+#     loaded.
+#
+# So B, BT, BF and CALL needn't check that a label is there, ANY_OF and
+# ANY_BUT needn't check their argument, and LOAD needn't check that its
+# variable has been set.
+#
+# metaphor-compiler.py makes these checks of every program it writes
+# (see emits_program()), so a program which is just as it made it has
+# passed them already, and we don't check it again, unless --verify.
+# One which has been through --inline or --fuse, or read from a bytecode
+# file (which could have come from anywhere), we check here.
+#
+# The kinds of operands are: "l" a label, "s" a string, "v" a variable's
+# slot, "m" a matching instruction (for CALL_INLINE) and "a" anything;
+# "*" means any number of the one before.
+
+DEFERRED["verify"] = deferred(r'''
+OPERAND_kinds = {
+    ADR: "l", CALL: "l", R: "", B: "l", BT: "l", BF: "l", END: "",
+    NOP: "a", CHECKPOINT: "", ROLLBACK: "", COMMIT: "", ANY_OF: "s",
+    ANY_BUT: "s", LITERAL: "s", SET: "", GEN: "", CL: "s", CI: "", TB: "",
+    LMI: "", LMD: "", NL: "", BRA: "", KET: "", YIELD: "", STORE: "v",
+    LOAD: "v", TOKEN: "s", TOKEN_END: "s", CALL_YIELD_BF: "ll",
+    YIELD_BF: "l", CALL_STORE_BF: "lvl", STORE_BF: "vl",
+    COMMIT_YIELD_B: "l", ANY_OF_YIELD_BF: "sl", ANY_BUT_YIELD_BF: "sl",
+    LITERAL_YIELD_BF: "sl", KET_YIELD_BT: "l", CALL_INLINE: "sms",
+    CHAR_CLASS: "ss", LEX: "l*",
+}
+
+def operand_fits(kind, x, labels):
+    if kind == "l":
+        return isinstance(x, str) and x in labels
+    if kind == "s":
+        return isinstance(x, str)
+    if kind == "v":
+        return isinstance(x, int) and x >= 0
+    if kind == "m":
+        return x in (ANY_OF, ANY_BUT, LITERAL)
+    return True
+
+def verify_error(rule, i, instruction, message):
+    error("+++ Bad program: in <%s>, at %s (instruction %d): %s" %
+          (rule, getattr(instruction, "__name__", instruction), i, message))
+
+def next_states(i, instruction, args, stack, stored, labels, rule,
+                slot_names):
+    # Where we can go from code[i], and with what (stack, stored) there.
+    # The stack is a tuple of "C" (for CHECKPOINT) and "B" (for BRA).
+    def fail(message):
+        verify_error(rule, i, instruction, message)
+    def pop(kind):
+        if not stack or stack[-1] != kind:
+            fail("nothing for it to match")
+        return stack[:-1]
+    if instruction in (R, END):
+        if instruction == R and stack:
+            fail("%d left unmatched on the stack at R" % len(stack))
+        return []
+    if instruction == B:
+        return [(labels[args[0]], stack, stored)]
+    if instruction in (BT, BF, YIELD_BF, ANY_OF_YIELD_BF, ANY_BUT_YIELD_BF,
+                       LITERAL_YIELD_BF):
+        return [(i + 1, stack, stored), (labels[args[-1]], stack, stored)]
+    if instruction in (CHECKPOINT, BRA):
+        return [(i + 1, stack + ("C" if instruction == CHECKPOINT else "B",),
+                 stored)]
+    if instruction in (COMMIT, ROLLBACK, TOKEN_END):
+        return [(i + 1, pop("C"), stored)]
+    if instruction == KET:
+        return [(i + 1, pop("B"), stored)]
+    if instruction == COMMIT_YIELD_B:
+        return [(labels[args[0]], pop("C"), stored)]
+    if instruction == KET_YIELD_BT:
+        rest = pop("B")
+        return [(i + 1, rest, stored), (labels[args[0]], rest, stored)]
+    if instruction == LOAD:
+        if args[0] not in stored:
+            names = slot_names.get(rule, [])
+            fail("%s may not have been stored yet" %
+                 (names[args[0]] if args[0] < len(names) else args[0]))
+        return [(i + 1, stack, stored)]
+    if instruction in (STORE, STORE_BF):
+        stored = stored | {args[0]}
+        if instruction == STORE:
+            return [(i + 1, stack, stored)]
+        return [(i + 1, stack, stored), (labels[args[1]], stack, stored)]
+    # The first half of a superinstruction with a CALL goes on to the
+    # second half when the rule returns, or does the second half's job
+    # itself, when the memo has the result (see called_from_memo())
+    if instruction == TOKEN:
+        return [(i + 1, stack + ("C",), stored), (i + 2, stack, stored)]
+    if instruction == CALL_YIELD_BF:
+        return [(i + 1, stack, stored), (i + 2, stack, stored),
+                (labels[args[1]], stack, stored)]
+    if instruction == CALL_STORE_BF:
+        done = stored | {args[1]}
+        return [(i + 1, stack, stored), (i + 2, stack, done),
+                (labels[args[2]], stack, done)]
+    return [(i + 1, stack, stored)]
+
+def verify(code, labels, slot_names=SLOT_names):
+    # code is (instruction, args) for each instruction, labels maps each
+    # label to its index in code, and slot_names is what allocate_slots()
+    # found the variables' names to be
+    names = {}
+    for label, i in labels.items():
+        names.setdefault(i, label)
+    entries = set()
+    rule = "?"
+    for i, (instruction, args) in enumerate(code):
+        if i in names and (i == 0 or code[i - 1][0] in (ADR, R, END)):
+            rule = names[i]
+        kinds = OPERAND_kinds.get(instruction)
+        if kinds is None:
+            verify_error(rule, i, instruction, "not an instruction")
+        if kinds.endswith("*"):
+            kinds = kinds[0] * len(args)
+        if len(args) != len(kinds) or \
+           kinds and not all(operand_fits(kind, x, labels)
+                             for kind, x in zip(kinds, args)):
+            verify_error(rule, i, instruction, "bad operands %r" % (args,))
+        if instruction in (ADR, CALL, CALL_YIELD_BF, CALL_STORE_BF):
+            entries.add(labels[args[0]])
+        elif instruction == TOKEN:
+            if "*whitespace*" not in labels:
+                verify_error(rule, i, instruction, "no <*whitespace*>")
+            entries.add(labels["*whitespace*"])
+        elif instruction == R and i + 1 in names:
+            entries.add(i + 1)
+    # Then every path from the start of each rule. Where paths meet, the
+    # stacks must be the same, and only what's stored on all of them is
+    # stored there.
+    state = {}      # index in code -> (stack, stored, rule)
+    todo = []
+    for i in sorted(entries):
+        state[i] = ((), frozenset(), names[i])
+        todo.append(i)
+    while todo:
+        i = todo.pop()
+        stack, stored, rule = state[i]
+        if i >= len(code):
+            verify_error(rule, i, "the end", "runs off the end")
+        instruction, args = code[i]
+        for j, stack_j, stored_j in next_states(i, instruction, args, stack,
+                                                stored, labels, rule,
+                                                slot_names):
+            if j not in state:
+                state[j] = (stack_j, stored_j, rule)
+                todo.append(j)
+                continue
+            old_stack, old_stored, _ = state[j]
+            if old_stack != stack_j:
+                verify_error(rule, i, instruction, "the stack is different "
+                             "here on different paths")
+            if not old_stored <= stored_j:
+                state[j] = (stack_j, old_stored & stored_j, rule)
+                todo.append(j)
+''')
+
+if VERIFY or INLINE or FUSE or BYTECODE_name is not None:
+    need("verify")
+    if LOADED is None:
+        verify(*program_code(PROGRAM))
+    else:
+        verify(compact_code(*LOADED[:3]), LOADED[3])
+
+#-------------------------------------------------------
+# Bytes mode, for --bytes (see the header). Once the program has been
+# checked, the strings of characters it looks for are made into tables
+# of bytes, and LITERAL's strings into bytes. A character which isn't
+# Latin-1 can't be in the input, so it isn't in a table, and a LITERAL
+# with one in it just doesn't match.
+
+DEFERRED["bytes"] = deferred(r'''
+def byte_table(chars):
+    table = bytearray(256)
+    for ch in chars:
+        if ord(ch) < 256:
+            table[ord(ch)] = 1
+    return bytes(table)
+
+def byte_args(instruction, args):
+    # args as the bytes mode instruction wants them (the same args, if
+    # nothing changes)
+    if instruction == CALL_INLINE:
+        rule, match, x = args
+        if match != LITERAL:
+            return rule, match, byte_table(x)
+        literal = x
+    elif instruction in (ANY_OF, ANY_BUT, ANY_OF_YIELD_BF, ANY_BUT_YIELD_BF):
+        return (byte_table(args[0]),) + args[1:]
+    elif instruction == CHAR_CLASS:
+        chars, called = args
+        return byte_table(chars), byte_table(called) if called else None
+    elif instruction in (LITERAL, LITERAL_YIELD_BF, TOKEN, TOKEN_END):
+        literal = args[0]
+    else:
+        return args
+    try:
+        ENCODED[literal] = literal.encode("latin-1")
+    except UnicodeEncodeError:
+        pass
+    return args
+
+def byte_tables(program):
+    return [item if isinstance(item, str) else
+            (item[0],) + byte_args(item[0], item[1:])
+            for item in program]
+
+def byte_compact_tables(opcodes, operands, constants, labels):
+    # The same for the compact form, where (as in allocate_compact_slots())
+    # the new arguments are new constants
+    operands = memoryview(bytearray(operands)).cast("i")
+    constants = list(constants)
+    numbers = {}
+    for i, opcode in enumerate(opcodes):
+        args = constants[operands[i]]
+        changed = byte_args(INSTRUCTIONS[opcode], args)
+        if changed is not args:
+            if changed not in numbers:
+                numbers[changed] = len(constants)
+                constants.append(changed)
+            operands[i] = numbers[changed]
+    return opcodes, operands, constants, labels
+''')
+
+if BYTES:
+    need("bytes")
+    if LOADED is None:
+        PROGRAM = byte_tables(PROGRAM)
+    else:
+        LOADED = byte_compact_tables(*LOADED)
+
 #-------------------------------------------------------
 # Helper to lookup labels
 
 LABELS = {}
 def lookup(s):
-    if s in LABELS:
+    try:
         return LABELS[s]
-    else:
-        for i, item in enumerate(PROGRAM):
-            if isinstance(item, str) and item == s:
-                LABELS[s] = i
-                return i
+    except KeyError:
         error("+++ No such label:", s)
 
-# All that's left is to run it ...        
-instruction = PROGRAM[0]
-while True:
-    fun, args = instruction[0], instruction[1:]
-    fun(*args)
-    if PC == None:
-        break
-    instruction = PROGRAM[PC]
-    PC += 1
-    # skip over labels
-    while isinstance(instruction, str):
+# Find all the labels in one go (the first of any duplicates wins)
+if COMPACT:
+    OPCODES, OPERANDS, CONSTANTS, LABELS = LOADED or assemble(PROGRAM)
+else:
+    for i, item in enumerate(PROGRAM):
+        if isinstance(item, str):
+            LABELS.setdefault(item, i)
+
+#-------------------------------------------------------
+# A packrat memo which needn't fit in memory, for --memo-spill=N. The
+# newest N entries are in a dict, as usual. When there are more, the
+# older half of them go into an SQLite table in a temporary file (which
+# is deleted as soon as it's open, so it goes away with us), keyed by
+# rule number and position. The results are marshalled, since they're
+# only strings, numbers, lists and tuples.
+#
+# Most CALLs are of rules which haven't been used at that position, so
+# must not cost a trip to the disk. A Bloom filter (two bits set per
+# entry, out of FILTER_bits for each) says which entries can't be on
+# disk; the rest are nearly always there. It's first made big enough for
+# the entries an input of this length is likely to spill (FILTER_per_char
+# memo entries for each character, less those kept in memory), and when
+# more than that have gone to disk it's made twice as big and filled
+# again from the table, so it never gets too full to say no.
+
+DEFERRED["memo-spill"] = deferred(r'''
+FILTER_bits = 16
+FILTER_per_char = 2
+FILTER_least = 1 << 16        # bytes
+
+class TieredMemo:
+    # Enough of a dict for RULE_USE_CACHE
+
+    def __init__(self, limit):
+        import marshal
+        import sqlite3
+        import tempfile
+        self.limit = limit
+        self.recent = {}
+        self.spilled = 0
+        self.disk_hits = 0
+        self.rule_numbers = {}
+        self.expected = max(len(INPUT) * FILTER_per_char - limit, limit)
+        self.new_filter(self.expected)
+        self.found = None           # (key, value) from the disk, just now
+        self.dumps, self.loads = marshal.dumps, marshal.loads
+        fd, path = tempfile.mkstemp(prefix="metaphor-memo-", dir=MEMO_dir)
+        os.close(fd)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE memo (rule INTEGER, position INTEGER, "
+                        "result BLOB, PRIMARY KEY (rule, position)) "
+                        "WITHOUT ROWID")
+        os.unlink(path)
+
+    def disk_key(self, key):
+        position, rule = key
+        if rule not in self.rule_numbers:
+            self.rule_numbers[rule] = len(self.rule_numbers)
+        return self.rule_numbers[rule], position
+
+    def new_filter(self, entries):
+        # (for the disk keys, so that it can be filled again from the table)
+        size = max(FILTER_least, entries * FILTER_bits // 8)
+        self.filter = bytearray(size)
+        self.capacity = size * 8 // FILTER_bits
+
+    def filter_bits(self, disk_key):
+        bits = 8 * len(self.filter)
+        h = hash(disk_key)
+        return h % bits, (h // bits) % bits
+
+    def add_to_filter(self, disk_key):
+        for bit in self.filter_bits(disk_key):
+            self.filter[bit >> 3] |= 1 << (bit & 7)
+
+    def grow_filter(self):
+        self.new_filter(2 * self.spilled)
+        for disk_key in self.db.execute("SELECT rule, position FROM memo"):
+            self.add_to_filter(disk_key)
+
+    def may_be_on_disk(self, key):
+        position, rule = key
+        if rule not in self.rule_numbers:
+            return False
+        for bit in self.filter_bits((self.rule_numbers[rule], position)):
+            if not self.filter[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        if key in self.recent:
+            return True
+        if not self.spilled or not self.may_be_on_disk(key):
+            return False
+        row = self.db.execute("SELECT result FROM memo "
+                              "WHERE rule = ? AND position = ?",
+                              self.disk_key(key)).fetchone()
+        if row is None:
+            return False
+        self.found = key, self.loads(row[0])
+        return True
+
+    def __getitem__(self, key):
+        if key in self.recent:
+            return self.recent[key]
+        if (self.found is None or self.found[0] != key) and key not in self:
+            raise KeyError(key)
+        self.disk_hits += 1
+        return self.found[1]
+
+    def __setitem__(self, key, value):
+        self.recent[key] = value
+        if len(self.recent) > self.limit:
+            self.spill()
+
+    def __len__(self):
+        return len(self.recent) + self.spilled
+
+    def spill(self):
+        import itertools
+        items = iter(self.recent.items())
+        older = list(itertools.islice(items, max(1, len(self.recent) // 2)))
+        self.recent = dict(items)
+        rows = []
+        for key, value in older:
+            disk_key = self.disk_key(key)
+            self.add_to_filter(disk_key)
+            # (marshal doesn't do spans)
+            end, result, switch = value
+            rows.append(disk_key +
+                        (self.dumps((end, text_of(result), switch)),))
+        self.db.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?)",
+                            rows)
+        self.spilled += len(rows)
+        if self.spilled > self.capacity:
+            self.grow_filter()
+
+    def clear(self):
+        self.recent.clear()
+        if self.spilled:
+            self.db.execute("DELETE FROM memo")
+            self.new_filter(self.expected)
+            self.spilled = 0
+        self.found = None
+''')
+
+#-------------------------------------------------------
+# Adaptive memoising, for --adapt-memo. Plenty of rules are hardly ever
+# called twice at the same position, so storing their results in the
+# memo costs time and memory for nothing. We memoise everything for the
+# first ADAPT_after instructions, then look at what each rule has put in
+# RULE_USE_CACHE and how often that was used, and give up on the rules
+# whose hits are under ADAPT_ratio of their entries (as long as they had
+# at least ADAPT_entries, so we know). Their entries are thrown away.
+#
+# The output can't change, since a rule parses the same way each time at
+# the same position (its GEN labels are new ones, but they're numbered in
+# the output, so that's the same too). We always memoise --split-rule,
+# though, whose results the --parallel workers put in the memo.
+
+ADAPT_after = 20000
+ADAPT_ratio = 0.02
+ADAPT_entries = 50
+
+def adapt_memo():
+    global RULE_USE_CACHE, MEMO_adapted
+    MEMO_adapted = True
+    entries = {}
+    for _, rule in RULE_USE_CACHE:
+        entries[rule] = entries.get(rule, 0) + 1
+    for rule, count in entries.items():
+        if count >= ADAPT_entries and rule != SPLIT_rule and \
+           MEMO_hits_of.get(rule, 0) < ADAPT_ratio * count:
+            UNMEMOISED.add(rule)
+    if UNMEMOISED:
+        RULE_USE_CACHE = {key: value
+                          for key, value in RULE_USE_CACHE.items()
+                          if key[1] not in UNMEMOISED}
+    if PROFILE:
+        for rule in sorted(UNMEMOISED):
+            report_profile([("memo-off", "<%s> %d hits for %d entries" %
+                             (rule, MEMO_hits_of.get(rule, 0),
+                              entries[rule]))])
+
+#-------------------------------------------------------
+# Limits: every CHECK_INTERVAL instructions (or sooner, if that would
+# take us past --max-steps) we look at the clock and the memo size too.
+
+CHECK_INTERVAL = 1000
+
+def limit_exceeded(message):
+    # Like show_place_of_error, but we also say which rules we were in
+    newline = "\n" if isinstance(INPUT, str) else b"\n"
+    line = INPUT.count(newline, 0, INPUT_position) + 1
+    column = INPUT_position - INPUT.rfind(newline, 0, INPUT_position)
+    text = "... " + \
+           input_text(INPUT_position - 60, INPUT_position) + "\n" + \
+           "***LIMIT: " + message + "\n" + \
+           "***AT: line %d, column %d\n" % (line, column) + \
+           "***HERE:\n" + \
+               input_text(INPUT_position, INPUT_position + 60) + " ...\n"
+    # innermost rule first, ignoring the bottom stackframe
+    text += "in <" + RULE + "> "
+    for _, rule, _ in reversed(CALL_STACK[1:]):
+        text += "in <" + rule + "> "
+    print(text, file=sys.stderr)
+    sys.exit(LIMIT_EXIT_STATUS)
+
+def check_limits(steps, started):
+    if not MEMO_adapted and steps >= ADAPT_after:
+        adapt_memo()
+    if MAX_STEPS is not None and steps >= MAX_STEPS:
+        limit_exceeded("Instruction limit (%d) exceeded" % MAX_STEPS)
+    if MAX_SECONDS is not None and time.monotonic() - started > MAX_SECONDS:
+        limit_exceeded("Time limit (%gs) exceeded" % MAX_SECONDS)
+    if MAX_MEMO is not None and len(RULE_USE_CACHE) > MAX_MEMO:
+        limit_exceeded("Memo limit (%d entries) exceeded" % MAX_MEMO)
+
+#-------------------------------------------------------
+# All that's left is to run it ...
+
+def run(rule=None, spent=(0, 0.0)):
+    # Run the program from the start, or just parse one rule (when PC is
+    # None, so that its R stops us). spent is the (instructions, seconds)
+    # of this input's limits already used up, by an earlier run.
+    global PC
+    started = time.monotonic() - spent[1]
+    steps = spent[0]
+    next_check = steps + CHECK_INTERVAL
+    if MAX_STEPS is not None:
+        next_check = min(next_check, MAX_STEPS)
+    instruction = PROGRAM[0] if rule is None else (ADR, rule)
+    while True:
+        fun, args = instruction[0], instruction[1:]
+        fun(*args)
+        if PC == None:
+            break
+        steps += 1
+        if steps >= next_check:
+            check_limits(steps, started)
+            next_check = steps + CHECK_INTERVAL
+            if MAX_STEPS is not None:
+                next_check = min(next_check, MAX_STEPS)
         instruction = PROGRAM[PC]
         PC += 1
+        # skip over labels
+        while isinstance(instruction, str):
+            instruction = PROGRAM[PC]
+            PC += 1
+    return steps, time.monotonic() - started
 
-# If the parse failed, show the high water mark
-if not SWITCH:
-    text = INPUT[max(0, HWM_position - 60):HWM_position] + "\n" + \
-            "***ERROR: Syntax error\n***HERE:\n" + \
-               INPUT[HWM_position:HWM_position + 60] + " ...\n"
-    HWM_rules.reverse()
-    for rule in HWM_rules[:-1]:
-        text += "in <" + rule + "> "
-    error(text)
+def run_compact(opcodes, operands, constants, rule=None, spent=(0, 0.0)):
+    # The same, for the compact form: no labels to skip, and no tuples
+    # to take apart
+    global PC
+    started = time.monotonic() - spent[1]
+    steps = spent[0]
+    next_check = steps + CHECK_INTERVAL
+    if MAX_STEPS is not None:
+        next_check = min(next_check, MAX_STEPS)
+    instructions = INSTRUCTIONS
+    if rule is None:
+        instructions[opcodes[0]](*constants[operands[0]])
+    else:
+        ADR(rule)
+    while PC is not None:
+        steps += 1
+        if steps >= next_check:
+            check_limits(steps, started)
+            next_check = steps + CHECK_INTERVAL
+            if MAX_STEPS is not None:
+                next_check = min(next_check, MAX_STEPS)
+        pc = PC
+        PC = pc + 1
+        instructions[opcodes[pc]](*constants[operands[pc]])
+    return steps, time.monotonic() - started
+
+# The parse makes lots of lists and tuples, but never a cycle of them,
+# so the garbage collector would only be looking through everything
+# we've built, again and again, for nothing. (In a long parse that's a
+# lot of looking.) So it's off while we parse and write the output,
+# unless --gc. But the collector belongs to the whole process, so we
+# only touch it when it's ours (GC_owned, in the header): when we're
+# the program being run, or a worker of metaphor-prefork.py or
+# metaphor-daemon.py, but not when we've been loaded into someone
+# else's program (see load_library() in metaphor_tools.py).
+
+def pause_collector():
+    # Returns what resume_collector() has to undo
+    import gc
+    counting = PROFILE and count_collection not in gc.callbacks
+    if counting:
+        gc.callbacks.append(count_collection)
+    paused = not KEEP_GC and GC_owned and gc.isenabled()
+    if paused:
+        gc.disable()
+    return paused, counting
+
+def resume_collector(undo):
+    import gc
+    paused, counting = undo
+    if paused:
+        gc.enable()
+    if counting:
+        gc.callbacks.remove(count_collection)
+
+def execute(rule=None, spent=(0, 0.0)):
+    paused = pause_collector()
+    try:
+        if COMPACT:
+            return run_compact(OPCODES, OPERANDS, CONSTANTS, rule, spent)
+        return run(rule, spent)
+    finally:
+        resume_collector(paused)
 
+def count_collection(phase, info):
+    # For --profile: how much time the garbage collector took
+    if phase == "start":
+        GC_work[2] = time.perf_counter()
+    else:
+        GC_work[0] += 1
+        GC_work[1] += time.perf_counter() - GC_work[2]
+
+#-------------------------------------------------------
+# Parallel parsing, for --parallel. If an input is mostly a long run of
+# one rule (like <st> in a grammar, or <as> in aexp), each of which ends
+# with a separator (like ";"), we can guess where they start by looking
+# for the separator, and have worker processes parse the rule from there
+# in chunks of the input, while we wait. Their results go in the memo,
+# and then we parse the input as usual, but find most of it done.
+#
+# A bad guess (a ";" in a string, say) costs time but not correctness:
+# a result is only used where the parse calls the rule at that position,
+# and a rule parses the same wherever it's called from. GEN labels are
+# only numbered in the output, so it doesn't matter who made them, as
+# long as each worker makes different ones (see GEN_source).
+
+DEFERRED["parallel"] = deferred(r'''
+SPLICES = {}    # (position, rule) -> (end, output, high water)
+
+def split_points(chunks):
+    # Where to start chunks: just after a separator, about evenly spaced
+    separator = SPLIT_at.encode("latin-1") if BYTES else SPLIT_at
+    points = [0]
+    for k in range(1, chunks):
+        at = INPUT.find(separator, max(points[-1], len(INPUT) * k // chunks))
+        if at < 0:
+            break
+        points.append(at + len(separator))
+    points.append(len(INPUT))
+    return sorted(set(points))
+
+def parse_chunk(begin, end):
+    # In a worker: parse SPLIT_rule over and over from begin, until we
+    # get to end (or it fails), and return what each one made
+    global INPUT_position, HWM_position, HWM_rules
+    results = []
+    position = begin
+    while position < end:
+        INPUT_position = position
+        HWM_position, HWM_rules = position, None
+        execute(SPLIT_rule)
+        if not SWITCH or INPUT_position == position:
+            break
+        # the rules it got furthest in, apart from our own frame
+        high_water = None if HWM_rules is None else \
+                     (HWM_position, HWM_rules[1:])
+        results.append((position, INPUT_position, RETVAL, high_water))
+        position = INPUT_position
+    return results
+
+def parallel_worker(number, chunks, queue):
+    global GEN_source
+    GEN_source = number + 1
+    sys.stderr = io.StringIO()  # we'll find any errors again in the parent
+    results = []
+    for begin, end in chunks:
+        try:
+            results.extend(parse_chunk(begin, end))
+        except (Exception, SystemExit):
+            pass
+    queue.put(results)
+
+def parallel_pass():
+    lookup(SPLIT_rule)
+    SPLICES.clear()
+    import multiprocessing
+    points = split_points(4 * PARALLEL)
+    chunks = list(zip(points, points[1:]))
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    workers = [context.Process(target=parallel_worker,
+                               args=(number, chunks[number::PARALLEL],
+                                     queue))
+               for number in range(PARALLEL)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        for position, end, output, high_water in queue.get():
+            key = (position, SPLIT_rule)
+            SPLICES[key] = (end, output, high_water)
+            RULE_USE_CACHE[key] = (end, SPLICED, True)
+    for worker in workers:
+        worker.join()
+
+def splice(key):
+    # CALL found a worker's result: make it as though we'd just parsed it
+    global RETVAL, HWM_position, HWM_rules
+    end, RETVAL, high_water = SPLICES.pop(key)
+    if high_water is not None and high_water[0] > HWM_position:
+        HWM_position = high_water[0]
+        HWM_rules = [rule for _, rule, _ in CALL_STACK] + [RULE] + \
+                    high_water[1]
+    RULE_USE_CACHE[key] = (end, RETVAL, True)
+''')
+
+#-------------------------------------------------------
 # Tidy up the output
 def flatten(xs):
     for x in xs:
@@ -1809,24 +3820,280 @@ def flatten(xs):
         else:
             yield x
 
-margin = 0
-line_start = True
-for item in flatten(RETVAL):
-    if isinstance(item, int):
-        if item == 0:
-            # Newline marker
-            sys.stdout.write("\n")
-            line_start = True
+def write_output(out):
+    paused = pause_collector()
+    try:
+        if BYTES:
+            write_bytes(out, flatten(RETVAL))
+        else:
+            write_items(out, flatten(RETVAL))
+    finally:
+        resume_collector(paused)
+
+def write_items(out, items):
+    margin = 0
+    line_start = True
+    for item in items:
+        if isinstance(item, tuple):
+            # a GEN label, numbered when we first see it
+            item = GEN_numbers.setdefault(
+                item, str(GEN_counted + len(GEN_numbers) + 1))
+        elif isinstance(item, slice):
+            # a span of the input (see spanned())
+            item = INPUT[item]
+        if isinstance(item, int):
+            if item == 0:
+                # Newline marker
+                out.write("\n")
+                line_start = True
+            else:
+                margin = max(0, margin + item)
+        elif isinstance(item, (str, bytes)):
+            # (bytes only with --bytes, from a span which has been
+            # through the spilled memo)
+            if len(item) > 0:
+                if line_start:
+                    out.write(" " * margin)
+                line_start = False
+                out.write(item)
         else:
-            margin = max(0, margin + item)
-    elif isinstance(item, str):
-        if len(item) > 0:
-            if line_start:
-                sys.stdout.write(" " * margin)
-            line_start = False
-            sys.stdout.write(item)
+            error("+++ Internal problem:", item)
+
+class ByteWriter:
+    # Just enough of a file for write_items(), which keeps what's
+    # written as bytes
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.encode("latin-1")
+        self.parts.append(text)
+
+def write_bytes(out, items):
+    # For --bytes: the output as Latin-1, with spans just as they are in
+    # the input, written all at once (as text, if out only takes text)
+    writer = ByteWriter()
+    try:
+        write_items(writer, items)
+    except UnicodeEncodeError:
+        error("+++ With --bytes, the output has to be Latin-1")
+    data = b"".join(writer.parts)
+    if hasattr(out, "buffer"):
+        out.flush()
+        out.buffer.write(data)
     else:
-        error("+++ Internal problem:", item)
+        out.write(data.decode("latin-1"))
 
+def report_profile(figures):
+    # With --profile, say how much work that was (one "+++ profile:" line
+    # per figure, so that the benchmark can pick them out of stderr)
+    for what, value in figures:
+        print("+++ profile:", what, value, file=sys.stderr)
 
-    
+def syntax_error_text():
+    # The parse failed, so show the high water mark
+    text = input_text(HWM_position - 60, HWM_position) + "\n" + \
+            "***ERROR: Syntax error\n***HERE:\n" + \
+               input_text(HWM_position, HWM_position + 60) + " ...\n"
+    HWM_rules.reverse()
+    for rule in HWM_rules[:-1]:
+        text += "in <" + rule + "> "
+    return text
+
+def syntax_error():
+    error(syntax_error_text())
+
+#-------------------------------------------------------
+# Streams, for --stream=RULE: the input is just RULE over and over (like
+# the assignments of aexp), perhaps for ever, so we don't read it all
+# first. INPUT is a window on it, which we read more of when we need to.
+# We parse RULE from where the last one ended, write out what it made
+# straight away, and forget everything about it (the memo included), so
+# we only ever hold about one RULE's worth, however long the stream is.
+#
+# How do we know the window was big enough? While we're streaming,
+# have_char() notes when it's asked about the end of the window: if it
+# never was, more input couldn't have made any difference. If it was, we
+# read some more and parse that RULE again.
+#
+# Each RULE's output starts with the margin at 0 (so they should leave
+# it there anyway), the limits are for each RULE rather than the whole
+# stream, and the stream must end with RULE, give or take whitespace.
+
+DEFERRED["stream"] = deferred(r'''
+STREAM_block = 65536
+WINDOW_short = False
+
+def have_char_in_window():
+    global WINDOW_short
+    if INPUT_position < len(INPUT):
+        return True
+    WINDOW_short = True
+    return False
+
+def read_more():
+    # Returns False at the end of the input. We take whatever has come
+    # (up to STREAM_block bytes) rather than wait for a whole block, so
+    # that a record is written as soon as all of it is there.
+    global INPUT
+    sys.stdout.flush()  # anyone waiting for output shouldn't wait for us
+    data = INPUT_file.buffer.read1(STREAM_block)
+    INPUT += INPUT_decoder.decode(data, final=not data)
+    return data != b""
+
+def parse_stream():
+    global INPUT, INPUT_position, HWM_position, HWM_rules, GEN_counted
+    global WINDOW_short, have_char
+    have_char = have_char_in_window
+    lookup(STREAM_rule)
+    steps = records = chars = window = 0
+    started = time.monotonic()
+    at = 0
+    while True:
+        while True:
+            INPUT_position = at
+            HWM_position, HWM_rules = at, []
+            RULE_USE_CACHE.clear()
+            WINDOW_short = False
+            steps += execute(STREAM_rule)[0]
+            if not WINDOW_short or not read_more():
+                break
+        window = max(window, len(INPUT))
+        if not SWITCH or INPUT_position == at:
+            break
+        write_output(sys.stdout)
+        records += 1
+        # a record's labels can't turn up in a later one, so only their
+        # count needs keeping
+        GEN_counted += len(GEN_numbers)
+        GEN_numbers.clear()
+        at = INPUT_position
+        # drop what we've done with, now and again
+        if at >= STREAM_block:
+            chars += at
+            INPUT = INPUT[at:]
+            at = 0
+    if PROFILE:
+        report_profile([("instructions", steps),
+                        ("seconds", "%.6f" % (time.monotonic() - started)),
+                        ("chars", chars + len(INPUT)),
+                        ("records", records),
+                        ("largest-window", window),
+                        ("memo-hits", MEMO_hits),
+                        ("gc-collections", GC_work[0]),
+                        ("gc-seconds", "%.6f" % GC_work[1])])
+    # nothing but whitespace should be left
+    INPUT = INPUT[at:]
+    HWM_position -= at
+    while not INPUT.strip():
+        INPUT, HWM_position, HWM_rules = "", 0, []
+        if not read_more():
+            return
+    syntax_error()
+''')
+
+#-------------------------------------------------------
+
+def parse():
+    # The whole job for one input, which start() (in the header) has
+    # read: run the program and write out the result
+    global RULE_USE_CACHE, TEXT_spans
+    lexing = None
+    if TEXT_patterns is None and wants_patterns(len(INPUT)):
+        make_patterns()
+    if TOKEN_pattern and not (NO_TOKENS or STREAM_rule):
+        lexing = tokenise()
+    if TEXT_patterns and not (NO_SPANS or STREAM_rule):
+        TEXT_spans = TEXT_patterns
+    if MEMO_spill:
+        need("memo-spill")
+        RULE_USE_CACHE = TieredMemo(MEMO_spill)
+    if STREAM_rule:
+        need("stream")
+        parse_stream()
+        return
+    if PARALLEL:
+        need("parallel")
+        parallel_pass()
+    # (what the parse leaves allocated: its memo, its output, and
+    # anything it didn't let go of, which --profile reports)
+    blocks = sys.getallocatedblocks()
+    steps, seconds = execute()
+    blocks = sys.getallocatedblocks() - blocks
+
+    if PROFILE:
+        report_profile([("instructions", steps),
+                        ("seconds", "%.6f" % seconds),
+                        ("chars", len(INPUT)),
+                        ("memo-entries", len(RULE_USE_CACHE)),
+                        ("memo-hits", MEMO_hits),
+                        ("allocated-blocks", blocks),
+                        ("gc-collections", GC_work[0]),
+                        ("gc-seconds", "%.6f" % GC_work[1])])
+        if MEMO_spill:
+            report_profile([("memo-spilled", RULE_USE_CACHE.spilled),
+                            ("memo-disk-hits", RULE_USE_CACHE.disk_hits),
+                            ("memo-filter-bytes",
+                             len(RULE_USE_CACHE.filter))])
+        if lexing is not None:
+            report_profile([("lex-seconds", "%.6f" % lexing),
+                            ("lex-tokens", len(TOKEN_starts)),
+                            ("lex-hits", LEX_hits)])
+        elif TOKEN_problem:
+            report_profile([("lex-off", TOKEN_problem)])
+        elif TOKEN_rules and TEXT_patterns is None:
+            report_profile([("lex-off", "the input is too small to bother")])
+        if TEXT_spans:
+            report_profile([("span-rules", len(TEXT_spans)),
+                            ("span-hits", SPAN_hits)])
+
+    if not SWITCH and (lexing is not None or TEXT_spans):
+        # again without the tokens and spans, for the high water mark,
+        # with only what's left of the limits
+        start(None, INPUT)
+        execute(spent=(steps, seconds))
+    if not SWITCH:
+        syntax_error()
+
+    if EMIT_BYTECODE_name is None and not emits_program():
+        write_output(sys.stdout)
+        return
+
+    # Our output is a program, which we check as it'll be checked when
+    # it's loaded, so that what's wrong with it is found now (and is the
+    # grammar's fault). With --emit-bytecode we then write it out in the
+    # form --bytecode reads.
+    out = io.StringIO()
+    write_output(out)
+    try:
+        emitted = eval("[\n" + out.getvalue() + "]\n", globals())
+    except Exception:
+        if EMIT_BYTECODE_name is None:
+            error("+++ Our output looks like a Metaphor program, but isn't")
+        error("+++ Our output isn't a Metaphor program, so it can't be "
+              "written as bytecode")
+    if "*whitespace*" not in emitted:
+        emitted.extend(whitespace_code)
+    names = {}
+    need("verify")
+    verify(*program_code(allocate_slots(emitted, names)), names)
+    if EMIT_BYTECODE_name is None:
+        write_output(sys.stdout)
+        return
+    need("bytecode")
+    write_bytecode(emitted, EMIT_BYTECODE_name)
+
+def emits_program():
+    # Whether our output is a Metaphor program, as metaphor-compiler.py's
+    # is: a program starts with an ADR of its first rule
+    for item in flatten(RETVAL):
+        if isinstance(item, int) or item == "":
+            continue
+        return isinstance(item, str) and item.lstrip().startswith("(ADR, ")
+    return False
+
+# Loaded as a library (see metaphor-prefork.py), everything is ready to
+# go but it's up to our caller to start() and parse() each input.
+if __name__ != "__metaphor_library__":
+    parse()
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+# Cross-engine conformance: run the same compilers over the same inputs
+# with each execution engine (or optimisation setting) of the runtime, and
+# check that stdout, stderr and the exit status are byte-for-byte the same
+# as with the reference engine (the first in ENGINES). That covers GEN
+# label numbering and the high-water mark in syntax error messages too.
+# We also report each engine's speed and memory relative to the reference.
+#
+# The inputs are the example files, random ones from metaphor-generate.py
+# and truncated copies of the examples (to get syntax errors).
+
+import argparse
+import atexit
+import difflib
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from metaphor_tools import HERE, COMPILER, error, build_compiler, \
+     build_bytecode, run_measured
+
+CLIENT = os.path.join(HERE, "metaphor-client.py")
+DAEMON = os.path.join(HERE, "metaphor-daemon.py")
+
+# Each engine is the runtime options which select it. Add new engines and
+# optimisations here as they arrive. "{bytecode}" stands for the
+# compiler's grammar compiled with --emit-bytecode, and "{split_rule}"
+# and "{split_at}" for where its inputs can be split (see SUITE).
+# "{daemon}" runs it through metaphor-client.py, with a daemon of our own
+# (so the rss is the client's).
+ENGINES = [
+    ("tuple", []),
+    # the limit checks shouldn't change anything while they're not hit
+    ("limits", ["--max-steps=1000000000", "--max-seconds=86400",
+                "--max-memo=1000000000"]),
+    ("fused", ["--fuse"]),
+    ("inlined", ["--inline"]),
+    ("inlined+fused", ["--inline", "--fuse"]),
+    ("compact", ["--compact"]),
+    ("compact+all", ["--compact", "--inline", "--fuse"]),
+    ("bytecode", ["--bytecode={bytecode}", "--compact"]),
+    ("parallel", ["--parallel=3", "--split-rule={split_rule}",
+                  "--split-at={split_at}"]),
+    # a tiny memo in memory, so that most of it is on disk
+    ("spilled-memo", ["--memo-spill=50"]),
+    ("adaptive-memo", ["--adapt-memo"]),
+    # the lexer and spans, which otherwise wait for a bigger input than
+    # we have (see make_patterns())
+    ("patterns", ["--patterns-from=0"]),
+    # the grammar's TOKENS parsed a character at a time, like the rest
+    ("no-tokens", ["--no-tokens", "--patterns-from=0"]),
+    # and the rules which only match text too (see spanned())
+    ("no-spans", ["--no-tokens", "--no-spans"]),
+    # the input as bytes, with and without the instructions which look
+    # at a character at a time
+    ("bytes", ["--bytes", "--patterns-from=0"]),
+    ("bytes+all", ["--bytes", "--no-tokens", "--no-spans", "--inline",
+                   "--fuse"]),
+    ("bytes+bytecode", ["--bytes", "--bytecode={bytecode}", "--compact",
+                        "--memo-spill=50", "--patterns-from=0"]),
+    ("daemon", ["{daemon}"]),
+    ("daemon+bytes", ["{daemon}", "--bytes", "--patterns-from=0"]),
+]
+
+# Compilers to try (None means metaphor-compiler.py itself), what they
+# compile, the grammar to generate random input from, and the rule and
+# separator for --parallel
+SUITE = [
+    ("metaphor", None,
+     ["metaphor-grammar.txt", "aexp-grammar.txt", "test-grammar.txt"],
+     "metaphor-grammar.txt", ("st", ";")),
+    ("aexp", "aexp-grammar.txt", ["aexp-example.txt"], "aexp-grammar.txt",
+     ("as", ";")),
+    ("test", "test-grammar.txt", ["test-example.txt"], "test-grammar.txt",
+     ("as", ";")),
+    # rules whose REPEATs return their last character twice (see
+    # rule_pieces() in the runtime trailer)
+    ("repeat", "repeat-grammar.txt", ["repeat-example.txt"],
+     "repeat-grammar.txt", ("item", ";")),
+]
+
+parser = argparse.ArgumentParser(
+    description="Check that every runtime engine gives identical results")
+parser.add_argument("--engines", default="",
+                    help="comma-separated engines to try (default: all)")
+parser.add_argument("--seeds", type=int, default=3,
+                    help="random inputs per compiler")
+parser.add_argument("--size", type=int, default=5000,
+                    help="size of the random inputs")
+parser.add_argument("--repeat", type=int, default=1,
+                    help="runs per case for timing (we keep the fastest)")
+parser.add_argument("--show", type=int, default=20,
+                    help="lines of diff to show for each mismatch")
+ARGS = parser.parse_args()
+
+WORK = tempfile.mkdtemp(prefix="metaphor-conform-")
+atexit.register(shutil.rmtree, WORK, True)
+
+if ARGS.engines:
+    known = dict(ENGINES)
+    for name in ARGS.engines.split(","):
+        if name not in known:
+            error("No such engine: %s (try %s)" %
+                  (name, ", ".join(known)))
+    # always compare against the reference engine
+    engines = [ENGINES[0]] + [(name, known[name])
+                              for name in ARGS.engines.split(",")
+                              if name != ENGINES[0][0]]
+else:
+    engines = ENGINES
+
+#--------------------------------------------------------
+# The cases
+
+def generate(grammar, seed, output):
+    status = subprocess.call(
+        [sys.executable, os.path.join(HERE, "metaphor-generate.py"),
+         os.path.join(HERE, grammar), "--seed=%d" % seed,
+         "--size=%d" % ARGS.size, "--output=" + output])
+    if status != 0:
+        error("+++ Couldn't generate input from", grammar)
+
+def truncated(name, output):
+    with open(os.path.join(HERE, name)) as fin:
+        text = fin.read()
+    with open(output, "w") as fout:
+        fout.write(text[:len(text) // 2])
+
+def cases():
+    # (name, compiler, what to put in the options, input file)
+    for kind, grammar, examples, generator_grammar, split in SUITE:
+        if grammar is None:
+            compiler = COMPILER
+        else:
+            compiler = build_compiler(os.path.join(HERE, grammar), WORK, kind)
+        bytecode = build_bytecode(
+            os.path.join(HERE, grammar or "metaphor-grammar.txt"),
+            os.path.join(WORK, kind + ".mbc"))
+        fill = {"{bytecode}": bytecode, "{split_rule}": split[0],
+                "{split_at}": split[1]}
+        for example in examples:
+            yield "%s/%s" % (kind, example), compiler, fill, \
+                  os.path.join(HERE, example)
+            broken = os.path.join(WORK, "%s-half-%s" % (kind, example))
+            truncated(example, broken)
+            yield "%s/half-%s" % (kind, example), compiler, fill, broken
+        for seed in range(ARGS.seeds):
+            random_input = os.path.join(WORK, "%s-random-%d.txt" % (kind, seed))
+            generate(generator_grammar, seed, random_input)
+            yield "%s/random-%d" % (kind, seed), compiler, fill, \
+                  random_input
+
+#--------------------------------------------------------
+# Run everything with every engine
+
+DAEMON_socket = None
+
+def daemon_socket():
+    # Start our daemon, the first time it's wanted. The client would
+    # quietly run the compiler itself if it couldn't connect, so we
+    # wait until it can.
+    global DAEMON_socket
+    if DAEMON_socket is None:
+        DAEMON_socket = os.path.join(WORK, "daemon.sock")
+        daemon = subprocess.Popen(
+            [sys.executable, DAEMON, "--socket=" + DAEMON_socket,
+             "--workers=2"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # (^C, which it takes as the signal to stop its workers too)
+        atexit.register(daemon.wait)
+        atexit.register(daemon.send_signal, signal.SIGINT)
+        for _ in range(100):
+            if os.path.exists(DAEMON_socket):
+                break
+            time.sleep(0.1)
+        else:
+            error("+++ The daemon didn't start")
+    return DAEMON_socket
+
+def fastest(compiler, options, input_path):
+    if "{daemon}" in options:
+        options = ["--socket=" + daemon_socket(), compiler] + \
+                  [option for option in options if option != "{daemon}"]
+        compiler = CLIENT
+    best = None
+    for _ in range(max(1, ARGS.repeat)):
+        run = run_measured(compiler, options, input_path)
+        if best is None or run.seconds < best.seconds:
+            best = run
+    return best
+
+def show_difference(what, reference, other):
+    if what == "status":
+        print("    exit status %d, not %d" % (other, reference))
+        return
+    diff = difflib.unified_diff(
+        reference.decode(errors="replace").splitlines(),
+        other.decode(errors="replace").splitlines(),
+        "reference " + what, "this " + what, lineterm="")
+    for line in list(diff)[:ARGS.show]:
+        print("    " + line)
+
+totals = {name: [0, 0, 0.0, 0.0] for name, _ in engines}  # same, differ, secs, rss
+mismatches = 0
+def filled_in(option, fill):
+    for name, value in fill.items():
+        option = option.replace(name, value)
+    return option
+
+for case, compiler, fill, input_path in cases():
+    reference = None
+    for engine, options in engines:
+        options = [filled_in(option, fill) for option in options]
+        run = fastest(compiler, options, input_path)
+        if reference is None:
+            reference = run
+        total = totals[engine]
+        total[2] += run.seconds
+        total[3] += run.peak_rss_kb / max(1, reference.peak_rss_kb)
+        different = [what for what in ("status", "stdout", "stderr")
+                     if getattr(run, what) != getattr(reference, what)]
+        if different:
+            total[1] += 1
+            mismatches += 1
+            print("***MISMATCH: %s with engine %s" % (case, engine))
+            for what in different:
+                show_difference(what, getattr(reference, what),
+                                getattr(run, what))
+        else:
+            total[0] += 1
+
+#--------------------------------------------------------
+# Side by side
+
+reference_seconds = totals[engines[0][0]][2]
+print("%-14s %6s %6s %8s %8s" % ("engine", "same", "differ", "time", "rss"))
+for engine, _ in engines:
+    same, differ, seconds, rss = totals[engine]
+    print("%-14s %6d %6d %7.2fx %7.2fx" %
+          (engine, same, differ, seconds / max(reference_seconds, 1e-9),
+           rss / max(1, same + differ)))
+
+if mismatches:
+    sys.exit(1)
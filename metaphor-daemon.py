@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# A long-running server which runs Metaphor compilers for its clients,
+# so that they don't each pay for starting Python and loading a program.
+# metaphor-client.py is the client: "./metaphor-client.py aexp-compiler.py
+# file" does what "./aexp-compiler.py file" does.
+#
+# We listen on a Unix domain socket, which only our own user can connect
+# to (a grammar is Python code, so anyone who can send us one can run
+# anything as us), and handle connections with asyncio. The parses themselves are CPU
+# bound, so they go to a pool of worker processes, each of which keeps
+# the compilers it has loaded (with load_library(), ready to start() and
+# parse() an input, as metaphor-prefork.py does) in an LRU of --cache
+# entries, one for each compiler and its options. A compiler is
+# reloaded if its file changes.
+#
+# The protocol: a message is a 4-byte big-endian count of fields, then
+# each field as a 4-byte big-endian length and that many bytes of UTF-8
+# (but the stdout of a reply is the compiler's output as it is, which
+# with --bytes needn't be UTF-8).
+# A request is
+#
+#   "parse", the client's directory, compiler, input file, options ...
+#
+# (the worker runs the compiler in the client's directory, so relative
+# file names mean what the client meant by them), and the reply is
+#
+#   exit status (in decimal), stdout, stderr
+#
+# A connection can carry any number of requests, one after the other.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import signal
+import struct
+import sys
+
+from metaphor_tools import error, read_compiler, load_library, captured
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                              "metaphor-%d.sock" % os.getuid())
+
+FIELD = struct.Struct(">I")
+
+#--------------------------------------------------------
+# In the workers
+
+LOADED = collections.OrderedDict()  # see load()
+CACHE_size = 16
+
+def start_worker(cache_size):
+    global CACHE_size
+    CACHE_size = cache_size
+    # the server deals with ^C, not us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def load(compiler, directory, options, name):
+    # The compiler's namespace. Options can name files relative to the
+    # client's directory (--bytecode's, say), so with options that's
+    # part of the key too.
+    stat = os.stat(compiler)
+    key = (compiler, stat.st_mtime_ns, stat.st_size, tuple(options),
+           directory if options else None)
+    if key in LOADED:
+        LOADED.move_to_end(key)
+        return LOADED[key]
+    namespace = load_library(*read_compiler(compiler), options=options,
+                             name=name, own_gc=True)
+    LOADED[key] = namespace
+    while len(LOADED) > CACHE_size:
+        LOADED.popitem(last=False)
+    return namespace
+
+def parse(directory, compiler, input_path, options):
+    def run():
+        try:
+            os.chdir(directory)
+            namespace = load(os.path.abspath(compiler), directory, options,
+                             compiler)
+        except (OSError, ValueError, SyntaxError) as problem:
+            error("+++ Can't load %s: %s" % (compiler, problem))
+        namespace["start"](input_path)
+        namespace["parse"]()
+    return captured(run)
+
+#--------------------------------------------------------
+# In the server
+
+async def read_message(reader):
+    count, = FIELD.unpack(await reader.readexactly(FIELD.size))
+    fields = []
+    for _ in range(count):
+        length, = FIELD.unpack(await reader.readexactly(FIELD.size))
+        fields.append((await reader.readexactly(length)).decode("utf-8"))
+    return fields
+
+def write_message(writer, fields):
+    parts = [FIELD.pack(len(fields))]
+    for field in fields:
+        # (captured() gives us any bytes which aren't UTF-8 as surrogates)
+        data = field.encode("utf-8", "surrogateescape")
+        parts += [FIELD.pack(len(data)), data]
+    writer.write(b"".join(parts))
+
+async def serve_client(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request = await read_message(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if len(request) >= 4 and request[0] == "parse":
+                directory, compiler, input_path = request[1:4]
+                status, stdout, stderr = await loop.run_in_executor(
+                    POOL, parse, directory, compiler, input_path, request[4:])
+                reply = [str(status), stdout, stderr]
+            else:
+                reply = ["1", "", "+++ Bad request\n"]
+            write_message(writer, reply)
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def main():
+    if os.path.exists(ARGS.socket):
+        os.unlink(ARGS.socket)
+    # (the socket is made with only our own permissions, rather than
+    # changed to them after it's already there)
+    umask = os.umask(0o077)
+    try:
+        server = await asyncio.start_unix_server(serve_client, ARGS.socket)
+    finally:
+        os.umask(umask)
+    print("Metaphor daemon listening on", ARGS.socket, file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+parser = argparse.ArgumentParser(
+    description="Serve Metaphor compilers to metaphor-client.py")
+parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                    help="Unix domain socket to listen on")
+parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="worker processes for the parses")
+parser.add_argument("--cache", type=int, default=16,
+                    help="compilers each worker keeps loaded")
+ARGS = parser.parse_args()
+
+POOL = concurrent.futures.ProcessPoolExecutor(
+    max_workers=ARGS.workers, mp_context=multiprocessing.get_context("fork"),
+    initializer=start_worker, initargs=(ARGS.cache,))
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
+finally:
+    POOL.shutdown()
+    if os.path.exists(ARGS.socket):
+        os.unlink(ARGS.socket)
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+# Generate random sentences from a Metaphor grammar, for load testing.
+#
+# We walk the grammar from its start rule, choosing alternatives and
+# repeat counts at random (from a fixed seed, so the same arguments give
+# the same output). Less than halfway to --max-depth, an alternative
+# which hasn't been used yet is taken first, so that even a rule which
+# the output only goes through once (like <tokens> in
+# metaphor-grammar.txt) leads somewhere new; after that, half the time
+# we pick whichever alternative has been used least so far, so every
+# alternative gets its turn. The deeper we are in nested calls, the more
+# often we take the shortest alternative and the fewer times REPEATs go
+# round; below --max-depth we always take the shortest way out, so
+# generation stops.
+# REPEATs in the start rule itself carry on until the output reaches
+# --size, which is how we make big inputs.
+#
+# Remember that a Metaphor grammar is a PEG: an earlier alternative can
+# sometimes match part of what we generated for a later one, so check
+# the output with --check (or by hand) before relying on it.
+
+import argparse
+import random
+import string
+import subprocess
+import sys
+
+import metaphor_grammar
+
+# Characters we use for ANY_BUT, minus the ones it excludes. (Punctuation
+# is asking for trouble: ANY_BUT '\'' must not produce a backslash.)
+SAFE_CHARS = string.ascii_letters + string.digits + " "
+
+INFINITY = float("inf")
+
+def error(*args):
+    print(*args, file=sys.stderr)
+    sys.exit(1)
+
+#--------------------------------------------------------
+# The shortest thing each node can produce, found by iterating until
+# nothing changes (recursive rules start off infinitely long)
+
+def shortest(node, lengths):
+    kind = node[0]
+    if kind == "alt":
+        return min(shortest(child, lengths) for child in node[1])
+    if kind == "seq":
+        return sum(shortest(child, lengths) for child in node[1])
+    if kind == "token":
+        return len(node[1]) + shortest(("call", "*whitespace*"), lengths)
+    if kind == "literal":
+        return len(node[1])
+    if kind in ("any_of", "any_but"):
+        return 1
+    if kind == "call":
+        return lengths.get(node[1], 1)
+    if kind in ("group", "store"):
+        return shortest(node[1], lengths)
+    return 0    # repeat, output, gen, empty
+
+def shortest_lengths(grammar):
+    lengths = {name: INFINITY for name in grammar.rules}
+    lengths["*whitespace*"] = 1
+    changed = True
+    while changed:
+        changed = False
+        for name, body in grammar.rules.items():
+            if name == "*whitespace*":
+                continue
+            length = shortest(body, lengths)
+            if length < lengths[name]:
+                lengths[name] = length
+                changed = True
+    return lengths
+
+def reachable(grammar):
+    # Rules we can get to from the start rule, other than through
+    # <*whitespace*> (which we never expand)
+    found = []
+    todo = [grammar.start]
+    while todo:
+        name = todo.pop()
+        if name in found or name not in grammar.rules or \
+           name == "*whitespace*":
+            continue
+        found.append(name)
+        todo.extend(metaphor_grammar.calls(grammar.rules[name]))
+    return found
+
+#--------------------------------------------------------
+# The generator
+
+class Generator:
+    def __init__(self, grammar, args):
+        self.grammar = grammar
+        self.random = random.Random(args.seed)
+        self.size = args.size
+        self.max_depth = args.max_depth
+        self.max_repeat = args.max_repeat
+        self.lengths = shortest_lengths(grammar)
+        for name, length in self.lengths.items():
+            if length == INFINITY:
+                error("Rule <%s> can never finish" % name)
+        # every alternative we might choose, numbered within its rule
+        self.usage = {}
+        self.names = {}
+        for name in reachable(grammar):
+            body = grammar.rules[name]
+            alts = [node for node in metaphor_grammar.walk(body)
+                    if node[0] == "alt"]
+            for number, alt in enumerate(alts):
+                for branch, _ in enumerate(alt[1]):
+                    self.usage[id(alt), branch] = 0
+                    self.names[id(alt), branch] = (name, number + 1, branch + 1)
+        self.output = []
+        self.length = 0
+
+    def emit(self, text):
+        self.output.append(text)
+        self.length += len(text)
+
+    def whitespace(self):
+        # <*whitespace*> is where tokens get separated; one space will do
+        self.emit(" ")
+
+    def choose(self, alt, depth):
+        # the deeper we are, the more likely we take the shortest way out
+        branches = range(len(alt[1]))
+        unused = [b for b in branches if self.usage.get((id(alt), b)) == 0]
+        if unused and depth < self.max_depth // 2:
+            return unused[0]
+        if self.random.random() * self.max_depth < depth:
+            return min(branches,
+                       key=lambda b: shortest(alt[1][b], self.lengths))
+        if self.random.random() < 0.5:
+            return min(branches, key=lambda b: self.usage.get((id(alt), b), 0))
+        return self.random.choice(branches)
+
+    def repeats(self, depth):
+        # fewer the deeper we are, or recursion through REPEAT explodes
+        if depth >= self.max_depth:
+            return 0
+        most = self.max_repeat * (self.max_depth - depth) // self.max_depth
+        return self.random.randint(0, most)
+
+    def generate(self, node, depth, filling):
+        kind = node[0]
+        if kind == "alt":
+            branch = self.choose(node, depth)
+            if (id(node), branch) in self.usage:
+                self.usage[id(node), branch] += 1
+            self.generate(node[1][branch], depth, filling)
+        elif kind == "seq":
+            for child in node[1]:
+                self.generate(child, depth, filling)
+        elif kind == "token":
+            self.whitespace()
+            self.emit(node[1])
+        elif kind == "literal":
+            self.emit(node[1])
+        elif kind == "any_of":
+            self.emit(self.random.choice(node[1]))
+        elif kind == "any_but":
+            allowed = [c for c in SAFE_CHARS if c not in node[1]]
+            self.emit(self.random.choice(allowed))
+        elif kind == "call":
+            self.call(node[1], depth + 1)
+        elif kind in ("group", "store"):
+            self.generate(node[1], depth, filling)
+        elif kind == "repeat":
+            if filling:
+                # repeat until we're big enough (or stop growing)
+                while self.length < self.size:
+                    before = self.length
+                    self.generate(node[1], depth, False)
+                    if self.length == before:
+                        break
+            else:
+                for _ in range(self.repeats(depth)):
+                    self.generate(node[1], depth, False)
+        # output, gen and empty produce no input
+
+    def call(self, name, depth):
+        if name == "*whitespace*":
+            self.whitespace()
+        elif name in self.grammar.rules:
+            self.generate(self.grammar.rules[name], depth, False)
+        else:
+            error("No such rule: <%s>" % name)
+
+    def run(self):
+        start = self.grammar.rules.get(self.grammar.start)
+        if start is None:
+            error("No such rule: <%s>" % self.grammar.start)
+        self.generate(start, 0, True)
+        self.emit("\n")
+        return "".join(self.output)
+
+    def unused(self):
+        return sorted(self.names[key] for key, count in self.usage.items()
+                      if count == 0)
+
+#--------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    description="Generate random input from a Metaphor grammar")
+parser.add_argument("grammar", help="the grammar file")
+parser.add_argument("--size", type=int, default=1000,
+                    help="keep going until the output is this many chars")
+parser.add_argument("--seed", type=int, default=0,
+                    help="random seed")
+parser.add_argument("--max-depth", type=int, default=12,
+                    help="beyond this many nested calls, finish quickly")
+parser.add_argument("--max-repeat", type=int, default=3,
+                    help="most iterations of a REPEAT (outside the start rule)")
+parser.add_argument("--output", help="write here rather than to stdout")
+parser.add_argument("--coverage", action="store_true",
+                    help="list alternatives that were never used on stderr")
+parser.add_argument("--check", metavar="COMPILER",
+                    help="run this compiler on the output to check it")
+ARGS = parser.parse_args()
+
+try:
+    GRAMMAR = metaphor_grammar.read_grammar_file(ARGS.grammar)
+except metaphor_grammar.GrammarError as problem:
+    error(ARGS.grammar + ":", problem)
+
+generator = Generator(GRAMMAR, ARGS)
+text = generator.run()
+
+if ARGS.output:
+    with open(ARGS.output, "w") as fout:
+        fout.write(text)
+else:
+    sys.stdout.write(text)
+
+if ARGS.coverage:
+    for rule, alt, branch in generator.unused():
+        print("Unused: <%s> choice %d, alternative %d" % (rule, alt, branch),
+              file=sys.stderr)
+
+if ARGS.check:
+    if not ARGS.output:
+        error("--check needs --output")
+    status = subprocess.call([sys.executable, ARGS.check, ARGS.output],
+                             stdout=subprocess.DEVNULL)
+    if status != 0:
+        error("+++ %s rejected %s" % (ARGS.check, ARGS.output))
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+# Check that metaphor_grammar.py reads grammars the way the compiler
+# does. It's a hand-written copy of the parser in metaphor-grammar.txt,
+# so when one changes the other has to follow; "make verify" runs this
+# over the example grammars to catch them drifting apart.
+#
+# For each grammar we compile it with metaphor-compiler.py and read it
+# with metaphor_grammar.py, and compare: whether it's accepted at all,
+# the start rule, the TOKENS, and for each rule (the first definition,
+# which is the one that gets used) what it matches and outputs, in order
+# (see instructions() in metaphor_grammar.py).
+
+import argparse
+import sys
+
+import metaphor_grammar
+from metaphor_tools import COMPILER, read_compiler, run_in_process, \
+     load_program
+
+CONTENT = {"CALL", "LITERAL", "ANY_OF", "ANY_BUT", "GEN", "STORE", "CL",
+           "LOAD", "NL", "TB", "LMI", "LMD"}
+
+def compiled_shape(program):
+    # (start, tokens, {rule: instructions}) from a compiled program,
+    # which is (ADR, start), maybe (LEX, ...), then each rule's label,
+    # body and (R,), then (END,)
+    start, tokens, rules = None, (), {}
+    body = None
+    for item in program:
+        if isinstance(item, str):
+            if body is None:
+                # a rule's label (and only its first definition counts)
+                body = []
+                rules.setdefault(item, body)
+            continue
+        name = item[0].__name__
+        if name == "ADR":
+            start = item[1]
+        elif name == "LEX":
+            tokens = tuple(item[1:])
+        elif name == "R":
+            body = None
+        elif name in CONTENT and body is not None:
+            body.append((name,) + tuple(item[1:]))
+    return start, tokens, rules
+
+def read_shape(grammar):
+    return (grammar.start, tuple(grammar.tokens),
+            {name: list(metaphor_grammar.instructions(node))
+             for name, node in grammar.rules.items()})
+
+def differences(filename, header, core, trailer):
+    status, output, errors = run_in_process(header, core, trailer, filename)
+    try:
+        grammar = metaphor_grammar.read_grammar_file(filename)
+    except metaphor_grammar.GrammarError as problem:
+        if status == 0:
+            yield "metaphor_grammar.py rejects it (%s), the compiler doesn't" \
+                  % problem
+        return
+    if status != 0:
+        yield "the compiler rejects it, metaphor_grammar.py doesn't"
+        return
+    start, tokens, rules = compiled_shape(load_program(header, output))
+    read_start, read_tokens, read_rules = read_shape(grammar)
+    if start != read_start:
+        yield "start rule <%s>, but read as <%s>" % (start, read_start)
+    if tokens != read_tokens:
+        yield "TOKENS %r, but read as %r" % (tokens, read_tokens)
+    if list(rules) != list(read_rules):
+        yield "rules %s, but read as %s" % (" ".join(rules),
+                                            " ".join(read_rules))
+    for name in rules:
+        if name in read_rules and rules[name] != read_rules[name]:
+            for i, (x, y) in enumerate(zip(rules[name] + [None],
+                                           read_rules[name] + [None])):
+                if x != y:
+                    yield "<%s> item %d is %r, but read as %r" % (name, i,
+                                                                  x, y)
+                    break
+
+parser = argparse.ArgumentParser(
+    description="Check that metaphor_grammar.py agrees with the compiler")
+parser.add_argument("grammars", nargs="+", help="grammar files")
+parser.add_argument("--compiler", default=COMPILER,
+                    help="the compiler to compare with")
+ARGS = parser.parse_args()
+
+header, core, trailer = read_compiler(ARGS.compiler)
+problems = 0
+for filename in ARGS.grammars:
+    for difference in differences(filename, header, core, trailer):
+        print("%s: %s" % (filename, difference), file=sys.stderr)
+        problems += 1
+sys.exit(1 if problems else 0)
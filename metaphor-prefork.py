@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+# Run one compiler over many input files with preforked workers:
+#
+#   ./metaphor-prefork.py [--workers=N] compiler file ...
+#
+# We load the compiler once, here: its program is built, the load-time
+# passes are done and (with --compact, which is the default) it's
+# assembled into arrays, and the token and span patterns are made, if
+# any file is big enough to want them. Then gc.freeze() moves all that
+# out of the collector's sight, so that nothing writes to it just to
+# look at it, and we fork the workers, which share it copy-on-write and
+# take files from a queue. So each worker costs not much more than the state of its parses.
+#
+# Each file's output goes to the file name plus --suffix (or into
+# --output-dir), and anything it says on stderr comes out on ours. With
+# --memory, each worker says how much of its memory is its own.
+
+import argparse
+import gc
+import io
+import multiprocessing
+import os
+import sys
+
+from metaphor_tools import error, read_compiler, load_library
+
+parser = argparse.ArgumentParser(
+    description="Run a Metaphor compiler over many files with forked workers")
+parser.add_argument("compiler", help="the compiler to run")
+parser.add_argument("files", nargs="+", help="input files")
+parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="number of worker processes")
+parser.add_argument("--options", default="--compact",
+                    help="runtime options for the compiler")
+parser.add_argument("--suffix", default=".out",
+                    help="added to each file name for its output")
+parser.add_argument("--output-dir",
+                    help="put the outputs here rather than by the inputs")
+parser.add_argument("--memory", action="store_true",
+                    help="report each worker's memory use")
+ARGS = parser.parse_args()
+
+def output_name(name):
+    if ARGS.output_dir:
+        name = os.path.join(ARGS.output_dir, os.path.basename(name))
+    return name + ARGS.suffix
+
+def wants_patterns(namespace, name):
+    try:
+        return namespace["wants_patterns"](os.path.getsize(name))
+    except OSError:
+        return False    # (the worker which gets it will say)
+
+def memory():
+    # (RSS, private) in KB, from /proc on Linux; (0, 0) elsewhere
+    sizes = {}
+    try:
+        with open("/proc/self/smaps_rollup") as fin:
+            for line in fin:
+                if line.endswith(" kB\n"):
+                    what, _, value = line.partition(":")
+                    sizes[what] = int(value.split()[0])
+    except OSError:
+        pass
+    return sizes.get("Rss", 0), \
+           sizes.get("Private_Clean", 0) + sizes.get("Private_Dirty", 0)
+
+#--------------------------------------------------------
+# In the workers
+
+def run_one(namespace, name):
+    # Like metaphor_tools.run_code, but with a compiler that's all ready
+    stderr = io.StringIO()
+    saved = sys.stdout, sys.stderr
+    status = 0
+    try:
+        with open(output_name(name), "w") as out:
+            sys.stdout, sys.stderr = out, stderr
+            namespace["start"](name)
+            namespace["parse"]()
+    except SystemExit as exit:
+        if isinstance(exit.code, int):
+            status = exit.code
+        elif exit.code is not None:
+            print(exit.code, file=stderr)
+            status = 1
+    except Exception as problem:
+        print("+++ %s: %s" % (type(problem).__name__, problem), file=stderr)
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = saved
+    return status, stderr.getvalue()
+
+def worker(number, namespace, jobs, results):
+    done = 0
+    while True:
+        name = jobs.get()
+        if name is None:
+            break
+        status, errors = run_one(namespace, name)
+        results.put(("file", name, status, errors))
+        done += 1
+    results.put(("worker", number, done, memory()))
+
+#--------------------------------------------------------
+# In the parent
+
+try:
+    NAMESPACE = load_library(*read_compiler(ARGS.compiler),
+                             options=ARGS.options.split(), own_gc=True)
+except (OSError, ValueError, SyntaxError) as problem:
+    error("+++ Can't load %s: %s" % (ARGS.compiler, problem))
+except SystemExit:
+    error("+++ Can't load %s with options %r" % (ARGS.compiler, ARGS.options))
+
+# The token and span patterns, if any file is big enough to want them,
+# are made here once, rather than by every worker which gets one
+if any(wants_patterns(NAMESPACE, name) for name in ARGS.files):
+    NAMESPACE["make_patterns"]()
+gc.freeze()
+
+context = multiprocessing.get_context("fork")
+jobs, results = context.Queue(), context.Queue()
+for name in ARGS.files:
+    jobs.put(name)
+workers = [context.Process(target=worker, args=(number, NAMESPACE, jobs,
+                                                 results))
+           for number in range(max(1, ARGS.workers))]
+for process in workers:
+    jobs.put(None)
+    process.start()
+
+failures = 0
+finished = 0
+while finished < len(workers):
+    message = results.get()
+    if message[0] == "file":
+        _, name, status, errors = message
+        if errors:
+            sys.stderr.write("=== %s\n%s" % (name, errors))
+        if status != 0:
+            failures += 1
+    else:
+        _, number, done, (rss, private) = message
+        finished += 1
+        if ARGS.memory:
+            print("worker %d: %d files, RSS %d KB, of which private %d KB" %
+                  (number, done, rss, private), file=sys.stderr)
+for process in workers:
+    process.join()
+
+if ARGS.memory:
+    rss, private = memory()
+    print("parent: RSS %d KB, of which private %d KB" % (rss, private),
+          file=sys.stderr)
+if failures:
+    print("+++ %d of %d files failed" % (failures, len(ARGS.files)),
+          file=sys.stderr)
+    sys.exit(1)
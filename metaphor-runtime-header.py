@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
+# Startup time matters (a compiler may be run thousands of times on tiny
+# inputs), so only import here what every run needs, and nothing Python
+# hasn't already loaded for itself if we can help it. The rest is
+# imported where it's used.
+import codecs
+import io
 import sys
-import string
-import re
 import os
+import time
 
 # Meta-compiler runtime. This was originally based on a tutorial/website by
 # James M. Neighbors: "Tutorial: Metacompilers Part 1" (2008). That was
@@ -18,36 +23,190 @@ def error(*args):
 
 #--------------------------------------------------------
 # Parse command-line arguments, get filenames straight
+#
+# Options come before the input file. The limits bound how much work one
+# parse may do, so that a bad grammar or a pathological input can't tie
+# us up forever. Running out of any of them stops the parse with
+# LIMIT_EXIT_STATUS (exit status 1 means a usage or syntax error).
+# Options without a type are flags, given without a value.
+
+OPTIONS = {
+    "--max-steps":     int,    # instructions executed
+    "--max-seconds":   float,  # wall-clock time
+    "--max-memo":      int,    # entries in RULE_USE_CACHE
+    "--profile":       None,   # report counts and timings on stderr
+    "--fuse":          None,   # use superinstructions (see fuse())
+    "--inline":        None,   # inline tiny rules (see inline())
+    "--compact":       None,   # run the compact form (see assemble())
+    "--bytecode":      str,    # run the program in this bytecode file
+    "--emit-bytecode": str,    # write our output as a bytecode file
+    "--parallel":      int,    # worker processes (see parallel_pass())
+    "--split-rule":    str,    # ... which parse runs of this rule
+    "--split-at":      str,    # ... from just after this text
+    "--stream":        str,    # parse a stream of this rule (see
+                               # parse_stream()); the input may be "-"
+    "--memo-spill":    int,    # memo entries to keep in memory before
+                               # spilling to disk (see TieredMemo)
+    "--memo-dir":      str,    # ... in a file in this directory
+    "--adapt-memo":    None,   # stop memoising rules which never gain
+                               # by it (see adapt_memo())
+    "--gc":            None,   # leave the garbage collector on while
+                               # parsing (see execute())
+    "--no-tokens":     None,   # ignore the grammar's TOKENS (see
+                               # tokenise())
+    "--no-spans":      None,   # run every rule an instruction at a time
+                               # (see spanned())
+    "--bytes":         None,   # read the input as bytes (see "Bytes
+                               # mode" below)
+    "--patterns-from": int,    # use the TOKENS and spans only for
+                               # inputs this long (see make_patterns())
+    "--verify":        None,   # check the program even if it's just as
+                               # metaphor-compiler.py made it (see
+                               # verify())
+}
+LIMIT_EXIT_STATUS = 3
 
 myname = os.path.basename(sys.argv[0])
-if len(sys.argv) == 1:
-    error("Usage: %s <input-file>" % myname)
-INPUT_name = sys.argv[1]
+usage = "Usage: %s [option=value ...] <input-file>\n" % myname + \
+        "Options: " + ", ".join(sorted(OPTIONS))
+
+OPTION_values = {}
+argv = sys.argv[1:]
+while argv and argv[0].startswith("--"):
+    name, _, value = argv.pop(0).partition("=")
+    if name not in OPTIONS:
+        error(usage)
+    if OPTIONS[name] is None:
+        if value:
+            error("Option %s takes no value" % name)
+        OPTION_values[name] = True
+        continue
+    try:
+        OPTION_values[name] = OPTIONS[name](value)
+    except ValueError:
+        error("Bad value for %s: %r" % (name, value))
+if len(argv) != 1:
+    error(usage)
+INPUT_name = argv[0]
+
+MAX_STEPS = OPTION_values.get("--max-steps")
+MAX_SECONDS = OPTION_values.get("--max-seconds")
+MAX_MEMO = OPTION_values.get("--max-memo")
+PROFILE = OPTION_values.get("--profile", False)
+FUSE = OPTION_values.get("--fuse", False)
+INLINE = OPTION_values.get("--inline", False)
+VERIFY = OPTION_values.get("--verify", False)
+COMPACT = OPTION_values.get("--compact", False)
+BYTECODE_name = OPTION_values.get("--bytecode")
+EMIT_BYTECODE_name = OPTION_values.get("--emit-bytecode")
+PARALLEL = OPTION_values.get("--parallel", 0)
+SPLIT_rule = OPTION_values.get("--split-rule")
+SPLIT_at = OPTION_values.get("--split-at")
+if PARALLEL and not (SPLIT_rule and SPLIT_at):
+    error("Option --parallel needs --split-rule and --split-at")
+STREAM_rule = OPTION_values.get("--stream")
+if STREAM_rule and (PARALLEL or EMIT_BYTECODE_name):
+    error("Option --stream can't be used with --parallel or --emit-bytecode")
+MEMO_spill = OPTION_values.get("--memo-spill")
+MEMO_dir = OPTION_values.get("--memo-dir")
+if MEMO_spill is not None and (MEMO_spill < 1 or PARALLEL):
+    error("Option --memo-spill needs a positive value, and no --parallel")
+ADAPT_memo = OPTION_values.get("--adapt-memo", False)
+KEEP_GC = OPTION_values.get("--gc", False)
+# The collector is ours to pause (see pause_collector() in the trailer)
+# if we're the program being run, or if load_library() says so
+GC_owned = __name__ == "__main__"
+NO_TOKENS = OPTION_values.get("--no-tokens", False)
+NO_SPANS = OPTION_values.get("--no-spans", False)
+BYTES = OPTION_values.get("--bytes", False)
+PATTERN_input = OPTION_values.get("--patterns-from", 20000)
+if BYTES and STREAM_rule:
+    error("Options --bytes and --stream can't be used together")
+if ADAPT_memo and STREAM_rule:
+    error("Options --adapt-memo and --stream can't be used together")
+if ADAPT_memo and MEMO_spill:
+    error("Options --adapt-memo and --memo-spill can't be used together")
 
 #--------------------------------------------------------
-# Global variables holding input file contents
+# Global variables holding input file contents, and the state of the
+# parse. start() sets them all up for one input: usually just the one
+# we were given, but see metaphor-prefork.py. If text is given, that's
+# the input, and name just names it (see metaphor_push.py).
+
+NO_VARS = ()
+
+def start(name, text=None):
+    global INPUT, INPUT_file, INPUT_decoder, INPUT_position
+    global GENINT_counter, GEN_numbers
+    global GEN_counted, HWM_position, HWM_rules
+    global CALL_STACK, EXPR_STACK, SWITCH, RETVAL
+    global PC, RULE, VARS_list, OUTPUT_list, RULE_USE_CACHE, MEMO_hits
+    global MEMO_hits_of, UNMEMOISED, MEMO_adapted
+    global TOKEN_kind, LEX_hits, TEXT_spans, SPAN_hits, GC_work
+
+    if text is not None:
+        INPUT = text
+    elif STREAM_rule:
+        # INPUT is just a window on the file, which parse_stream() moves
+        # (read_more() reads its bytes, and decodes them as it would)
+        INPUT_file = sys.stdin if name == "-" else open(name)
+        INPUT_decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(INPUT_file.encoding)(
+                INPUT_file.errors), True)
+        INPUT = ""
+    else:
+        with open(name, "rb" if BYTES else "r") as fin:
+            INPUT = fin.read()
+
+    # Other global variables
+
+    INPUT_position = 0
+    GENINT_counter = 1
+    GEN_numbers = {}    # label -> its number in the output, as a string
+    GEN_counted = 0     # labels numbered before GEN_numbers was cleared
+
+    HWM_position = 0
+    HWM_rules = []
+
+    # The stacks' frames are tuples, which CPython keeps free lists of,
+    # so pushing and popping one hardly allocates anything. (We've tried
+    # the other ways: the positions in an array('i') beside a list of
+    # output lists, frames as __slots__ objects reused from call to call,
+    # and a free list of output lists. Each was as slow or slower, by up
+    # to 8% on AEXP and our own grammar, since each takes more Python to
+    # push and pop than a tuple does.)
+    CALL_STACK = [] # return addr, rule-name, vars list
+    EXPR_STACK = [] # input position, output list 
+    SWITCH = False
+    RETVAL = ""
 
-with open(INPUT_name) as fin:
-    INPUT = fin.read()
- 
-# Other global variables
+    # These get saved on a function (rule) call
+    PC = None
+    RULE = None
+    VARS_list = NO_VARS
+    OUTPUT_list = []
 
-INPUT_position = 0
-GENINT_counter = 1
+    # The packrat memo (see CALL), and which rules we've given up
+    # memoising (see adapt_memo())
+    RULE_USE_CACHE = {}
+    MEMO_hits = 0
+    MEMO_hits_of = {}
+    UNMEMOISED = set()
+    MEMO_adapted = not ADAPT_memo
 
-HWM_position = 0
-HWM_rules = []
+    # The rules the lexer has found tokens for (see tokenise()): none yet
+    TOKEN_kind = {}
+    LEX_hits = 0
 
-CALL_STACK = [] # return addr, rule-name, vars dict
-EXPR_STACK = [] # input position, output list 
-SWITCH = False
-RETVAL = ""
+    # The rules we match all at once (see spanned()): none yet either
+    TEXT_spans = {}
+    SPAN_hits = 0
 
-# These get saved on a function (rule) call
-PC = None
-RULE = None
-VARS_dict = {}
-OUTPUT_list = []
+    # For --profile: the garbage collector's collections, the seconds
+    # they took, and when this one started (see count_collection())
+    GC_work = [0, 0.0, 0.0]
+
+start(INPUT_name)
         
 #--------------------------------------------------------
 # Parsing machine instructions
@@ -65,6 +224,11 @@ def get_char():
     INPUT_position += 1
     return result
 
+def input_text(start, end):
+    # INPUT[start:end] as a string, even with --bytes (for messages)
+    text = INPUT[max(0, start):end]
+    return text if isinstance(text, str) else text.decode("latin-1")
+
 def success():
     global SWITCH, HWM_position, HWM_rules
     SWITCH = True
@@ -133,17 +297,14 @@ def match_char_not_in(candidates):
 # token recognisers in the grammar, rather than built-in to the
 # runtime
 
+# (verify() in the trailer has made sure that x is a string; with
+# --bytes, it's then made into a table: see "Bytes mode" below)
+
 def ANY_OF(x):
-    if isinstance(x, str):
-        match_char_in(x)
-    else:
-        error("Wrong argument " + x + " to ANY_OF")
+    match_char_in(x)
 
 def ANY_BUT(x):
-    if isinstance(x, str):
-        match_char_not_in(x)
-    else:
-        error("Wrong argument " + x + " to ANY_BUT")
+    match_char_not_in(x)
 
 def LITERAL(x):
     CHECKPOINT()
@@ -159,29 +320,79 @@ def LITERAL(x):
 # Be a packrat: 
 # When we use a rule at a particular place in the input, first check 
 # if we've done this before, and if so, return the cached result.
-RULE_USE_CACHE = {}
+# (RULE_USE_CACHE is set up by start().) With --parallel, some of the
+# results were worked out by other processes, and are only SPLICED in
+# when we get to them: see splice() in the trailer. A token rule where
+# the lexer found one of its tokens is as quick: see lexed(). So is a
+# rule which only matches text, which we can match in one go: see
+# spanned().
+
+SPLICED = object()
 
 def CALL(rule):
-    global PC, RULE, OUTPUT_list, VARS_dict
-    global INPUT_position, RETVAL, SWITCH
-    if (INPUT_position, rule) in RULE_USE_CACHE:
-        INPUT_position, RETVAL, SWITCH =  RULE_USE_CACHE[INPUT_position, rule]
+    global PC, RULE, OUTPUT_list, VARS_list
+    global INPUT_position, RETVAL, SWITCH, MEMO_hits
+    key = (INPUT_position, rule)
+    if key in RULE_USE_CACHE:
+        MEMO_hits += 1
+        INPUT_position, RETVAL, SWITCH = RULE_USE_CACHE[key]
+        if RETVAL is SPLICED:
+            splice(key)
+    elif rule in TOKEN_kind and lexed(rule):
+        pass
+    elif rule in TEXT_spans:
+        spanned(rule)
     else:
-        CALL_STACK.append([PC, RULE, VARS_dict])
+        CALL_STACK.append((PC, RULE, VARS_list))
         EXPR_STACK.append((INPUT_position, OUTPUT_list))
-        PC = lookup(rule)
+        PC = LABELS[rule]
         RULE = rule
         OUTPUT_list = []
-        VARS_dict = {}
+        VARS_list = NO_VARS
 
 def R():
-    global PC, RULE, VARS_dict, OUTPUT_list
+    global PC, RULE, VARS_list, OUTPUT_list
     consolidate_OUTPUT_list_to_RETVAL()
     # DON'T restore old INPUT_position ...
     old_posn, OUTPUT_list = EXPR_STACK.pop()  
     # ... but use it to cache our result
     RULE_USE_CACHE[old_posn, RULE] = (INPUT_position, RETVAL, SWITCH)
-    PC, RULE, VARS_dict = CALL_STACK.pop()
+    PC, RULE, VARS_list = CALL_STACK.pop()
+
+# With --adapt-memo, CALL counts each rule's memo hits as well, and CALL
+# and R leave the memo alone for the rules adapt_memo() (in the trailer)
+# has given up on. Without it, they needn't do either.
+
+if ADAPT_memo:
+    def CALL(rule):
+        global PC, RULE, OUTPUT_list, VARS_list
+        global INPUT_position, RETVAL, SWITCH, MEMO_hits
+        key = (INPUT_position, rule)
+        if rule not in UNMEMOISED and key in RULE_USE_CACHE:
+            MEMO_hits += 1
+            MEMO_hits_of[rule] = MEMO_hits_of.get(rule, 0) + 1
+            INPUT_position, RETVAL, SWITCH = RULE_USE_CACHE[key]
+            if RETVAL is SPLICED:
+                splice(key)
+        elif rule in TOKEN_kind and lexed(rule):
+            pass
+        elif rule in TEXT_spans:
+            spanned(rule)
+        else:
+            CALL_STACK.append((PC, RULE, VARS_list))
+            EXPR_STACK.append((INPUT_position, OUTPUT_list))
+            PC = LABELS[rule]
+            RULE = rule
+            OUTPUT_list = []
+            VARS_list = NO_VARS
+
+    def R():
+        global PC, RULE, VARS_list, OUTPUT_list
+        consolidate_OUTPUT_list_to_RETVAL()
+        old_posn, OUTPUT_list = EXPR_STACK.pop()
+        if RULE not in UNMEMOISED:
+            RULE_USE_CACHE[old_posn, RULE] = (INPUT_position, RETVAL, SWITCH)
+        PC, RULE, VARS_list = CALL_STACK.pop()
     
 def SET():
     global RETVAL
@@ -193,17 +404,17 @@ def ADR(label):
 
 def B(label):
     global PC
-    PC = lookup(label)
+    PC = LABELS[label]
 
 def BT(label):
     global PC
     if SWITCH:
-        PC = lookup(label)
+        PC = LABELS[label]
    
 def BF(label):
     global PC
     if not SWITCH:
-        PC = lookup(label)
+        PC = LABELS[label]
         
 def CL(literal):
     OUTPUT_list.append(literal)
@@ -214,10 +425,18 @@ def CI():
 def END():
     PC = None # halt interpreter
 
+# GEN makes a new label, which is just a tuple that nothing else could
+# be equal to: (GEN_source, GENINT_counter), where GEN_source is 0, or
+# which --parallel worker made it. It gets its number when it's first
+# written out (see write_output()), so the numbers don't depend on what
+# was parsed (or thrown away, or found in the memo) before: just on the
+# output, and whichever copies of the label are in it.
+GEN_source = 0
+
 def GEN():
     global GENINT_counter
     global RETVAL
-    RETVAL = str(GENINT_counter)
+    RETVAL = (GEN_source, GENINT_counter)
     GENINT_counter += 1
     success()
 
@@ -254,32 +473,241 @@ def KET():
 def YIELD():
     OUTPUT_list.append(RETVAL)
 
-def STORE(name):
-    VARS_dict[name] = RETVAL
+# A rule's variables are numbered when the program is loaded (see
+# allocate_slots() in the trailer), so STORE and LOAD take a slot number
+# in VARS_list. Most rules never STORE anything, so they all share
+# NO_VARS (which is never changed) until they do.
+
+def STORE(slot):
+    global VARS_list
+    if VARS_list is NO_VARS:
+        VARS_list = [None] * len(SLOT_names[RULE])
+    VARS_list[slot] = RETVAL
 
 def show_place_of_error(message):   
     # This shows where we are NOW
     text = "... " + \
-           INPUT[max(0, INPUT_position - 60):INPUT_position] + "\n" + \
+           input_text(INPUT_position - 60, INPUT_position) + "\n" + \
            "***ERROR: "+ message + "\n***HERE:\n" + \
-               INPUT[INPUT_position:INPUT_position + 60] + " ...\n"
+               input_text(INPUT_position, INPUT_position + 60) + " ...\n"
     # ignore last stackframe
     while len(CALL_STACK) > 1:
         _, rule, _ = CALL_STACK.pop()
         text += "in <" + rule + "> "
     error(text)
 
-def LOAD(name):
+def LOAD(slot):
+    # verify() in the trailer has made sure that it's been stored
     global RETVAL
-    if name in VARS_dict:
-        RETVAL = VARS_dict[name]
-    else:
-        show_place_of_error("INTERNAL ERROR: No such variable: " + name)
+    RETVAL = VARS_list[slot]
 
 # DEBUGGING
 def NOP(what):
     pass
 
+def LEX(*rules):
+    # Not really an instruction: it just records the grammar's TOKENS,
+    # after the last rule, where it's never executed
+    pass
+
+#-------------------------------------------------
+# Superinstructions: each does the work of a common sequence of the
+# instructions above, so the interpreter loop goes round fewer times.
+# They're never in the grammar's output; with --fuse, fuse() in the
+# trailer swaps them in when the program is loaded.
+#
+# A CALL can't be followed by anything in the same instruction, because
+# the rule it calls has to run first. So the ones with CALL come in pairs:
+# if the rule's result was already in RULE_USE_CACHE the first does the
+# whole job and skips the second, and otherwise the rule returns to the
+# second, which finishes off.
+
+def called_from_memo(rule):
+    # CALL, and say whether the rule's result came from the memo
+    resume = PC
+    CALL(rule)
+    return PC == resume
+
+def TOKEN(literal):
+    # CHECKPOINT, CALL '*whitespace*', then as TOKEN_END
+    global PC
+    CHECKPOINT()
+    if called_from_memo("*whitespace*"):
+        PC += 1
+        TOKEN_END(literal)
+
+def TOKEN_END(literal):
+    # BF rollback, LITERAL, BF rollback, COMMIT, B end, rollback: ROLLBACK
+    if SWITCH:
+        LITERAL(literal)
+    if SWITCH:
+        COMMIT()
+    else:
+        ROLLBACK()
+
+def CALL_YIELD_BF(rule, label):
+    global PC
+    if called_from_memo(rule):
+        PC += 1
+        YIELD_BF(label)
+
+def YIELD_BF(label):
+    YIELD()
+    BF(label)
+
+def CALL_STORE_BF(rule, slot, label):
+    global PC
+    if called_from_memo(rule):
+        PC += 1
+        STORE_BF(slot, label)
+
+def STORE_BF(slot, label):
+    STORE(slot)
+    BF(label)
+
+def COMMIT_YIELD_B(label):
+    COMMIT()
+    YIELD()
+    B(label)
+
+def ANY_OF_YIELD_BF(x, label):
+    ANY_OF(x)
+    YIELD_BF(label)
+
+def ANY_BUT_YIELD_BF(x, label):
+    ANY_BUT(x)
+    YIELD_BF(label)
+
+def LITERAL_YIELD_BF(x, label):
+    LITERAL(x)
+    YIELD_BF(label)
+
+def KET_YIELD_BT(label):
+    KET()
+    YIELD()
+    BT(label)
+
+#-------------------------------------------------
+# Inlined rules: with --inline, inline() in the trailer replaces calls
+# of rules which just match one thing, like <digit> ::= ANY_OF '0..9';
+# and runs of alternatives which each match one character, like
+# (<lower> | <upper> | LITERAL '_'). The results are the same as before,
+# except that nothing goes in RULE_USE_CACHE. We still push a frame
+# while "in" the rule, so that the high water mark knows where we were.
+
+def CALL_INLINE(rule, match, x):
+    # CALL a rule which is just "match x" (ANY_OF, ANY_BUT or LITERAL)
+    global RETVAL
+    CALL_STACK.append((PC, RULE, VARS_list))
+    match(x)
+    CALL_STACK.pop()
+    if not SWITCH:
+        RETVAL = ""     # as R would leave it
+
+def CHAR_CLASS(chars, called):
+    # Alternatives which each match one of chars, the first of them
+    # through a CALL_INLINE for each of the called ones. Like those
+    # alternatives, we YIELD the character we match.
+    global RETVAL
+    if have_char() and INPUT[INPUT_position] in chars:
+        got = INPUT[INPUT_position]
+        if got in called:
+            CALL_STACK.append((PC, RULE, VARS_list))
+            match_char_in(got)
+            CALL_STACK.pop()
+        else:
+            match_char_in(got)
+        OUTPUT_list.append(RETVAL)
+    else:
+        failure()
+        if called:
+            RETVAL = ""
+
+#-------------------------------------------------------
+# Bytes mode, for --bytes. For grammars which only deal in ASCII (or
+# Latin-1), INPUT can be the bytes of the file, as they are, rather than
+# decoded into a string: then each byte is a character, and we needn't
+# make a string for each one we look at.
+#
+# These replace the matching instructions above (before the program is
+# made, so it's these which it uses). Once the program is loaded, each
+# string of characters which ANY_OF, ANY_BUT and CHAR_CLASS look for
+# is made into a table of 256 entries, which is true for the bytes in
+# it (see byte_tables() in the trailer), and we look up the byte in
+# that. LITERAL compares the bytes of its string with INPUT in one go.
+# A character we match is still returned as a string (one of CHARS,
+# which are made once), and the output is the same as it would be
+# without --bytes, but written as Latin-1 in one go (see write_bytes()
+# in the trailer). Spans are written just as they are in the input.
+
+if BYTES:
+    CHARS = [chr(byte) for byte in range(256)]
+    ENCODED = {}    # LITERAL's string -> its bytes, if it's Latin-1
+
+    def match_char_in(table):
+        # (which is all that CHECKPOINT, get_char and COMMIT come to)
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and table[INPUT[INPUT_position]]:
+            RETVAL = CHARS[INPUT[INPUT_position]]
+            INPUT_position += 1
+            success()
+        else:
+            failure()
+        return SWITCH
+
+    def match_char_not_in(table):
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and \
+           not table[INPUT[INPUT_position]]:
+            RETVAL = CHARS[INPUT[INPUT_position]]
+            INPUT_position += 1
+            success()
+        else:
+            failure()
+        return SWITCH
+
+    def LITERAL(x):
+        global INPUT_position, RETVAL
+        data = ENCODED.get(x)
+        if data is not None and INPUT.startswith(data, INPUT_position):
+            INPUT_position += len(data)
+            RETVAL = x
+            success()
+            return
+        # It doesn't match, but what it matches of it counts for the
+        # high water mark, and the last character of that is left in
+        # RETVAL, just as though we'd matched a character at a time
+        start = INPUT_position
+        for ch in x:
+            if INPUT_position < len(INPUT) and \
+               CHARS[INPUT[INPUT_position]] == ch:
+                RETVAL = ch
+                INPUT_position += 1
+                success()
+            else:
+                INPUT_position = start
+                failure()
+                return
+
+    def CHAR_CLASS(chars, called):
+        # (called is None if there are none)
+        global INPUT_position, RETVAL
+        if INPUT_position < len(INPUT) and chars[INPUT[INPUT_position]]:
+            got = INPUT[INPUT_position]
+            inside = called is not None and called[got]
+            if inside:
+                CALL_STACK.append((PC, RULE, VARS_list))
+            RETVAL = CHARS[got]
+            INPUT_position += 1
+            success()
+            if inside:
+                CALL_STACK.pop()
+            OUTPUT_list.append(RETVAL)
+        else:
+            failure()
+            if called is not None:
+                RETVAL = ""
+
 #-------------------------------------------------------
 # The "assembler" instructions go here
 PROGRAM = \
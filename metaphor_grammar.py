@@ -0,0 +1,374 @@
+# Reading Metaphor grammars into Python data, for the tools that need to
+# look at a grammar's structure (rather than just compile it).
+#
+# This follows metaphor-grammar.txt closely, including its PEG quirks:
+# keywords are matched as plain prefixes and alternatives are tried in
+# order. A grammar comes back as a Grammar, whose rules map each rule name
+# to an expression tree made of tuples, with the kind of node first (and
+# whose tokens are the rules named after TOKENS, if any):
+#
+#   ("alt", [seq, ...])          e1 | e2 | ...
+#   ("seq", [item, ...])         e1 e2 ...
+#   ("token", s)                 's' (skips <*whitespace*> first)
+#   ("literal", s)               LITERAL 's'
+#   ("any_of", s)                ANY_OF 's'
+#   ("any_but", s)               ANY_BUT 's'
+#   ("gen",)                     GEN
+#   ("empty",)                   EMPTY
+#   ("call", rule)               <rule>
+#   ("group", alt)               ( e1 | e2 ... )
+#   ("repeat", item)             REPEAT item
+#   ("store", item, name)        item:name
+#   ("output", [out, ...], name) { ... } or { ... }:name
+#
+# and the things inside an output are ("string", s), ("nl",), ("tab",),
+# ("indent",), ("outdent",), ("gen",) and ("load", name).
+
+import ast
+import warnings
+
+WHITESPACE = " \t\n\r\u000b\u000c"
+LOWER = "abcdefghijklmnopqrstuvwxyz"
+UPPER = LOWER.upper()
+DIGITS = "0123456789"
+ESCAPES = "\\'\"abfnrtv0"
+HEX_DIGITS = DIGITS + "abcdefABCDEF"
+
+class GrammarError(Exception):
+    pass
+
+class Grammar:
+    def __init__(self, start, rules, tokens=()):
+        self.start = start
+        self.rules = rules  # rule name -> ("alt", ...), in order
+        self.tokens = tokens
+
+#--------------------------------------------------------
+# The reader itself: one method per rule of metaphor-grammar.txt. Each
+# returns None (and leaves self.position alone) if it doesn't match.
+
+class Reader:
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+        self.furthest = 0
+
+    def advance(self, n):
+        self.position += n
+        self.furthest = max(self.furthest, self.position)
+
+    def whitespace(self):
+        text = self.text
+        while self.position < len(text):
+            if text[self.position] in WHITESPACE:
+                self.advance(1)
+            elif text[self.position] == "#":
+                while self.position < len(text) and \
+                      text[self.position] not in "\n\r":
+                    self.advance(1)
+            else:
+                break
+
+    def token(self, s):
+        start = self.position
+        self.whitespace()
+        if self.text.startswith(s, self.position):
+            self.advance(len(s))
+            return s
+        self.position = start
+        return None
+
+    def id(self):
+        start = self.position
+        self.whitespace()
+        text = self.text
+        if self.position < len(text) and text[self.position] in LOWER + UPPER + "_":
+            end = self.position + 1
+            while end < len(text) and text[end] in LOWER + UPPER + "_" + DIGITS:
+                end += 1
+            result = text[self.position:end]
+            self.advance(end - self.position)
+            return result
+        self.position = start
+        return None
+
+    def ruleid(self):
+        result = self.id()
+        if result is None:
+            return self.token("*whitespace*")
+        return result
+
+    def string(self):
+        start = self.position
+        self.whitespace()
+        text = self.text
+        if not text.startswith("'", self.position):
+            self.position = start
+            return None
+        end = self.position + 1
+        while True:
+            if end >= len(text):
+                self.position = start
+                return None
+            if text[end] == "\\" and end + 1 < len(text) and \
+               text[end + 1] in ESCAPES:
+                end += 2
+            elif text.startswith("\\u", end) and end + 6 <= len(text) and \
+                 all(c in HEX_DIGITS for c in text[end + 2:end + 6]):
+                end += 6
+            elif text[end] == "'":
+                break
+            else:
+                end += 1
+        source = text[self.position:end + 1]
+        self.advance(end + 1 - self.position)
+        return decode_string(source)
+
+    def program(self):
+        if self.token("BEGIN") is None or self.token("<") is None:
+            return None
+        start = self.id()
+        if start is None or self.token(">") is None:
+            return None
+        tokens = self.tokens()
+        rules = {}
+        while True:
+            rule = self.st()
+            if rule is None:
+                break
+            name, body = rule
+            # like the runtime's label lookup, the first definition wins
+            rules.setdefault(name, body)
+        if self.token("END") is None:
+            return None
+        return Grammar(start, rules, tokens)
+
+    def tokens(self):
+        # TOKENS <rule> ...; or nothing
+        start = self.position
+        if self.token("TOKENS") is None:
+            return ()
+        names = []
+        while True:
+            before = self.position
+            if self.token("<") is None:
+                break
+            name = self.ruleid()
+            if name is None or self.token(">") is None:
+                self.position = before
+                break
+            names.append(name)
+        if not names or self.token(";") is None:
+            self.position = start
+            return ()
+        return tuple(names)
+
+    def st(self):
+        start = self.position
+        if self.token("<") is not None:
+            name = self.ruleid()
+            if name is not None and self.token(">") is not None and \
+               self.token("::=") is not None:
+                body = self.ex1()
+                if body is not None and self.token(";") is not None:
+                    return name, body
+        self.position = start
+        return None
+
+    def ex1(self):
+        first = self.ex2()
+        if first is None:
+            return None
+        alternatives = [first]
+        while True:
+            start = self.position
+            if self.token("|") is None:
+                break
+            more = self.ex2()
+            if more is None:
+                self.position = start
+                break
+            alternatives.append(more)
+        return ("alt", alternatives)
+
+    def ex2(self):
+        items = []
+        while True:
+            item = self.ex3()
+            if item is None:
+                item = self.output()
+            if item is None:
+                break
+            items.append(item)
+        if not items:
+            return None
+        return ("seq", items)
+
+    def ex3(self):
+        s = self.string()
+        if s is not None:
+            return ("token", s)
+        start = self.position
+        item = self.ex3yield()
+        if item is not None:
+            before_store = self.position
+            if self.token(":") is not None:
+                name = self.id()
+                if name is not None:
+                    return ("store", item, name)
+                self.position = before_store
+            return item
+        self.position = start
+        if self.token("REPEAT") is not None:
+            item = self.ex3()
+            if item is not None:
+                return ("repeat", item)
+        self.position = start
+        return None
+
+    def ex3yield(self):
+        start = self.position
+        for keyword, kind in [("ANY_OF", "any_of"), ("ANY_BUT", "any_but"),
+                              ("LITERAL", "literal")]:
+            if self.token(keyword) is not None:
+                s = self.string()
+                if s is not None:
+                    return (kind, s)
+                self.position = start
+        if self.token("GEN") is not None:
+            return ("gen",)
+        if self.token("EMPTY") is not None:
+            return ("empty",)
+        if self.token("<") is not None:
+            name = self.ruleid()
+            if name is not None and self.token(">") is not None:
+                return ("call", name)
+            self.position = start
+        if self.token("(") is not None:
+            body = self.ex1()
+            if body is not None and self.token(")") is not None:
+                return ("group", body)
+            self.position = start
+        return None
+
+    def output(self):
+        start = self.position
+        if self.token("{") is None:
+            return None
+        outs = []
+        while True:
+            out = self.out1()
+            if out is None:
+                break
+            outs.append(out)
+        if self.token("}") is None:
+            self.position = start
+            return None
+        name = None
+        before_store = self.position
+        if self.token(":") is not None:
+            name = self.id()
+            if name is None:
+                self.position = before_store
+        return ("output", outs, name)
+
+    def out1(self):
+        s = self.string()
+        if s is not None:
+            return ("string", s)
+        for keyword, kind in [("NL", "nl"), ("TAB", "tab"),
+                              ("INDENT", "indent"), ("OUTDENT", "outdent"),
+                              ("GEN", "gen")]:
+            if self.token(keyword) is not None:
+                return (kind,)
+        name = self.id()
+        if name is not None:
+            return ("load", name)
+        return None
+
+def decode_string(source):
+    # The compiler copies strings straight into Python source, so Python
+    # decides what they mean
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return ast.literal_eval(source)
+    except (SyntaxError, ValueError):
+        raise GrammarError("Bad string: " + source)
+
+def read_grammar(text):
+    reader = Reader(text)
+    grammar = reader.program()
+    if grammar is None:
+        where = reader.furthest
+        line = text.count("\n", 0, where) + 1
+        raise GrammarError("Syntax error at line %d:\n%s ..." %
+                           (line, text[where:where + 60]))
+    return grammar
+
+def read_grammar_file(name):
+    with open(name) as fin:
+        return read_grammar(fin.read())
+
+#--------------------------------------------------------
+# Helpers for walking the trees
+
+def children(node):
+    kind = node[0]
+    if kind in ("alt", "seq"):
+        return node[1]
+    if kind in ("group", "repeat", "store"):
+        return [node[1]]
+    return []
+
+def walk(node):
+    yield node
+    for child in children(node):
+        for descendant in walk(child):
+            yield descendant
+
+def calls(node):
+    # Rules called from this node, <*whitespace*> included, in order
+    for descendant in walk(node):
+        if descendant[0] == "call":
+            yield descendant[1]
+        elif descendant[0] == "token":
+            yield "*whitespace*"
+
+# The instructions metaphor-grammar.txt compiles a node to which say
+# what it matches and outputs, in order, as (name, operand...) tuples:
+# the labels, branches, backtracking and YIELDs around them are left out.
+# (metaphor-grammar-check.py compares these with the compiler's own.)
+
+OUTS = {"nl": "NL", "tab": "TB", "indent": "LMI", "outdent": "LMD",
+        "gen": "GEN"}
+
+def instructions(node):
+    kind = node[0]
+    if kind == "token":
+        yield ("CALL", "*whitespace*")
+        yield ("LITERAL", node[1])
+    elif kind in ("literal", "any_of", "any_but"):
+        yield (kind.upper(), node[1])
+    elif kind == "gen":
+        yield ("GEN",)
+    elif kind == "call":
+        yield ("CALL", node[1])
+    elif kind == "store":
+        for instruction in instructions(node[1]):
+            yield instruction
+        yield ("STORE", node[2])
+    elif kind == "output":
+        for out in node[1]:
+            if out[0] == "string":
+                yield ("CL", out[1])
+            elif out[0] == "load":
+                yield ("LOAD", out[1])
+            else:
+                yield (OUTS[out[0]],)
+        if node[2] is not None:
+            yield ("STORE", node[2])
+    else:
+        for child in children(node):
+            for instruction in instructions(child):
+                yield instruction
@@ -0,0 +1,166 @@
+# Feeding a Metaphor compiler its input a piece at a time, as it arrives
+# from a pipe or a socket, rather than all at once:
+#
+#   parser = PushParser("aexp-compiler.py")
+#   for chunk in pieces:
+#       parser.feed(chunk)
+#   output = parser.close()     # or ParseError
+#
+# The compiler runs in a thread of its own, on what it's been fed so
+# far. When it wants a character we haven't got yet, have_char() waits
+# for the next feed() (or for close(), after which there are no more),
+# so the parse just stops where it is until then, and nothing is parsed
+# twice. Meanwhile the caller can be reading the next piece. feed() only
+# puts the piece on a list, and have_char() adds all that's waiting to
+# the input in one go, so that the input isn't copied for every piece.
+# It can't be used with --bytes, whose instructions look at the input
+# without asking have_char() first.
+#
+# AsyncPushParser is the same for asyncio: its feed() and close() are
+# coroutines, which let the event loop get on with other things while
+# the parse catches up with the input.
+#
+# Each parser loads its own copy of the compiler (see load_library in
+# metaphor_tools.py), since a compiler's state is all in its globals.
+
+import asyncio
+import threading
+
+from metaphor_tools import read_compiler, load_library
+
+class ParseError(Exception):
+    # The input didn't parse, or the compiler stopped (on a limit, say)
+    pass
+
+class PushParser:
+    def __init__(self, compiler, options=()):
+        self.namespace = load_library(*read_compiler(compiler),
+                                      options=options)
+        if self.namespace["BYTES"]:
+            raise ValueError("A push parser can't be used with --bytes")
+        self.namespace["start"](compiler, "")
+        self.namespace["have_char"] = self.have_char
+        self.pending = []   # fed, but not yet on the end of INPUT
+        self.fed = 0        # how much we've been fed
+        self.more = threading.Condition()
+        self.closed = False
+        self.output = None
+        self.problem = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def idle(self, reached):
+        # Called in the parser's thread, with self.more held, whenever the
+        # parse catches up with the input (reached is how much of it
+        # there is), or finishes (reached is None)
+        pass
+
+    def have_char(self):
+        namespace = self.namespace
+        if namespace["INPUT_position"] < len(namespace["INPUT"]):
+            return True
+        with self.more:
+            while namespace["INPUT_position"] >= len(namespace["INPUT"]):
+                if self.pending:
+                    self.take_pending()
+                    continue
+                if self.closed:
+                    return False
+                self.idle(len(namespace["INPUT"]))
+                self.more.wait()
+        return True
+
+    def take_pending(self):
+        # (In the parser's thread, with self.more held.) INPUT comes out
+        # of the namespace first, so that ours is the only reference to
+        # it, which lets CPython extend it in place rather than copy it.
+        namespace = self.namespace
+        text = namespace.pop("INPUT")
+        text += "".join(self.pending)
+        namespace["INPUT"] = text
+        self.pending.clear()
+
+    def run(self):
+        namespace = self.namespace
+        try:
+            namespace["execute"]()
+            if namespace["SWITCH"]:
+                self.output = OutputCollector()
+                namespace["write_output"](self.output)
+            else:
+                self.problem = ParseError(namespace["syntax_error_text"]())
+        except SystemExit as exit:
+            self.problem = ParseError("Parse stopped with status %r" %
+                                      exit.code)
+        except Exception as problem:
+            self.problem = problem
+        with self.more:
+            self.idle(None)
+
+    def feed(self, chunk):
+        with self.more:
+            if self.closed:
+                raise ValueError("feed() after close()")
+            self.pending.append(chunk)
+            self.fed += len(chunk)
+            self.more.notify()
+
+    def close(self):
+        # No more input: finish the parse and return its output
+        with self.more:
+            self.closed = True
+            self.more.notify()
+        self.thread.join()
+        return self.result()
+
+    def result(self):
+        if self.problem is not None:
+            raise self.problem
+        return "".join(self.output.parts)
+
+class OutputCollector:
+    # Just enough of a file for write_output()
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+class AsyncPushParser(PushParser):
+    # feed() returns once the parse has caught up with what it was given
+    # (or has finished), so the input can't get far ahead of the parse
+
+    def __init__(self, compiler, options=()):
+        self.loop = asyncio.get_running_loop()
+        self.reached = 0
+        self.progress = asyncio.Event()
+        super().__init__(compiler, options)
+
+    def idle(self, reached):
+        self.loop.call_soon_threadsafe(self.note_progress, reached)
+
+    def note_progress(self, reached):
+        # (In the event loop.) An old note may arrive after a newer one,
+        # so we only ever move forwards.
+        if self.reached is not None:
+            self.reached = reached if reached is None else \
+                           max(self.reached, reached)
+        self.progress.set()
+
+    async def wait_until(self, length):
+        while self.reached is not None and \
+              (length is None or self.reached < length):
+            self.progress.clear()
+            await self.progress.wait()
+
+    async def feed(self, chunk):
+        super().feed(chunk)
+        await self.wait_until(self.fed)
+
+    async def close(self):
+        with self.more:
+            self.closed = True
+            self.more.notify()
+        await self.wait_until(None)
+        self.thread.join()
+        return self.result()
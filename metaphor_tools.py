@@ -0,0 +1,266 @@
+# Helpers shared by the Metaphor tools: building a compiler from a
+# grammar (what the Makefile does with metaphor-compiler.py and combiner),
+# running a compiler while measuring it, and running one inside this
+# Python process without writing it out at all.
+
+import collections
+import gc
+import hashlib
+import io
+import os
+import py_compile
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPILER = os.path.join(HERE, "metaphor-compiler.py")
+COMBINER = os.path.join(HERE, "combiner")
+HEADER = os.path.join(HERE, "metaphor-runtime-header.py")
+TRAILER = os.path.join(HERE, "metaphor-runtime-trailer.py")
+
+def error(*args):
+    print(*args, file=sys.stderr)
+    sys.exit(1)
+
+def build_compiler(grammar, directory, name=None):
+    # Returns the path of the new compiler, <name>-compiler.py
+    if name is None:
+        name = os.path.splitext(os.path.basename(grammar))[0]
+    core = os.path.join(directory, name + "-core.py")
+    compiler = os.path.join(directory, name + "-compiler.py")
+    with open(core, "w") as fout:
+        status = subprocess.call([sys.executable, COMPILER, grammar],
+                                 stdout=fout)
+    if status != 0:
+        error("+++ Couldn't compile", grammar)
+    with open(compiler, "w") as fout:
+        subprocess.check_call([COMBINER, HEADER, core, TRAILER], stdout=fout)
+    os.chmod(compiler, 0o755)
+    return compiler
+
+def build_bytecode(grammar, output):
+    # The grammar compiled to a bytecode file, for --bytecode
+    status = subprocess.call([sys.executable, COMPILER,
+                              "--emit-bytecode=" + output, grammar])
+    if status != 0:
+        error("+++ Couldn't make bytecode from", grammar)
+    return output
+
+def build_runtime(directory):
+    # A runtime with an empty program, which can only run bytecode
+    with open(HEADER) as fin:
+        header = fin.read()
+    with open(TRAILER) as fin:
+        trailer = fin.read()
+    runtime = os.path.join(directory, "metaphor-runtime.py")
+    with open(runtime, "w") as fout:
+        fout.write(combine(header, "", trailer))
+    os.chmod(runtime, 0o755)
+    return runtime
+
+def build_pyc(source):
+    # The compiled form of a compiler (or runtime), which Python can run
+    # as it is, without parsing the source again
+    pyc = source + "c"
+    py_compile.compile(source, cfile=pyc, doraise=True)
+    return pyc
+
+# What running a compiler once gives us. stdout is None unless we asked
+# to keep it. peak_rss_kb is the compiler's own high-water mark, which
+# it reports as it exits (see MEASURED): wait4's ru_maxrss would be at
+# least what we were using ourselves, since Linux counts the memory the
+# child had as a copy of us, between the fork and the exec.
+Run = collections.namedtuple("Run", "status stdout stderr seconds peak_rss_kb")
+
+# A preamble which Python's site module runs (as sitecustomize, from a
+# directory we put on PYTHONPATH) before the compiler, which is run as
+# itself: at exit it writes VmHWM (in KB) to the file descriptor in
+# METAPHOR_PEAK_FD. That costs next to nothing, where running the
+# compiler through "python -c" and runpy cost about 5ms a run. Forked
+# workers (see --parallel) leave through os._exit, so they don't report.
+MEASURED = """\
+import atexit, os, sys
+def report(fd):
+    with open("/proc/self/status") as fin:
+        for line in fin:
+            if line.startswith("VmHWM:"):
+                os.write(fd, line.split()[1].encode())
+if "METAPHOR_PEAK_FD" in os.environ:
+    atexit.register(report, int(os.environ.pop("METAPHOR_PEAK_FD")))
+sys.path.remove(os.path.dirname(__file__))
+"""
+MEASURED_dir = None     # (a tempfile.TemporaryDirectory, holding it)
+
+def measured_environment(fd):
+    global MEASURED_dir
+    if MEASURED_dir is None:
+        MEASURED_dir = tempfile.TemporaryDirectory(prefix="metaphor-measure-")
+        with open(os.path.join(MEASURED_dir.name, "sitecustomize.py"),
+                  "w") as fout:
+            fout.write(MEASURED)
+    environment = dict(os.environ, METAPHOR_PEAK_FD=str(fd))
+    environment["PYTHONPATH"] = os.pathsep.join(
+        [MEASURED_dir.name] + [path for path in
+                               [os.environ.get("PYTHONPATH")] if path])
+    return environment
+
+def run_measured(compiler, options, input_path, keep_stdout=True):
+    # Output goes to temporary files rather than pipes, so that we can
+    # reap the process ourselves with wait4 (and nothing can block)
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err, \
+         tempfile.TemporaryFile() as peak:
+        command = [sys.executable, compiler] + list(options) + [input_path]
+        environment = measured_environment(peak.fileno())
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            command, stderr=err, pass_fds=(peak.fileno(),), env=environment,
+            stdout=out if keep_stdout else subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        err.seek(0)
+        peak.seek(0)
+        stdout = out.read() if keep_stdout else None
+        stderr = err.read()
+        # (without /proc, ru_maxrss is the best we've got)
+        peak_rss_kb = int(peak.read() or usage.ru_maxrss)
+    return Run(process.returncode, stdout, stderr, seconds, peak_rss_kb)
+
+#--------------------------------------------------------
+# Compilers in pieces. A compiler is just the runtime header, "[", the
+# core (the body of the PROGRAM list), "]" and the runtime trailer, as
+# made by combiner.
+
+def combine(header, core, trailer):
+    return header + "[\n" + core + "]\n" + trailer
+
+def split_compiler(text):
+    # Back into (header, core, trailer): the core is the only part whose
+    # lines are all indented or quoted, so the first "[" and "]" lines
+    # on their own are the ones combiner added
+    lines = text.splitlines(True)
+    try:
+        start = lines.index("[\n")
+        end = lines.index("]\n", start)
+    except ValueError:
+        raise ValueError("Doesn't look like a combined compiler")
+    return "".join(lines[:start]), "".join(lines[start + 1:end]), \
+           "".join(lines[end + 1:])
+
+def read_compiler(name):
+    with open(name) as fin:
+        return split_compiler(fin.read())
+
+CODE_cache = {}
+
+def compiled(source, name, mode="exec"):
+    key = hashlib.sha256(source.encode()).hexdigest(), mode
+    if key not in CODE_cache:
+        CODE_cache[key] = compile(source, name, mode)
+    return CODE_cache[key]
+
+def compiler_code(header, core, trailer, cache=True):
+    # The code objects for running a compiler in-process: the header
+    # ends with "PROGRAM = \", waiting for the core, so we finish that
+    # statement off and build PROGRAM from the core ourselves
+    make = compiled if cache else \
+           (lambda source, name, mode="exec": compile(source, name, mode))
+    return (make(header + "None\n", "<runtime-header>"),
+            make("[\n" + core + "]\n", "<core>", "eval"),
+            make(trailer, "<runtime-trailer>"))
+
+def run_in_process(header, core, trailer, input_path, options=()):
+    # Run a compiler on a file, as though from the command line, and
+    # return (exit status, stdout, stderr)
+    return run_code(compiler_code(header, core, trailer), input_path, options)
+
+def run_code(code, input_path, options=(), name="metaphor"):
+    # The same, given what compiler_code() made. The core is evaluated
+    # in the namespace where the instructions it refers to live, and
+    # name is what the compiler is called in its messages. stdout has a
+    # buffer, like the real one, which --bytes writes its bytes to (see
+    # write_bytes() in the runtime trailer); any which aren't UTF-8 come
+    # back as the surrogates of the "surrogateescape" error handler.
+    header, core, trailer = code
+    namespace = {"__name__": "__metaphor__"}
+    def run():
+        exec(header, namespace)
+        namespace["PROGRAM"] = eval(core, namespace)
+        exec(trailer, namespace)
+    saved = sys.argv
+    sys.argv = [name] + list(options) + [input_path]
+    try:
+        return captured(run)
+    finally:
+        sys.argv = saved
+
+def captured(run):
+    # Call run() with stdout and stderr captured, and return (exit
+    # status, stdout, stderr), as run_code() does
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    stderr = io.StringIO()
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    status = 0
+    try:
+        run()
+    except SystemExit as exit:
+        if exit.code is None:
+            status = 0
+        elif isinstance(exit.code, int):
+            status = exit.code
+        else:
+            print(exit.code, file=stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc(file=stderr)
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = saved
+    stdout.flush()
+    return status, stdout.buffer.getvalue().decode("utf-8",
+                                                   "surrogateescape"), \
+           stderr.getvalue()
+
+def load_program(header, core):
+    # Just the PROGRAM list of a compiler, without running it (the
+    # header still wants an input file, so it gets an empty one)
+    namespace = {"__name__": "__metaphor__"}
+    saved = sys.argv
+    sys.argv = ["metaphor", os.devnull]
+    try:
+        exec(compiled(header + "None\n", "<runtime-header>"), namespace)
+    finally:
+        sys.argv = saved
+    return eval(compiled("[\n" + core + "]\n", "<core>", "eval"), namespace)
+
+def load_library(header, core, trailer, options=(), name="metaphor",
+                 own_gc=False):
+    # A compiler loaded and ready to run, but not run: the namespace it
+    # lives in, whose start(input_file) and parse() do the work (parse()
+    # writes to sys.stdout and sys.stderr, and exits through SystemExit
+    # on errors). name is what it's called in its messages. If own_gc,
+    # the process is there just to run it, so (unless --gc) it can pause
+    # the garbage collector while it parses, as it would if it were run
+    # itself; and we pause it while we load it.
+    code = compiler_code(header, core, trailer, cache=False)
+    namespace = {"__name__": "__metaphor_library__"}
+    paused = own_gc and "--gc" not in options and gc.isenabled()
+    saved = sys.argv
+    sys.argv = [name] + list(options) + [os.devnull]
+    try:
+        if paused:
+            gc.disable()
+        exec(code[0], namespace)
+        namespace["GC_owned"] = own_gc
+        namespace["PROGRAM"] = eval(code[1], namespace)
+        exec(code[2], namespace)
+    finally:
+        sys.argv = saved
+        if paused:
+            gc.enable()
+    return namespace